@@ -1,17 +1,21 @@
 # Description: This file contains the analytics functions for the Habit Tracker app
 
 # Import the datetime module to work with dates and times
-# Import the relativedelta module to work with relativedelta objects
+# Import the array module to keep prefix counts compactly
+# Import the heapq module to select the top habits without sorting all of them
+# Import the itemgetter function to rank (habit, value) pairs by value
+# Import the Sized class to tell collections of habits, which can be walked twice, from streams of habits
 
-from dateutil.relativedelta import relativedelta, MO
+from datetime import date
+from array import array
+from collections.abc import Sized
+import heapq
+from operator import itemgetter
 
 # Define a function that returns True if the two dates are in the same week
 def are_dates_in_same_week(date1, date2):
-    # Get the start of the week for each date
-    week_start1 = date1 + relativedelta(weekday=MO(-1))
-    week_start2 = date2 + relativedelta(weekday=MO(-1))
-    # Return True if the dates are in the same week
-    return week_start1.date() == week_start2.date()
+    # Day number 1 (1 January of year 1) is a Monday, so every week from Monday to Sunday shares (day number - 1) // 7
+    return (date1.toordinal() - 1) // 7 == (date2.toordinal() - 1) // 7
 
 # Define a function that returns all habits
 def get_all_habits(habits):
@@ -22,8 +26,40 @@ def get_habits_by_frequency(habits, frequency):
     # Return all habits that match the frequency
     return [habit for habit in habits if habit.habitfrequency == frequency]
 
-# Define a function that returns the longest streak for a habit
-def get_longest_streak(habits):
+# The functions below take any iterable of habits, such as the generator returned by habit_app.iter_habits(),
+# and only hold one habit at a time, so memory is bounded by the largest single history instead of the whole database
+# get_longest_streak() also works this way, it only keeps the habit with the longest streak so far
+
+# Define a function that yields all habits one at a time
+def iter_all_habits(habits):
+    yield from habits
+
+# Define a function that yields the habits with the given frequency one at a time
+def iter_habits_by_frequency(habits, frequency):
+    return (habit for habit in habits if habit.habitfrequency == frequency)
+
+# Define a function that yields each habit with its longest streak, current streak, and number of completions
+def iter_habit_stats(habits, today=None):
+    for habit in habits:
+        yield habit, get_longest_streak_for_habit(habit), get_current_streak_for_habit(habit, today), habit.get_streaks().count
+
+# Define a function that returns the habit with the longest streak and its streak
+# The streaks are computed in Python by default, or inside SQLite with backend="sql" for habits stored in the database
+# In Python, a collection of habits with a length, such as a list or a HabitStore, whose streaks have to be computed from
+# long histories is spread over several cores, backend="parallel" always does that and backend="sequential" never does
+def get_longest_streak(habits, backend="python"):
+    # Let SQLite find the longest streak and map the winning habit id back to its habit
+    if backend == "sql":
+        import sql_analytics
+        habits_by_id = {habit.id: habit for habit in habits}
+        habit_id, streak = sql_analytics.get_longest_streak(list(habits_by_id))
+        return habits_by_id.get(habit_id), streak
+    # Compute the missing streaks in worker processes, habits that are streamed one at a time stay on this core
+    if backend == "parallel" or (backend == "python" and isinstance(habits, Sized)):
+        import parallel_analytics
+        if backend == "parallel" or parallel_analytics.should_run_in_parallel(habits):
+            return parallel_analytics.get_longest_streak(habits)
+
     max_streak = 0
     max_habit = None
     # Loop through all habits
@@ -38,31 +74,144 @@ def get_longest_streak(habits):
     return max_habit, max_streak
 
 # Define a function that returns the longest streak for a habit
-def get_longest_streak_for_habit(habit):
-    streak = 0
-    longest_streak = 0
-    prev_date = None
-    # Loop through all completion dates
-    for completion_date in sorted(habit.completion_dates):
-        # Check if the completion date is the next day or week
-        if prev_date:
-            # Check if the habit is completed daily and the completion date is the next day
-            #if habit.habitfrequency == "daily" and completion_date.date() == prev_date.date() + timedelta(days=1):
-            if habit.habitfrequency == "daily" and completion_date.date() == prev_date.date() + relativedelta(days=1):
-
-                streak += 1
-            # Check if the habit is completed weekly and the completion date is the next week
-            #elif habit.habitfrequency == "weekly" and are_dates_in_same_week(completion_date, prev_date + timedelta(weeks=1)):
-            elif habit.habitfrequency == "weekly" and are_dates_in_same_week(completion_date, prev_date + relativedelta(weeks=1)):
-
-                streak += 1
-            else:
-                streak = 1
+# The streak is kept up to date by the habit by default, or computed inside SQLite with backend="sql" for a habit stored in the database
+def get_longest_streak_for_habit(habit, backend="python"):
+    if backend == "sql":
+        import sql_analytics
+        # Weekly habits read their weeks from the weekly rollup instead of their completions
+        if habit.habitfrequency == "weekly":
+            stats = sql_analytics.get_weekly_streak_stats([habit.id]).get(habit.id)
+            return stats.longest if stats else 0
+        return sql_analytics.get_longest_streak_for_habit(habit.id)
+    # Return the longest streak kept up to date by the habit
+    return habit.get_streaks().longest
+
+# Define a function that returns the current streak for a habit, which is 0 if the last completed period is not this one or the one before
+def get_current_streak_for_habit(habit, today=None):
+    # Get the streaks of the habit
+    stats = habit.get_streaks()
+    # Get the current period
+    current_period = period_key(habit.habitfrequency, today or date.today())
+    # Return the streak if it reaches this period or the previous one, because the current period may not be completed yet
+    if stats.last_period is not None and stats.last_period >= current_period - 1:
+        return stats.current
+    return 0
+
+# Define a function that returns how many distinct periods of a habit between two periods, inclusive, are completed
+def get_completion_count(habit, first_period, last_period):
+    return habit.prefix_counts.count(first_period, last_period)
+
+# Define a function that returns the share of the last periods (days or weeks, up to and including today) in which a habit was completed
+def get_completion_rate(habit, periods, today=None):
+    last_period = period_key(habit.habitfrequency, today or date.today())
+    return get_completion_count(habit, last_period - periods + 1, last_period) / periods
+
+# Define a function that returns the completion rate of every habit over its last periods, in the order of the habits
+def get_completion_rates(habits, periods, today=None):
+    today = today or date.today()
+    return [get_completion_rate(habit, periods, today) for habit in habits]
+
+# Define a function that returns the k habits with the longest streaks, or the longest current streaks, as (habit, streak) pairs
+# The habits are picked with a heap, ties keep the order of the habits
+def get_top_habits_by_streak(habits, k, current=False, today=None):
+    if current:
+        streaks = ((habit, get_current_streak_for_habit(habit, today)) for habit in habits)
+    else:
+        streaks = ((habit, get_longest_streak_for_habit(habit)) for habit in habits)
+    return heapq.nlargest(k, streaks, key=itemgetter(1))
+
+# Define a function that returns the k habits with the highest completion rates over their last periods as (habit, rate) pairs
+def get_top_habits_by_rate(habits, k, periods, today=None):
+    today = today or date.today()
+    return heapq.nlargest(k, ((habit, get_completion_rate(habit, periods, today)) for habit in habits), key=itemgetter(1))
+
+# Define a function that returns the period a date falls into: its day number for daily habits, its week number for weekly habits
+# Consecutive days or weeks get consecutive numbers, so a streak is a run of periods that each differ by 1
+def period_key(frequency, day):
+    # Get the day number of the date, day 1 is Monday 1 January of year 1
+    return period_of_day(frequency, day.toordinal())
+
+# Define a function that returns the period of a day number, as returned by date.toordinal()
+def period_of_day(frequency, ordinal):
+    # Weeks start on Monday, so every day of a week maps to the same week number
+    if frequency == "weekly":
+        return (ordinal - 1) // 7
+    return ordinal
+
+# Define a function that walks all completion days of a habit and returns its streaks, used to build or repair the stored streaks
+def compute_streak_stats(habit):
+    if habit.habitfrequency == "weekly":
+        return StreakStats.from_periods((day - 1) // 7 for day in habit.completion_days)
+    return StreakStats.from_periods(habit.completion_days)
+
+# Define a class that keeps the longest and current streak of a habit up to date as completions are added
+class StreakStats:
+    # Initialize the streaks with the longest streak, the streak ending at the last completion, the last completed period, and the number of completions
+    def __init__(self, longest=0, current=0, last_period=None, count=0):
+        self.longest = longest
+        self.current = current
+        self.last_period = last_period
+        self.count = count
+
+    # Build the streaks from the completed periods of a habit, in any order
+    @classmethod
+    def from_periods(cls, periods):
+        stats = cls()
+        for period in sorted(periods):
+            stats.add(period)
+        return stats
+
+    # Add a completed period and return True, or return False if it is before the last completed period and the streaks must be recomputed
+    def add(self, period):
+        if self.last_period is not None and period < self.last_period:
+            return False
+        # Extend the streak if the period directly follows the last one, otherwise start a new streak
+        # A second completion in the same period also starts a new streak, matching how the history has always been counted
+        if self.last_period is not None and period == self.last_period + 1:
+            self.current += 1
         else:
-            streak = 1
-        # Update the longest streak
-        longest_streak = max(longest_streak, streak)
-        # Update the previous date
-        prev_date = completion_date
-    # Return the longest streak
-    return longest_streak
\ No newline at end of file
+            self.current = 1
+        # Update the longest streak, the last completed period, and the number of completions
+        self.longest = max(self.longest, self.current)
+        self.last_period = period
+        self.count += 1
+        return True
+
+# Define a class that counts the completed periods of a habit up to every period, so the completions in any range of periods are counted in O(1)
+class PrefixCounts:
+    __slots__ = ("first_period", "counts")
+
+    # counts[i] is the number of completed periods from first_period up to, but not including, first_period + i
+    def __init__(self, first_period=0, counts=None):
+        self.first_period = first_period
+        self.counts = array("i", [0]) if counts is None else counts
+
+    # Build the counts from the completed periods of a habit, in order
+    @classmethod
+    def from_periods(cls, periods):
+        prefix = cls()
+        for period in periods:
+            prefix.add(period)
+        return prefix
+
+    # Add a completed period and return True, or return False if it is before the last completed period and the counts must be rebuilt
+    def add(self, period):
+        counts = self.counts
+        if len(counts) == 1:
+            self.first_period = period
+        index = period - self.first_period
+        # The period is already covered: fine if it is completed already, otherwise the counts are out of order
+        if index < len(counts) - 1:
+            return index >= 0 and counts[index + 1] > counts[index]
+        # The periods between the last completed one and this one are not completed
+        total = counts[-1]
+        counts.extend(array("i", [total]) * (index - len(counts) + 1))
+        counts.append(total + 1)
+        return True
+
+    # Count the completed periods between two periods, inclusive
+    def count(self, first_period, last_period):
+        covered = len(self.counts) - 1
+        start = min(max(first_period - self.first_period, 0), covered)
+        end = min(max(last_period - self.first_period + 1, 0), covered)
+        return self.counts[end] - self.counts[start] if end > start else 0
@@ -0,0 +1,152 @@
+# Description: Cold-history archive for the Habit Tracker app
+# Completions older than the archive horizon are moved out of the database into one compressed file per year, kept in a
+# directory next to the database (habits.db.archive/completions-2021.z). Each file holds the completion days of every
+# habit as the raw bytes of an int32 array, compressed with zlib one habit at a time. A marshalled index of
+# {habit id: (offset, size)} at the start of the file lets the days of one habit be read without decompressing the others.
+# The database records the horizon in its meta table and the streaks and completion count of each habit's archived
+# history in the archived_habits table, so streaks can be continued without reading the files. The repository merges
+# the archived days back into every query that reads whole histories.
+
+# Import the marshal, os, re, struct, and zlib modules to read and write the compressed yearly files
+# Import the array module to keep the completion days in compact arrays, and closing to close the files after reading
+# Import the date class to find the year of a day number
+import marshal
+import os
+import re
+import struct
+import zlib
+from array import array
+from contextlib import closing
+from datetime import date
+
+# Define the name of a yearly archive file
+File_Pattern = re.compile(r"^completions-(\d+)\.z$")
+
+# Define the header of a yearly archive file, the size of the index that follows it
+Index_Size = struct.Struct("<q")
+
+# Define a function that returns the year of a day number, as returned by date.toordinal()
+def year_of_day(day):
+    return date.fromordinal(day).year
+
+# Define a class that reads and writes the yearly archive files in one directory
+class CompletionArchive:
+    # Initialize the archive in the given directory, which is created when the first file is written
+    def __init__(self, directory):
+        self.directory = directory
+
+    # Get the path of the file of a year
+    def path(self, year):
+        return os.path.join(self.directory, f"completions-{year}.z")
+
+    # Get the years that have an archive file, in order
+    def years(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(match.group(1)) for match in map(File_Pattern.match, names) if match)
+
+    # Read the file of a year as {habit id: sorted array of day numbers}
+    def read_year(self, year):
+        with closing(YearFile(self.path(year))) as year_file:
+            return {habit_id: year_file.days(habit_id) for habit_id in year_file.index}
+
+    # Write the file of a year from {habit id: sorted array of day numbers}, to a temporary file that then replaces the old one
+    # A year without any days left has its file removed
+    def write_year(self, year, days_by_habit):
+        rows = {habit_id: days.tobytes() for habit_id, days in days_by_habit.items() if days}
+        if not rows:
+            try:
+                os.remove(self.path(year))
+            except FileNotFoundError:
+                pass
+            return
+        # Compress the days of each habit on their own and index where they are in the file
+        blobs = {habit_id: zlib.compress(data) for habit_id, data in rows.items()}
+        index, offset = {}, 0
+        for habit_id, blob in blobs.items():
+            index[habit_id] = (offset, len(blob))
+            offset += len(blob)
+        index_data = marshal.dumps(index)
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = f"{self.path(year)}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(Index_Size.pack(len(index_data)))
+            file.write(index_data)
+            file.writelines(blobs.values())
+        os.replace(temporary_path, self.path(year))
+
+    # Read every file as {year: {habit id: sorted array of day numbers}}
+    def read_years(self):
+        return {year: self.read_year(year) for year in self.years()}
+
+    # Read every file as {habit id: sorted array of day numbers}, with the days of all years merged in order
+    def read_all(self):
+        merged = {}
+        for days_by_habit in self.read_years().values():
+            for habit_id, days in days_by_habit.items():
+                merged.setdefault(habit_id, array("i")).extend(days)
+        return merged
+
+    # Open the files of every year to read the days of one habit at a time, see ArchiveReader
+    def reader(self):
+        return ArchiveReader([self.path(year) for year in self.years()])
+
+    # Read the days of one habit from every file as a sorted array of day numbers
+    def read_habit(self, habit_id):
+        with closing(self.reader()) as reader:
+            return reader.days(habit_id)
+
+# Define a class that reads the days of single habits from one yearly file, decompressing only those habits
+class YearFile:
+    # Open the file and read its index
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            index_size, = Index_Size.unpack(self.file.read(Index_Size.size))
+            self.index = marshal.loads(self.file.read(index_size))
+        except BaseException:
+            self.file.close()
+            raise
+        # The compressed days start right after the index
+        self.data_offset = Index_Size.size + index_size
+
+    # Read the days of a habit as a sorted array of day numbers, empty if the file has none
+    def days(self, habit_id):
+        days = array("i")
+        entry = self.index.get(habit_id)
+        if entry is not None:
+            offset, size = entry
+            self.file.seek(self.data_offset + offset)
+            days.frombytes(zlib.decompress(self.file.read(size)))
+        return days
+
+    # Close the file
+    def close(self):
+        self.file.close()
+
+# Define a class that keeps the files of every year open, so the days of many habits can be read one habit at a time
+# Only the indexes are kept in memory, the days of a habit are decompressed when they are asked for
+class ArchiveReader:
+    # Open the files in the order of their years
+    def __init__(self, paths):
+        self.year_files = []
+        try:
+            for path in paths:
+                self.year_files.append(YearFile(path))
+        except BaseException:
+            self.close()
+            raise
+
+    # Read the days of a habit from every year, merged in order
+    def days(self, habit_id):
+        days = array("i")
+        for year_file in self.year_files:
+            days.extend(year_file.days(habit_id))
+        return days
+
+    # Close every file
+    def close(self):
+        for year_file in self.year_files:
+            year_file.close()
@@ -0,0 +1,394 @@
+# Description: Benchmarks for the Habit Tracker app
+# Run with: python benchmarks.py suite [--scales small medium large] [--output results.json] [--baseline bench_baseline.json]
+#           python benchmarks.py memory
+#           python benchmarks.py service
+#           python benchmarks.py startup
+# All benchmarks build their own synthetic data in a temporary database, habits.db is never touched.
+
+# Import the argparse module to read command line arguments
+# Import the os, random, and tempfile modules to build throwaway databases with synthetic data
+# Import the tracemalloc module to measure Python memory use, and the resource module to measure the peak resident memory
+# Import the multiprocessing module and the ProcessPoolExecutor class to measure each peak in a fresh process
+# Import the asyncio, json, and time modules to drive the service with many clients and time the requests
+# Import the contextmanager decorator to point the app at a benchmark database and back
+# Import the datetime module to work with dates
+# Import the sys module to exit with an error when a benchmark regresses
+# Import the subprocess module to time how long the app takes to show its menu
+# Import the habit_app, analytics, numpy_analytics, parallel_analytics, and sql_analytics modules to benchmark them
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import tempfile
+import sys
+import time
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+# The resource module only exists on Unix, where the peak resident memory is measured
+try:
+    import resource
+except ImportError:
+    resource = None
+from datetime import date, timedelta
+import analytics
+import habit_app
+import numpy_analytics
+import parallel_analytics
+import service
+import sql_analytics
+
+# Define the first day of the synthetic histories, fixed so every run builds the same data
+History_Start = date(2020, 1, 6)
+
+# Define the data sizes of the benchmark suite as (number of habits, days of history)
+Scales = {
+    "small": (100, 365),
+    "medium": (1000, 3 * 365),
+    "large": (10000, 3 * 365),
+}
+
+# Define a function that yields the (habit_id, date) completions of a synthetic history
+# Each habit alternates between runs of completed periods and gaps, with run and gap lengths drawn from geometric
+# distributions with the given means, so the data has realistic streaks. The same seed always gives the same data.
+def generate_completions(habits, days, seed=0, mean_run=8.0, mean_gap=2.0):
+    rng = random.Random(seed)
+    for habit in habits:
+        step = 1 if habit.habitfrequency == "daily" else 7
+        completing = rng.random() < mean_run / (mean_run + mean_gap)
+        for offset in range(0, days, step):
+            if completing:
+                yield habit.id, History_Start + timedelta(days=offset)
+            # Switch between a run and a gap with the probability that gives the mean length
+            if rng.random() < 1 / (mean_run if completing else mean_gap):
+                completing = not completing
+
+# Point the app at a database file for the duration of a with block, then close it and point the app back
+@contextmanager
+def using_database(path):
+    previous = habit_app.Database_Name
+    habit_app.Database_Name = path
+    try:
+        yield habit_app.get_repository()
+    finally:
+        habit_app.close_repository()
+        habit_app.Database_Name = previous
+
+# Define a function that fills a new database with habits that each have a history of the given number of days
+def create_database(path, habit_count, days, seed=0, mean_run=8.0, mean_gap=2.0):
+    with using_database(path):
+        habit_app.init_db()
+        with habit_app.transaction():
+            # Half of the habits are daily and half are weekly
+            habits = [habit_app.add_habit(f"Habit {number}", "daily" if number % 2 == 0 else "weekly") for number in range(habit_count)]
+            habit_app.add_completions(generate_completions(habits, days, seed, mean_run, mean_gap))
+
+# Define a function that returns the fastest time of several calls of a function, in seconds
+# With setup, each call is given what setup() returns, and setup() runs before the timer starts
+def best_time(function, repeat=3, setup=None):
+    times = []
+    for _ in range(repeat):
+        arguments = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        function(*arguments)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+# Time the main operations of the app on one data size and return {operation: seconds}
+def run_scale(habit_count, days, repeat=3, seed=0, mean_run=8.0, mean_gap=2.0):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "habits.db")
+        create_database(path, habit_count, days, seed, mean_run, mean_gap)
+        with using_database(path) as repository:
+            # Loading every habit with its history
+            results["get_all_habits"] = best_time(repository.get_all_habits, repeat)
+            habits = repository.get_all_habits()
+            store = habit_app.HabitStore(repository).load()
+            # The status listing of every habit
+            results["status_listing"] = best_time(store.completed_this_period, repeat)
+            # The status listing read from the memory-mapped completion bitmaps
+            repository.attach_bitmaps(os.path.join(directory, "habits.db.bitmaps"))
+            results["status_listing_bitmaps"] = best_time(store.completed_this_period, repeat)
+            repository.bitmaps.close()
+            repository.bitmaps = None
+            # The longest streak over all habits with the stored streaks, recomputed from every history, in SQL, and with NumPy
+            results["get_longest_streak"] = best_time(lambda: analytics.get_longest_streak(habits), repeat)
+            results["get_longest_streak_recompute"] = best_time(lambda: [analytics.compute_streak_stats(habit) for habit in habits], repeat)
+            results["get_longest_streak_sql"] = best_time(lambda: analytics.get_longest_streak(habits, backend="sql"), repeat)
+            results["get_longest_streak_numpy"] = best_time(lambda: numpy_analytics.get_longest_streak(habits), repeat)
+            # Completion rates over the last 30 periods and the top 10 habits by rate, with the prefix counts built
+            end_day = History_Start + timedelta(days=days - 1)
+            analytics.get_completion_rates(habits, 30, end_day)
+            results["get_completion_rates"] = best_time(lambda: analytics.get_completion_rates(habits, 30, end_day), repeat)
+            results["get_top_habits_by_rate"] = best_time(lambda: analytics.get_top_habits_by_rate(habits, 10, 30, end_day), repeat)
+            # Recomputing every history on a process pool, which computes the streaks again each time they are forgotten
+            def parallel():
+                for habit in habits:
+                    habit.streak_stats = None
+                parallel_analytics.get_longest_streak(habits)
+            results["get_longest_streak_parallel"] = best_time(parallel, repeat)
+            # Completing every habit in memory, on fresh copies made before the timer starts so each one really is completed and only complete() is timed
+            copies = lambda: [habit_app.HabitClass.from_completion_days(h.id, h.habitname, h.habitfrequency, h.creation_date, h.completion_days[:]) for h in habits]
+            results["HabitClass.complete"] = best_time(lambda copies: [habit.complete() for habit in copies], repeat, copies) / len(habits)
+            # Adding completions one at a time after the end of the history, each in its own transaction
+            rng = random.Random(seed)
+            sample = [rng.choice(habits) for _ in range(200)]
+            end = History_Start + timedelta(days=days)
+            def add_completions():
+                for offset, habit in enumerate(sample):
+                    repository.add_completion(habit, end + timedelta(days=offset))
+            results["add_completion"] = best_time(add_completions, 1) / len(sample)
+    return results
+
+# Define a function that returns the operations that are slower than the baseline by more than the threshold
+# Differences below min_difference seconds are timer noise and never count as a regression
+def find_regressions(results, baseline, threshold, min_difference=0.0001):
+    regressions = []
+    for scale, operations in results.items():
+        for operation, seconds in operations.items():
+            expected = baseline.get(scale, {}).get(operation)
+            if expected and seconds > expected * (1 + threshold) and seconds - expected > min_difference:
+                regressions.append((scale, operation, expected, seconds))
+    return regressions
+
+# Run the benchmark suite, save the results, and compare them against a baseline
+# Returns False if any operation regressed past the threshold
+def benchmark_suite(scales, repeat, seed, mean_run, mean_gap, output=None, baseline_path=None, threshold=0.5, save_baseline=False):
+    results = {}
+    for scale in scales:
+        habit_count, days = Scales[scale]
+        print(f"{scale}: {habit_count} habits x {days} days")
+        results[scale] = run_scale(habit_count, days, repeat, seed, mean_run, mean_gap)
+        for operation, seconds in results[scale].items():
+            print(f"  {operation:<32} {seconds * 1000:>10.3f} ms")
+    # Save the results as JSON
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+    if not baseline_path:
+        return True
+    # Store the results as the new baseline, keeping the scales that were not run
+    if save_baseline:
+        baseline = {}
+        if os.path.exists(baseline_path):
+            with open(baseline_path) as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with open(baseline_path, "w") as file:
+            json.dump(baseline, file, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+        return True
+    # Compare the results against the baseline
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    regressions = find_regressions(results, baseline, threshold)
+    for scale, operation, expected, seconds in regressions:
+        print(f"REGRESSION {scale} {operation}: {seconds * 1000:.3f} ms, baseline {expected * 1000:.3f} ms")
+    if not regressions:
+        print(f"No regressions beyond {threshold:.0%} of {baseline_path}")
+    return not regressions
+
+# Define a function that returns the peak Python memory used by a function call, in bytes
+# tracemalloc only sees the objects Python allocates, not the memory SQLite allocates in C
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Define a function that returns the peak resident memory of this process so far, in bytes, or 0 where it cannot be read
+# Linux keeps ru_maxrss across exec, so a new process would start with the peak of the one that started it, while the
+# VmHWM line of /proc/self/status starts again with the new program
+def peak_rss():
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kibibytes and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Open a database, find the longest streak of its habits with a backend ("python" or "sql", or None to only open the
+# database) and return the peak resident memory of the process, in bytes, which counts every allocation of the
+# process, SQLite's page cache and sorts included
+# Run in a fresh process, so the peak is not left over from an earlier measurement
+def streak_peak_rss(path, backend):
+    with using_database(path):
+        if backend == "sql":
+            sql_analytics.get_longest_streak()
+        elif backend == "python":
+            analytics.get_longest_streak(habit_app.get_all_habits())
+        return peak_rss()
+
+# Compare the memory used to find the longest streak in Python and inside SQLite as the history grows
+# The Python backend has to load every completion, while the SQL backend only returns the winning habit
+# The heap columns are the peak Python memory of the call as seen by tracemalloc, which misses what SQLite allocates
+# The rss columns are the peak resident memory of a fresh process that makes the call, next to one that only opens the database
+def benchmark_memory(habit_count, day_counts):
+    print(f"Peak memory to find the longest streak of {habit_count} habits, in KiB")
+    print(f"{'days':>8} {'completions':>12} {'python heap':>12} {'sql heap':>9} {'open rss':>9} {'python rss':>11} {'sql rss':>8}")
+    # Start a new program for every measurement instead of forking this one, which would share its memory
+    context = multiprocessing.get_context("spawn")
+    for days in day_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "habits.db")
+            create_database(path, habit_count, days)
+            with using_database(path) as repository:
+                completions = repository.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+                python_peak = peak_memory(lambda: analytics.get_longest_streak(habit_app.get_all_habits()))
+                sql_peak = peak_memory(lambda: sql_analytics.get_longest_streak())
+            rss = {}
+            for backend in (None, "python", "sql"):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    rss[backend] = executor.submit(streak_peak_rss, path, backend).result() / 1024
+        print(f"{days:>8} {completions:>12} {python_peak / 1024:>12.1f} {sql_peak / 1024:>9.1f} {rss[None]:>9.0f} {rss['python']:>11.0f} {rss['sql']:>8.0f}")
+
+# Define a function that returns the value at a percentile of a sorted list
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# Run one load generator client that sends a mix of reads and writes and records the latency of each request
+async def service_client(port, habit_ids, requests, latencies, seed):
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=2 ** 24)
+    for number in range(requests):
+        choice = rng.random()
+        if choice < 0.2:
+            request = {"op": "create", "name": f"Load {seed}-{number}", "frequency": rng.choice(["daily", "weekly"])}
+        elif choice < 0.4:
+            request = {"op": "complete", "id": rng.choice(habit_ids)}
+        elif choice < 0.6:
+            request = {"op": "status"}
+        elif choice < 0.8:
+            request = {"op": "analytics", "kind": "longest_streak"}
+        else:
+            request = {"op": "analytics", "kind": "habit_streak", "id": rng.choice(habit_ids)}
+        start = time.perf_counter()
+        writer.write(json.dumps(request).encode() + b"\n")
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        latencies.append(time.perf_counter() - start)
+        assert response["ok"], response
+    writer.close()
+
+# Start the service on a synthetic database and drive it with many concurrent clients
+async def run_service_load(habit_count, days, clients, requests):
+    service_instance, server = await service.start_service(port=0)
+    port = server.sockets[0].getsockname()[1]
+    habit_ids = [habit.id for habit in service_instance.store]
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(service_client(port, habit_ids, requests, latencies, seed) for seed in range(clients)))
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    await service_instance.stop()
+    return elapsed, sorted(latencies), service_instance.commits, service_instance.writes
+
+# Measure the throughput and latency of the service under load
+def benchmark_service(habit_count, days, clients, requests):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "habits.db")
+        create_database(path, habit_count, days)
+        with using_database(path):
+            elapsed, latencies, commits, writes = asyncio.run(run_service_load(habit_count, days, clients, requests))
+    print(f"{clients} clients x {requests} requests against {habit_count} habits with {days} days of history")
+    print(f"throughput: {len(latencies) / elapsed:.0f} requests/s")
+    print(f"latency: p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"group commit: {writes} writes in {commits} transactions")
+
+# Define the prompt that the app shows once the habits are loaded
+First_Prompt = b"Enter your choice: "
+
+# Start the app in a directory and return the seconds until it shows the menu, then leave it
+def time_to_first_prompt(directory, *options):
+    start = time.perf_counter()
+    app = subprocess.Popen([sys.executable, os.path.abspath(habit_app.__file__), *options], cwd=directory,
+                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = b""
+    while not output.endswith(First_Prompt):
+        chunk = os.read(app.stdout.fileno(), 65536)
+        if not chunk:
+            raise RuntimeError("the app exited before showing the menu")
+        output += chunk
+    elapsed = time.perf_counter() - start
+    # Choose Exit
+    app.communicate(b"6\n")
+    return elapsed
+
+# Measure the time from starting the app to the first prompt for databases with the given numbers of completions
+# Loading from SQL (--no-snapshot), the first start that also saves the snapshot, and later starts from the snapshot are timed
+def benchmark_startup(completion_counts, repeat):
+    print(f"{'completions':>12} {'sql ms':>9} {'cold ms':>9} {'warm ms':>9}")
+    for target in completion_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            # Half of the habits are daily and half weekly with completions in about 80% of their periods,
+            # so a habit gets about 0.46 completions per day of history
+            days = 1095
+            path = os.path.join(directory, "habits.db")
+            create_database(path, max(2, round(target / (0.46 * days))), days)
+            with using_database(path) as repository:
+                completions = repository.conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+            snapshot_path = os.path.join(directory, "habits.db.snapshot")
+            sql = min(time_to_first_prompt(directory, "--no-snapshot") for _ in range(repeat))
+            cold = []
+            for _ in range(repeat):
+                if os.path.exists(snapshot_path):
+                    os.remove(snapshot_path)
+                cold.append(time_to_first_prompt(directory))
+            warm = min(time_to_first_prompt(directory) for _ in range(repeat))
+        print(f"{completions:>12} {sql * 1000:>9.1f} {min(cold) * 1000:>9.1f} {warm * 1000:>9.1f}")
+
+# Run the benchmark chosen on the command line
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Habit Tracker benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    memory = subparsers.add_parser("memory", help="compare the memory used by the Python and SQL streak backends")
+    memory.add_argument("--habits", type=int, default=200)
+    memory.add_argument("--days", type=int, nargs="+", default=[90, 365, 1095, 2190])
+    load = subparsers.add_parser("service", help="measure the throughput and latency of the asyncio service")
+    load.add_argument("--habits", type=int, default=200)
+    load.add_argument("--days", type=int, default=365)
+    load.add_argument("--clients", type=int, default=50)
+    load.add_argument("--requests", type=int, default=200)
+    startup = subparsers.add_parser("startup", help="measure the time from starting the app to its first prompt")
+    startup.add_argument("--completions", type=int, nargs="+", default=[1000, 100000, 1000000])
+    startup.add_argument("--repeat", type=int, default=3)
+    suite = subparsers.add_parser("suite", help="time the main operations at several data sizes and compare them against a baseline")
+    suite.add_argument("--scales", nargs="+", choices=list(Scales), default=["small", "medium"])
+    suite.add_argument("--repeat", type=int, default=3, help="number of timed runs per operation, the fastest one counts")
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--mean-run", type=float, default=8.0, help="mean number of periods in a row a habit is completed")
+    suite.add_argument("--mean-gap", type=float, default=2.0, help="mean number of periods in a row a habit is missed")
+    suite.add_argument("--output", metavar="PATH", help="save the results as JSON")
+    suite.add_argument("--baseline", metavar="PATH", help="compare the results against this baseline JSON file")
+    suite.add_argument("--threshold", type=float, default=0.5, help="allowed slowdown against the baseline, 0.5 is 50%%")
+    suite.add_argument("--save-baseline", action="store_true", help="store the results in the baseline file instead of comparing")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "suite":
+        passed = benchmark_suite(args.scales, args.repeat, args.seed, args.mean_run, args.mean_gap,
+                                 args.output, args.baseline, args.threshold, args.save_baseline)
+        if not passed:
+            sys.exit(1)
+    elif args.benchmark == "memory":
+        benchmark_memory(args.habits, args.days)
+    elif args.benchmark == "service":
+        benchmark_service(args.habits, args.days, args.clients, args.requests)
+    elif args.benchmark == "startup":
+        benchmark_startup(args.completions, args.repeat)
+
+# Run the main function
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+# Description: Completion bitmaps for the Habit Tracker app
+# A habit's history is kept as one byte per week, counted from the week of its creation date (or of its first
+# completion if that is earlier). Bit 0 of a byte is Monday and bit 6 is Sunday, so checking a day is one bit test
+# and checking a week is one byte test, and the bytes of a habit are the columns of its calendar heatmap.
+# BitmapFile keeps the bitmaps of all habits in one memory-mapped file with a fixed number of weeks per habit, so the
+# status of every habit can be read in a single vectorized pass when NumPy is installed.
+
+# Import the mmap, os, and struct modules to keep the bitmaps in a memory-mapped file
+import mmap
+import os
+import struct
+
+# Use NumPy if it is installed, but only import it the first time it is needed, so importing the app stays fast
+Not_Loaded = object()
+np = Not_Loaded
+
+# Define a function that imports NumPy on first use and returns it, or None if it is not installed
+def load_numpy():
+    global np
+    if np is Not_Loaded:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = None
+    return np
+
+# Define the header of a bitmap file: a magic string, the id and change count of the database it matches,
+# the number of habit slots and the number of weeks kept per habit
+File_Header = struct.Struct("<8sqqqq")
+File_Magic = b"HABITBM1"
+
+# Define the size of the header, followed by one (habit id, first week) entry per slot and then the bitmaps
+Header_Size = 64
+Slot_Entry = struct.Struct("<qq")
+
+# Define how many weeks and slots to leave free when a file is written, so it does not have to grow for a while
+Spare_Weeks = 104
+Spare_Slots = 16
+
+# Define a function that returns the week number and weekday of a day number, weeks start on Monday
+# The week number is the same as analytics.period_of_day("weekly", day)
+def week_of_day(day):
+    return divmod(day - 1, 7)
+
+# Define a class that keeps the completed days of one habit as one byte per week
+class HabitBitmap:
+    __slots__ = ("origin_week", "weeks")
+
+    # Initialize an empty bitmap that starts at the given week
+    def __init__(self, origin_week, weeks=None):
+        self.origin_week = origin_week
+        self.weeks = bytearray() if weeks is None else weeks
+
+    # Build the bitmap of a habit from its completion days, starting at the week of its creation day or of its first completion
+    @classmethod
+    # The days must be sorted
+    def from_days(cls, days, origin_day):
+        if not days:
+            return cls(week_of_day(origin_day)[0])
+        origin_week = week_of_day(min(origin_day, days[0]))[0]
+        weeks = bytearray(week_of_day(days[-1])[0] - origin_week + 1)
+        for day in days:
+            weeks[(day - 1) // 7 - origin_week] |= 1 << (day - 1) % 7
+        return cls(origin_week, weeks)
+
+    # Mark a day as completed, growing the bitmap if the day is outside it
+    def add(self, day):
+        week, weekday = week_of_day(day)
+        index = week - self.origin_week
+        if index < 0:
+            self.weeks[0:0] = bytes(-index)
+            self.origin_week = week
+            index = 0
+        elif index >= len(self.weeks):
+            self.weeks.extend(bytes(index - len(self.weeks) + 1))
+        self.weeks[index] |= 1 << weekday
+
+    # Get the completed days of a week as a 7-bit mask, Monday is bit 0
+    def week_mask(self, week):
+        index = week - self.origin_week
+        return self.weeks[index] if 0 <= index < len(self.weeks) else 0
+
+    # Check if a day is completed
+    def has_day(self, day):
+        week, weekday = week_of_day(day)
+        return self.week_mask(week) >> weekday & 1 == 1
+
+    # Check if any day of a week is completed
+    def has_week(self, week):
+        return self.week_mask(week) != 0
+
+    # Get the completed days in order as day numbers
+    def days(self):
+        return [(self.origin_week + index) * 7 + weekday + 1
+                for index, mask in enumerate(self.weeks) if mask
+                for weekday in range(7) if mask >> weekday & 1]
+
+# Define a class that keeps the bitmaps of all habits in a memory-mapped file
+# The file records the id and change count of the database it was built from, a file that does not match is rebuilt
+class BitmapFile:
+    # Open the file at path, which must already match the database
+    def __init__(self, path):
+        self.path = path
+        self._map_file()
+
+    # Map the file into memory and read its header and slots
+    def _map_file(self):
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.database_id, self.changes, self.slot_count, self.week_count = File_Header.unpack_from(self.map, 0)
+        self.data_offset = Header_Size + self.slot_count * Slot_Entry.size
+        # Index the used slots by habit id and keep the free ones
+        self.slots = {}
+        self.free_slots = []
+        for slot in range(self.slot_count):
+            habit_id, _ = Slot_Entry.unpack_from(self.map, Header_Size + slot * Slot_Entry.size)
+            if habit_id:
+                self.slots[habit_id] = slot
+            else:
+                self.free_slots.append(slot)
+        self.free_slots.reverse()
+
+    # Open the bitmap file of a database, rebuilding it with load_habits() if it is missing or out of date
+    # load_habits returns (habit id, creation day number, sorted completion days) for every habit
+    @classmethod
+    def open(cls, path, database_id, changes, load_habits):
+        try:
+            with open(path, "rb") as file:
+                header = file.read(File_Header.size)
+            valid = len(header) == File_Header.size and File_Header.unpack(header)[:3] == (File_Magic, database_id, changes)
+        except OSError:
+            valid = False
+        if not valid:
+            write_file(path, database_id, changes, {habit_id: HabitBitmap.from_days(days, origin_day) for habit_id, origin_day, days in load_habits()})
+        return cls(path)
+
+    # Get the bitmap of a habit, or None if it has no completions in the file
+    def get(self, habit_id):
+        slot = self.slots.get(habit_id)
+        if slot is None:
+            return None
+        _, origin_week = Slot_Entry.unpack_from(self.map, Header_Size + slot * Slot_Entry.size)
+        start = self.data_offset + slot * self.week_count
+        weeks = bytearray(self.map[start:start + self.week_count])
+        # Drop the unused weeks at the end
+        while weeks and not weeks[-1]:
+            weeks.pop()
+        return HabitBitmap(origin_week, weeks)
+
+    # Mark a completed day of a habit, rewriting the file with more room if the day does not fit
+    def add(self, habit_id, day, origin_day):
+        week, weekday = week_of_day(day)
+        slot = self.slots.get(habit_id)
+        if slot is None and self.free_slots:
+            # Give the habit a free slot that starts at the week of its creation day or of this day
+            slot = self.free_slots.pop()
+            self.slots[habit_id] = slot
+            origin_week = week_of_day(min(origin_day, day))[0]
+            Slot_Entry.pack_into(self.map, Header_Size + slot * Slot_Entry.size, habit_id, origin_week)
+            self.map[self.data_offset + slot * self.week_count:self.data_offset + (slot + 1) * self.week_count] = bytes(self.week_count)
+        if slot is not None:
+            _, origin_week = Slot_Entry.unpack_from(self.map, Header_Size + slot * Slot_Entry.size)
+            index = week - origin_week
+            if 0 <= index < self.week_count:
+                self.map[self.data_offset + slot * self.week_count + index] |= 1 << weekday
+                return
+        # The habit has no slot left or the day is outside its weeks, so rewrite the file with the day added
+        bitmaps = self.load()
+        bitmaps.setdefault(habit_id, HabitBitmap(week_of_day(min(origin_day, day))[0])).add(day)
+        self.rewrite(bitmaps)
+
+    # Remove the bitmap of a deleted habit
+    def remove(self, habit_id):
+        slot = self.slots.pop(habit_id, None)
+        if slot is not None:
+            Slot_Entry.pack_into(self.map, Header_Size + slot * Slot_Entry.size, 0, 0)
+            self.free_slots.append(slot)
+
+    # Record that the bitmaps match the database at the given change count
+    def mark_synced(self, changes):
+        self.changes = changes
+        struct.pack_into("<q", self.map, 16, changes)
+
+    # Get the bitmaps of all habits in the file as {habit id: HabitBitmap}
+    def load(self):
+        return {habit_id: self.get(habit_id) for habit_id in self.slots}
+
+    # Rewrite the file with the given bitmaps, sized to fit them
+    def rewrite(self, bitmaps, database_id=None, changes=None):
+        database_id = self.database_id if database_id is None else database_id
+        changes = self.changes if changes is None else changes
+        self.close()
+        write_file(self.path, database_id, changes, bitmaps)
+        self._map_file()
+
+    # Get the ids of the habits completed on a day and of those completed in the week of that day
+    # With NumPy the slots of all habits are checked in one vectorized pass over the memory-mapped file
+    def completed_ids(self, day):
+        week, weekday = week_of_day(day)
+        np = load_numpy()
+        if np is None:
+            completed_day, completed_week = set(), set()
+            for habit_id in self.slots:
+                mask = self.get(habit_id).week_mask(week)
+                if mask:
+                    completed_week.add(habit_id)
+                    if mask >> weekday & 1:
+                        completed_day.add(habit_id)
+            return completed_day, completed_week
+        entries = np.frombuffer(self.map, dtype="<i8", count=2 * self.slot_count, offset=Header_Size).reshape(self.slot_count, 2)
+        data = np.frombuffer(self.map, dtype=np.uint8, count=self.slot_count * self.week_count, offset=self.data_offset).reshape(self.slot_count, self.week_count)
+        # Find the column of the week in every used slot
+        columns = week - entries[:, 1]
+        slots = np.nonzero((entries[:, 0] != 0) & (columns >= 0) & (columns < self.week_count))[0]
+        masks = data[slots, columns[slots]]
+        habit_ids = entries[slots, 0]
+        completed_week = set(habit_ids[masks != 0].tolist())
+        completed_day = set(habit_ids[(masks >> weekday) & 1 != 0].tolist())
+        return completed_day, completed_week
+
+    # Close the memory map and the file
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+# Define a function that writes a bitmap file for {habit id: HabitBitmap}, to a temporary file that then replaces the old one
+def write_file(path, database_id, changes, bitmaps):
+    slot_count = len(bitmaps) * 2 + Spare_Slots
+    week_count = max((len(bitmap.weeks) for bitmap in bitmaps.values()), default=0) + Spare_Weeks
+    data_offset = Header_Size + slot_count * Slot_Entry.size
+    contents = bytearray(data_offset + slot_count * week_count)
+    File_Header.pack_into(contents, 0, File_Magic, database_id, changes, slot_count, week_count)
+    for slot, (habit_id, bitmap) in enumerate(sorted(bitmaps.items())):
+        Slot_Entry.pack_into(contents, Header_Size + slot * Slot_Entry.size, habit_id, bitmap.origin_week)
+        start = data_offset + slot * week_count
+        contents[start:start + len(bitmap.weeks)] = bitmap.weeks
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(contents)
+    os.replace(temporary_path, path)
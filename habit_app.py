@@ -1,193 +1,1378 @@
 # Description: A habit tracker app that allows users to create, complete, and delete habits. The app also allows users to view analytics for their habits. 
 # The app uses a SQLite database to store habit information and completion dates. The app uses the HabitClass to store habit information and the analytics module to calculate habit analytics.
 
+# Import the argparse module to read command line arguments
+# Import the json and shlex modules to run scripted commands and print their results as JSON
 # Import the sqlite3 module to work with SQLite databases
 # Import the analytics module to work with habit analytics
 # Import the datetime module to work with dates and times
-# Import the relativedelta module to work with relative dates and times
+# Import the array and bisect modules to keep completion days in a compact sorted array
+# Import the OrderedDict class to keep recently used histories in order
+# Import the MutableSequence class to give the completion dates the methods of a list
+# Import the groupby, islice, and itemgetter functions to group query results and batch inserts
+# Import the threading module and contextmanager decorator to share one connection safely, and closing to close archive files
+# Import the sys module to find this module when it runs as a script
+# Import the marshal, os, and struct modules to save and load snapshots of the habits
+# Import the bitmaps module to keep each habit's completed days as one byte per week
+# Import the archive module to move old completions out of the database into compressed yearly files
 
+import argparse
+import json
+import marshal
+import os
+import shlex
 import sqlite3
-from datetime import datetime
+import struct
+import sys
+import threading
+from contextlib import closing, contextmanager
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from collections.abc import MutableSequence
+from datetime import date, datetime, timedelta
+from itertools import groupby, islice
+from operator import itemgetter
 import analytics
-from dateutil.relativedelta import relativedelta, MO
+import archive
+import bitmaps
 
 
 # Define the database name
 Database_Name = "habits.db"
 
+# Define the SQL expression that converts a completion date to its day number, the same number as date.toordinal()
+# julianday() of 1 January of year 1 is 1721425.5 and that day is day number 1
+Day_Number_SQL = "CAST(julianday(date(completion_date)) - 1721424.5 AS INTEGER)"
+
+# Define the SQL expression that converts a completion date to its week number, the same number as analytics.period_key("weekly", date)
+# Day number 1 is a Monday, so weeks run from Monday to Sunday like ISO weeks
+Week_Number_SQL = f"(({Day_Number_SQL}) - 1) / 7"
+
+# Define the SQL expression that converts a completion to its period, the same number as analytics.period_key(frequency, date):
+# its week number for weekly habits and its day number otherwise
+Period_Key_SQL = f"CASE WHEN (SELECT frequency FROM habits WHERE id = habit_id) = 'weekly' THEN {Week_Number_SQL} ELSE {Day_Number_SQL} END"
+
+# Define the schema migrations that are applied on top of the base tables created by init_db()
+# Each entry upgrades the database by one version, PRAGMA user_version records the last version applied
+MIGRATIONS = [
+    # Version 1: index completions by habit and date so per-habit lookups do not scan the whole table
+    "CREATE INDEX IF NOT EXISTS idx_completions_habit_date ON completions (habit_id, completion_date);",
+    # Version 2: store each habit's streaks so analytics do not have to walk the whole history
+    lambda conn: create_habit_stats(conn),
+    # Version 3: index completions by date so the status of all habits can be read from a narrow date range
+    "CREATE INDEX IF NOT EXISTS idx_completions_date_habit ON completions (completion_date, habit_id);",
+    # Version 4: record which tenant owns each habit when several users share a database (see sharding.py)
+    "ALTER TABLE habits ADD COLUMN tenant TEXT; CREATE INDEX IF NOT EXISTS idx_habits_tenant ON habits (tenant);",
+    # Version 5: count the changes to the database so snapshots of the habits can tell when they are out of date
+    lambda conn: create_change_counter(conn),
+    # Version 6: count the completions of each habit per week and per month so dashboards do not aggregate raw completions
+    lambda conn: create_rollups(conn),
+    # Version 7: delete the completions, streaks and rollups of a habit together with the habit
+    lambda conn: add_cascading_deletes(conn),
+    # Version 8: keep the streaks and completion count of each habit's archived history (see archive.py)
+    lambda conn: create_archived_habits(conn),
+    # Version 9: store the period of each completion and allow only one completion per habit and period
+    lambda conn: add_period_keys(conn),
+]
+
+# Define the tables whose changes are counted, a snapshot of the habits is out of date when any of them changes
+Counted_Tables = ("habits", "completions", "habit_stats")
+
+# Define the header of a snapshot file: a magic string, the id of the database and its change count when the snapshot was taken
+Snapshot_Header = struct.Struct("<8sqq")
+Snapshot_Magic = b"HABITSN1"
+
+# Define a list-like view of a habit's completion days as datetimes at midnight
+# Changing the view, for example with habit.completion_dates.append(datetime.now()), changes the habit's completion days
+class CompletionDates(MutableSequence):
+    __slots__ = ("habit",)
+
+    def __init__(self, habit):
+        self.habit = habit
+
+    def __len__(self):
+        return len(self.habit.completion_days)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [datetime.fromordinal(day) for day in self.habit.completion_days[index]]
+        return datetime.fromordinal(self.habit.completion_days[index])
+
+    # Replace or delete completions, the days are sorted again and the streaks are recomputed when next needed
+    def __setitem__(self, index, value):
+        days = list(self.habit.completion_days)
+        if isinstance(index, slice):
+            days[index] = [to_date(item).toordinal() for item in value]
+        else:
+            days[index] = to_date(value).toordinal()
+        self._replace(days)
+
+    def __delitem__(self, index):
+        days = list(self.habit.completion_days)
+        del days[index]
+        self._replace(days)
+
+    # Add a completion, the position is ignored since the days are kept in order
+    def insert(self, index, value):
+        # Keep the history of a lazy habit in the habit itself from now on
+        if self.habit._history is not None:
+            self.habit.completion_days = array("i", self.habit.completion_days)
+        self.habit._add_completion_day(to_date(value).toordinal())
+
+    def _replace(self, days):
+        self.habit.completion_days = array("i", sorted(days))
+        self.habit.streak_stats = None
+
+    def __eq__(self, other):
+        return list(self) == list(other) if isinstance(other, (list, tuple, CompletionDates)) else NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
 # Initialize a HabitClass instance with habit information
 class HabitClass:
+    # Keep only these attributes, without a per-instance dictionary
+    __slots__ = ("id", "habitname", "habitfrequency", "creation_date", "_completion_days", "_history", "_bitmap", "_prefix_counts", "streak_stats")
+
     # Initialize a habit with an id, name, frequency, creation date, and completion dates
-    def __init__(self, id, name_of_habit, frequency_of_habit, creation_date, completion_dates):
+    def __init__(self, id, name_of_habit, frequency_of_habit, creation_date, completion_dates, streak_stats=None):
         # Initialize the habit with the given id, name, frequency, creation date, and completion dates
         self.id = id
         self.habitname = name_of_habit
         self.habitfrequency = frequency_of_habit
         self.creation_date = creation_date
+        # Keep the history in the habit itself, lazy habits fetch it from a HistoryCache instead
+        self._history = None
         self.completion_dates = completion_dates
+        # Keep the streaks of the habit, computed from the completion dates when they are first needed if not given
+        self.streak_stats = streak_stats
+
+    # Create a habit from completion days that are already sorted day numbers, as returned by date.toordinal()
+    @classmethod
+    def from_completion_days(cls, id, name_of_habit, frequency_of_habit, creation_date, completion_days, streak_stats=None):
+        habit = cls(id, name_of_habit, frequency_of_habit, creation_date, [], streak_stats)
+        habit.completion_days = completion_days
+        return habit
+
+    # Create a habit without its history, which is fetched through the history cache when it is first needed
+    @classmethod
+    def lazy(cls, id, name_of_habit, frequency_of_habit, creation_date, history, streak_stats=None):
+        habit = cls(id, name_of_habit, frequency_of_habit, creation_date, [], streak_stats)
+        habit._completion_days = None
+        habit._history = history
+        return habit
+
+    # Get the completed days as a bitmap of one byte per week, built from the completion days when first needed
+    # Lazy habits have no bitmap, their history may leave the cache at any time
+    @property
+    def bitmap(self):
+        if self._history is not None:
+            return None
+        if self._bitmap is None:
+            self._bitmap = bitmaps.HabitBitmap.from_days(self._completion_days, to_date(self.creation_date).toordinal())
+        return self._bitmap
+
+    # Get the completion days as a sorted array of day numbers, fetching the history of a lazy habit if needed
+    @property
+    def completion_days(self):
+        if self._history is None:
+            return self._completion_days
+        return self._history.get(self.id)
+
+    # Replace the completion days with a sorted array of day numbers
+    @completion_days.setter
+    def completion_days(self, completion_days):
+        self._completion_days = completion_days
+        self._history = None
+        self._bitmap = None
+        self._prefix_counts = None
+
+    # Get the number of completed periods up to every period, so analytics can count any range of periods in O(1)
+    # Built from the completion days when first needed, lazy habits build them again every time
+    @property
+    def prefix_counts(self):
+        if self._history is not None or self._prefix_counts is None:
+            prefix_counts = analytics.PrefixCounts.from_periods(analytics.period_of_day(self.habitfrequency, day) for day in self.completion_days)
+            if self._history is not None:
+                return prefix_counts
+            self._prefix_counts = prefix_counts
+        return self._prefix_counts
+
+    # Get the completion days if they are already in memory, or None if the history of a lazy habit is not cached
+    def _loaded_days(self):
+        if self._history is None:
+            return self._completion_days
+        return self._history.peek(self.id)
+
+    # Get the completion dates as datetime objects at midnight, as a list-like view of the sorted completion days
+    # The completions are stored as a sorted array of day numbers, which takes 4 bytes per completion
+    @property
+    def completion_dates(self):
+        return CompletionDates(self)
+
+    # Replace the completion dates, which may be dates or datetimes in any order
+    @completion_dates.setter
+    def completion_dates(self, completion_dates):
+        self.completion_days = array("i", sorted(d.toordinal() for d in completion_dates))
+        self.streak_stats = None
+
+    # Get the streaks of the habit, kept up to date as the habit is completed
+    def get_streaks(self):
+        # Recompute the streaks from the full history if they are missing or do not match the completions in memory
+        days = self._loaded_days()
+        if self.streak_stats is None or (days is not None and self.streak_stats.count != len(days)):
+            self.streak_stats = analytics.compute_streak_stats(self)
+        return self.streak_stats
+
+    # Add a completion day and update the streaks without walking the whole history
+    def _add_completion_day(self, day):
+        # Only update the streaks if they still match the completions, otherwise they are recomputed when next needed
+        days = self._loaded_days()
+        in_sync = self.streak_stats is not None and (days is None or self.streak_stats.count == len(days))
+        # Insert the day in sorted order, a lazy habit whose history is not cached fetches it from the database later
+        if self._history is not None:
+            self._history.insert(self.id, day)
+        else:
+            insort(days, day)
+            if self._bitmap is not None:
+                self._bitmap.add(day)
+            if self._prefix_counts is not None and not self._prefix_counts.add(analytics.period_of_day(self.habitfrequency, day)):
+                self._prefix_counts = None
+        if in_sync and not self.streak_stats.add(analytics.period_of_day(self.habitfrequency, day)):
+            self.streak_stats = None
 
     # Complete a habit if it is not already completed in the current period (today or this week)
     def complete(self):
-        # Get the current date and time
-        now = datetime.now()
-        # If the habit is completed daily and it is not completed today, add the current date and time to the completion dates and return True
+        # Get the current date
+        today = date.today()
+        # If the habit is completed daily and it is not completed today, add today to the completion dates and return True
         if self.habitfrequency == "daily" and not self.is_completed_today():
-            # Add the current date and time to the completion dates
-            self.completion_dates.append(now)
+            # Add today to the completion dates
+            self._add_completion_day(today.toordinal())
             return True
-        # If the habit is completed weekly and it is not completed this week, add the current date and time to the completion dates and return True
+        # If the habit is completed weekly and it is not completed this week, add today to the completion dates and return True
         elif self.habitfrequency == "weekly" and not self.is_completed_this_week():
-            # Add the current date and time to the completion dates
-            self.completion_dates.append(now)
+            # Add today to the completion dates
+            self._add_completion_day(today.toordinal())
             return True
         return False
-    
+
+    # Check if the habit has a completion between two day numbers, inclusive
+    def is_completed_between(self, first_day, last_day):
+        # Ask the database about just these days if the history of a lazy habit is not cached
+        days = self._loaded_days()
+        if days is None:
+            return self._history.repository.has_completion_between(self.id, first_day, last_day)
+        # Find the first completion on or after the first day with a binary search
+        index = bisect_left(days, first_day)
+        return index < len(days) and days[index] <= last_day
+
+    # Check if a habit is completed on a day number, with one bit test if its bitmap is already built
+    # Otherwise a binary search over the completion days is cheaper than building the bitmap from the whole history
+    def is_completed_on(self, day):
+        if self._bitmap is None:
+            return self.is_completed_between(day, day)
+        return self._bitmap.has_day(day)
+
     # Check if a habit is completed today
     def is_completed_today(self):
-        # Get the current date
-        today = datetime.now().date()
-        # Check if the current date is in the completion dates
-        return any(d.date() == today for d in self.completion_dates)
+        # Check if today's day number is in the completion days
+        return self.is_completed_on(date.today().toordinal())
 
     # Check if a habit is completed this week
     def is_completed_this_week(self):
-        # Get the current date
+        # Get the current day number and the day number of the start of the week (Monday)
+        today = date.today().toordinal()
+        week_start = today - (today - 1) % 7
+        # Test the byte of this week in the bitmap if it is already built
+        if self._bitmap is not None:
+            return self._bitmap.has_week(bitmaps.week_of_day(today)[0])
+        # Check if a completion falls between Monday and Sunday of this week
+        return self.is_completed_between(week_start, week_start + 6)
+
+    # Check if a habit is completed for the current period (today for daily habits, this week for weekly habits)
+    def is_completed_this_period(self):
+        if self.habitfrequency == "weekly":
+            return self.is_completed_this_week()
+        return self.is_completed_today()
+
+# Convert a date, datetime, or ISO date string to a date
+def to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(value[:10])
+
+# Keep the histories of lazy habits in a least recently used cache with a limit on the number of habits and completions
+class HistoryCache:
+    # Initialize an empty cache that loads histories from a repository
+    def __init__(self, repository, max_habits=1000, max_completions=None):
+        self.repository = repository
+        self.max_habits = max_habits
+        self.max_completions = max_completions
+        # Map habit ids to their sorted completion days, the least recently used habit comes first
+        self.entries = OrderedDict()
+        # Count the completions held by the cache
+        self.size = 0
+
+    # Get the completion days of a habit, loading them from the database if they are not cached
+    def get(self, habit_id):
+        days = self.entries.get(habit_id)
+        if days is None:
+            days = self.repository.get_completion_days(habit_id)
+            self.entries[habit_id] = days
+            self.size += len(days)
+            self._evict()
+        else:
+            # Mark the habit as the most recently used one
+            self.entries.move_to_end(habit_id)
+        return days
+
+    # Get the completion days of a habit if they are cached, without loading them
+    def peek(self, habit_id):
+        return self.entries.get(habit_id)
+
+    # Insert a completion day into the cached history of a habit, if it is cached
+    def insert(self, habit_id, day):
+        days = self.entries.get(habit_id)
+        if days is not None:
+            insort(days, day)
+            self.size += 1
+
+    # Drop the history of a habit from the cache
+    def discard(self, habit_id):
+        days = self.entries.pop(habit_id, None)
+        if days is not None:
+            self.size -= len(days)
+
+    # Drop the least recently used histories until the cache is within its limits, always keeping the newest one
+    def _evict(self):
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.max_habits or (self.max_completions is not None and self.size > self.max_completions)
+        ):
+            _, days = self.entries.popitem(last=False)
+            self.size -= len(days)
+
+# Manage one long-lived connection to the habit database and run all habit queries through it
+class HabitRepository:
+    # Open the connection once and configure it for fast, concurrent access
+    def __init__(self, database_name):
+        # Remember which database file this repository owns
+        self.database_name = database_name
+        # Open the connection in autocommit mode so transactions are started and ended explicitly by transaction()
+        # SQLite keeps up to cached_statements prepared statements per connection, keyed by their SQL text
+        self.conn = sqlite3.connect(database_name, isolation_level=None, check_same_thread=False, cached_statements=256)
+        # Let a new database give freed pages back to the file system with incremental vacuum, see compact()
+        # This only takes effect on an empty database, before switching to write-ahead logging writes its header
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # Use write-ahead logging so readers do not block the writer and commits do not rewrite the main file
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode NORMAL only syncs at checkpoints, which is still safe against corruption
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        # Checkpoint once the log holds 4000 pages (16 MB) instead of 1000, since a completion writes about eight pages
+        # (the row, its three indexes, the streaks, the change counter and both rollups) and every checkpoint syncs the
+        # files; between checkpoints, pages that many completions touch are written back to the database only once
+        self.conn.execute("PRAGMA wal_autocheckpoint = 4000")
+        # Enforce foreign keys so deleting a habit deletes its completions, streaks and rollups with it
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        # Serialize access from several threads, re-entrant so nested transactions work on the same thread
+        self.lock = threading.RLock()
+        # Count how deeply transaction() is nested so only the outermost block commits
+        self.depth = 0
+        # Keep the completion bitmaps of all habits in a memory-mapped file once attach_bitmaps() is called
+        self.bitmaps = None
+        # Collect the bitmap updates of the current transaction, applied once it commits
+        self.commit_callbacks = []
+        # Keep the completions moved out of the database in yearly files next to it
+        self.archive = archive.CompletionArchive(database_name + ".archive")
+        # Keep the archive horizon in memory once it is read, 0 if nothing is archived and None until it is read
+        # Only archive_completions() moves it, another process sees the new horizon once it opens the database again
+        self.horizon = None
+
+    # Group several operations into one transaction, nested blocks join the outer transaction
+    # A write transaction takes the write lock when it begins, so a writer never reads data that another writer changes
+    # before it writes, which SQLite would report as a locked database; read-only transactions pass immediate=False
+    @contextmanager
+    def transaction(self, immediate=True):
+        with self.lock:
+            # Start a transaction if this is the outermost block
+            if self.depth == 0:
+                self.conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+                # Remember whether the bitmaps match the database before this transaction
+                bitmaps_in_sync = self.bitmaps is not None and self.bitmaps.changes == self.change_count()[1]
+            self.depth += 1
+            try:
+                yield self.conn
+            except BaseException:
+                self.depth -= 1
+                # Roll back everything done in the outermost block if any part of it failed
+                if self.depth == 0:
+                    self.conn.execute("ROLLBACK")
+                    self.commit_callbacks.clear()
+                raise
+            else:
+                self.depth -= 1
+                # Commit once the outermost block is done
+                if self.depth == 0:
+                    changes = self.change_count()[1] if self.bitmaps is not None else None
+                    self.conn.execute("COMMIT")
+                    # Apply the bitmap updates of the transaction
+                    callbacks, self.commit_callbacks = self.commit_callbacks, []
+                    for callback in callbacks:
+                        callback()
+                    # The bitmaps still match the database if they did before and got every change of the transaction
+                    if bitmaps_in_sync:
+                        self.bitmaps.mark_synced(changes)
+
+    # Run part of a transaction on its own savepoint, if it fails only that part is rolled back and the transaction goes on
+    @contextmanager
+    def savepoint(self):
+        with self.transaction() as conn:
+            # Forget the bitmap updates of the part if it is rolled back
+            callbacks = len(self.commit_callbacks)
+            conn.execute("SAVEPOINT part")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK TO part")
+                conn.execute("RELEASE part")
+                del self.commit_callbacks[callbacks:]
+                raise
+            conn.execute("RELEASE part")
+
+    # Run a function once the current transaction commits, used to keep the completion bitmaps in sync
+    def after_commit(self, function):
+        self.commit_callbacks.append(function)
+
+    # Keep the completion bitmaps of all habits in a memory-mapped file, rebuilding it if it does not match the database
+    def attach_bitmaps(self, path):
+        with self.transaction(immediate=False):
+            self.bitmaps = bitmaps.BitmapFile.open(path, *self.change_count(), self.get_bitmap_habits)
+        return self.bitmaps
+
+    # Rebuild the completion bitmaps from the completions table, into the file at path if none is attached yet
+    def rebuild_bitmaps(self, path=None):
+        with self.transaction(immediate=False):
+            database_id, changes = self.change_count()
+            habit_bitmaps = {habit_id: bitmaps.HabitBitmap.from_days(days, origin_day) for habit_id, origin_day, days in self.get_bitmap_habits()}
+            if self.bitmaps is None:
+                bitmaps.write_file(path, database_id, changes, habit_bitmaps)
+                self.bitmaps = bitmaps.BitmapFile(path)
+            else:
+                self.bitmaps.rewrite(habit_bitmaps, database_id, changes)
+        return self.bitmaps
+
+    # Get (habit id, creation day number, sorted completion days) for every habit, to build the bitmaps from
+    def get_bitmap_habits(self):
+        with self.lock:
+            creation_days = [(habit_id, to_date(creation_date).toordinal()) for habit_id, creation_date in self.conn.execute("SELECT id, creation_date FROM habits ORDER BY id")]
+            rows = self.conn.execute(f"SELECT habit_id, {Day_Number_SQL} FROM completions ORDER BY habit_id, completion_date")
+            completions_by_habit = {habit_id: [row[1] for row in habit_rows] for habit_id, habit_rows in groupby(rows, key=itemgetter(0))}
+            # Put the archived days in front of the days in the database
+            for habit_id, days in self.all_archived_days().items():
+                completions_by_habit[habit_id] = days.tolist() + completions_by_habit.get(habit_id, [])
+        return [(habit_id, creation_day, completions_by_habit.get(habit_id, [])) for habit_id, creation_day in creation_days]
+
+    # Create the habits and completions tables and bring the schema up to date
+    def init_db(self):
+        with self.lock:
+            # Create the habits table if it does not exist
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS habits (
+                    /* Define the id column as the primary key */
+                    id INTEGER PRIMARY KEY,
+                    /* Define the name column as a text field that cannot be null */
+                    name TEXT NOT NULL,
+                    /* Define the frequency column as a text field that cannot be null */
+                    frequency TEXT NOT NULL,
+                    /* Define the creation_date column as a text field that cannot be null */
+                    creation_date TEXT NOT NULL
+                );
+            """)
+            # Create the completions table if it does not exist
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS completions (
+                    /* Define the id column as the primary key */
+                    id INTEGER PRIMARY KEY,
+                    /* Define the habit_id column as an integer that cannot be null */
+                    habit_id INTEGER NOT NULL,
+                    /* Define the completion_date column as a text field that cannot be null */
+                    completion_date DATE,
+                    /* Define the habit_id column as a foreign key that references the id column in the habits table */
+                    FOREIGN KEY (habit_id) REFERENCES habits (id)
+                );
+            """)
+            # Bring existing databases up to the latest schema version
+            migrate_db(self.conn)
+
+    # Add a new habit to the database, optionally owned by a tenant
+    def add_habit(self, name, frequency, tenant=None):
+        # Get the current date and time
         now = datetime.now()
-        # Get the start of the week
-        week_start = now + relativedelta(weekday=MO(-1))
-        # Get the end of the week
-        week_end = week_start + relativedelta(days=6)
-        # Check if the current date is in the completed weeks, return True if it is
-        return any(week_start.date() <= d.date() <= week_end.date() for d in self.completion_dates)
+        with self.transaction() as conn:
+            # Insert the habit into the habits table and get the id of the habit that was just added
+            habit_id = conn.execute(
+                "INSERT INTO habits (name, frequency, creation_date, tenant) VALUES (?, ?, ?, ?)", (name, frequency, now, tenant)
+            ).lastrowid
+            # Start the habit without any streak
+            conn.execute("INSERT INTO habit_stats (habit_id) VALUES (?)", (habit_id,))
+        # Return a HabitClass instance with the habit information
+        return HabitClass(habit_id, name, frequency, now, [])
+
+    # Delete a habit and its completions from the database
+    def delete_habit(self, habit_id):
+        with self.transaction() as conn:
+            # Delete the habit from the habits table, its completions, streaks, rollups and archived streaks are deleted with it
+            # Its archived days are left in the archive files until the next archive run drops them
+            conn.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
+            # Delete the bitmap of the habit
+            if self.bitmaps is not None:
+                self.after_commit(lambda: self.bitmaps.remove(habit_id))
+
+    # Get the id of the database and the number of changes made to its habits, completions and streaks so far
+    def change_count(self):
+        with self.lock:
+            rows = dict(self.conn.execute("SELECT key, value FROM meta WHERE key IN ('database_id', 'changes')"))
+            return rows["database_id"], rows["changes"]
+
+    # Get all habits from a snapshot file if it is up to date, otherwise from the database, saving a new snapshot
+    # The change count and the habits are read in one transaction so the snapshot matches the count it is saved with
+    def get_all_habits_cached(self, snapshot_path):
+        with self.transaction(immediate=False):
+            database_id, changes = self.change_count()
+            habits = read_snapshot(snapshot_path, database_id, changes)
+            if habits is None:
+                habits = self.get_all_habits()
+                write_snapshot(snapshot_path, database_id, changes, habits)
+        return habits
+
+    # Get all habits from the database, or only their details if a history cache is given to fetch their completions lazily
+    # If a tenant is given, only the habits owned by that tenant are returned
+    def get_all_habits(self, history=None, tenant=None):
+        # Select the habits of the tenant, or every habit
+        habit_filter, parameters = ("WHERE h.tenant = ?", (tenant,)) if tenant is not None else ("", ())
+        with self.lock:
+            # Get all habits from the habits table
+            # Join the stored streaks of each habit, which are missing for databases that have not been repaired yet
+            habits_data = self.conn.execute(f"""
+                SELECT h.id, h.name, h.frequency, h.creation_date, s.longest_streak, s.current_streak, s.last_period, s.completion_count
+                FROM habits h LEFT JOIN habit_stats s ON s.habit_id = h.id {habit_filter} ORDER BY h.id
+            """, parameters).fetchall()
+
+            # Create lazy habits that fetch their completions through the history cache
+            if history is not None:
+                return [
+                    HabitClass.lazy(row[0], row[1], row[2], datetime.fromisoformat(row[3]), history,
+                                    analytics.StreakStats(*row[4:]) if row[4] is not None else None)
+                    for row in habits_data
+                ]
+
+            # Get all completions in a single query as day numbers, ordered so that each habit's completions are sorted and next to each other
+            completions_data = self.conn.execute(f"""
+                SELECT c.habit_id, {Day_Number_SQL} FROM completions c
+                {"JOIN habits h ON h.id = c.habit_id " + habit_filter if tenant is not None else ""}
+                ORDER BY c.habit_id, c.completion_date
+            """, parameters)
+            # Group the completion days by habit in one pass
+            completions_by_habit = {
+                habit_id: array("i", map(itemgetter(1), rows))
+                for habit_id, rows in groupby(completions_data, key=itemgetter(0))
+            }
+            # Put the archived days in front of the days in the database
+            for habit_id, days in self.all_archived_days().items():
+                completions_by_habit[habit_id] = days + completions_by_habit.get(habit_id, array("i"))
+
+        # Create a list of HabitClass instances
+        habits = []
+        # Loop through each habit
+        for habit_data in habits_data:
+            # Get the habit id, name, frequency, creation date, and stored streaks
+            id, name, frequency, creation_date = habit_data[:4]
+            # Convert the creation date from a string to a datetime object
+            creation_date = datetime.fromisoformat(creation_date)
+            # Use the stored streaks if there are any, otherwise they are computed when first needed
+            streak_stats = analytics.StreakStats(*habit_data[4:]) if habit_data[4] is not None else None
+            # Add the habit to the list of habits with its completion days, or an empty array if it has none
+            habits.append(HabitClass.from_completion_days(id, name, frequency, creation_date, completions_by_habit.get(id, array("i")), streak_stats))
+        # Return the list of habits
+        return habits
+
+    # Yield the habits one at a time with their completions, optionally only those with the given frequency
+    # The habits are read from a cursor ordered by habit and completion date on a separate connection, so only one
+    # habit's history is in memory at a time and the shared connection stays free while the caller works through them
+    def iter_habits(self, frequency=None):
+        # Read the archived days of each habit when the habit comes up, so only one archived history is in memory at a time
+        horizon = self.archive_horizon()
+        with self.lock:
+            archived_ids = {row[0] for row in self.conn.execute("SELECT habit_id FROM archived_habits")} if horizon is not None else set()
+        reader = self.archive.reader() if archived_ids else None
+        conn = sqlite3.connect(self.database_name)
+        try:
+            rows = conn.execute(f"""
+                SELECT h.id, h.name, h.frequency, h.creation_date,
+                       s.longest_streak, s.current_streak, s.last_period, s.completion_count, {Day_Number_SQL}
+                FROM habits h
+                LEFT JOIN habit_stats s ON s.habit_id = h.id
+                LEFT JOIN completions c ON c.habit_id = h.id
+                {"WHERE h.frequency = ?" if frequency else ""}
+                ORDER BY h.id, c.completion_date
+            """, (frequency,) if frequency else ())
+            # Group the rows of each habit and build the habit from them
+            for _, habit_rows in groupby(rows, key=itemgetter(0)):
+                first = next(habit_rows)
+                # Start with the archived days before the horizon, a habit without completions has one row without a day
+                days = array("i")
+                if first[0] in archived_ids:
+                    days = reader.days(first[0])
+                    del days[bisect_left(days, horizon):]
+                days.extend(row[8] for row in (first, *habit_rows) if row[8] is not None)
+                streak_stats = analytics.StreakStats(*first[4:8]) if first[4] is not None else None
+                yield HabitClass.from_completion_days(first[0], first[1], first[2], datetime.fromisoformat(first[3]), days, streak_stats)
+        finally:
+            conn.close()
+            if reader is not None:
+                reader.close()
+
+    # Get the number of completions of a habit, or of every habit, per week as (habit id, week number, completions) rows
+    def get_weekly_counts(self, habit_id=None):
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT habit_id, week, completions FROM completion_weeks {'WHERE habit_id = ?' if habit_id is not None else ''} ORDER BY habit_id, week",
+                () if habit_id is None else (habit_id,),
+            ).fetchall()
+
+    # Get the number of completions of a habit, or of every habit, per month as (habit id, YYYY-MM, completions) rows
+    def get_monthly_counts(self, habit_id=None):
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT habit_id, month, completions FROM completion_months {'WHERE habit_id = ?' if habit_id is not None else ''} ORDER BY habit_id, month",
+                () if habit_id is None else (habit_id,),
+            ).fetchall()
+
+    # Get the completion days of a habit as a sorted array of day numbers, the archived ones included
+    def get_completion_days(self, habit_id):
+        with self.lock:
+            rows = self.conn.execute(f"SELECT {Day_Number_SQL} FROM completions WHERE habit_id = ? ORDER BY completion_date", (habit_id,))
+            days = array("i", map(itemgetter(0), rows))
+            archived = self.archived_days(habit_id)
+            return archived + days if archived else days
+
+    # Check if a habit has a completion between two day numbers, inclusive, reading only that date range
+    def has_completion_between(self, habit_id, first_day, last_day):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM completions WHERE habit_id = ? AND completion_date >= ? AND completion_date < ? LIMIT 1",
+                (habit_id, date.fromordinal(first_day).isoformat(), date.fromordinal(last_day + 1).isoformat()),
+            ).fetchone()
+            # Look in the archive only if the range starts before the horizon
+            if row is None and self.is_archived(first_day):
+                days = self.archived_days(habit_id)
+                index = bisect_left(days, first_day)
+                return index < len(days) and days[index] <= last_day
+        return row is not None
+
+    # Get the ids of the habits that have a completion between two day numbers, inclusive, reading only that date range
+    def get_completed_habit_ids(self, first_day, last_day):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT habit_id FROM completions WHERE completion_date >= ? AND completion_date < ?",
+                (date.fromordinal(first_day).isoformat(), date.fromordinal(last_day + 1).isoformat()),
+            )
+            habit_ids = {row[0] for row in rows}
+            # Look in the archive only if the range starts before the horizon
+            if self.is_archived(first_day):
+                habit_ids |= self.get_archived_habit_ids(first_day, last_day)
+            return habit_ids
+
+    # Get the day before which completions are archived, or None if nothing has been archived
+    # The horizon is read from the meta table once and then kept in memory, so the hot paths do not query it
+    def archive_horizon(self):
+        with self.lock:
+            if self.horizon is None:
+                row = self.conn.execute("SELECT value FROM meta WHERE key = 'archive_horizon'").fetchone()
+                self.horizon = row[0] if row else 0
+            return self.horizon or None
+
+    # Check if a day is before the archive horizon, so its completions are in the archive files
+    def is_archived(self, day):
+        horizon = self.archive_horizon()
+        return horizon is not None and day < horizon
+
+    # Get the archived days of a habit as a sorted array of day numbers, empty if it has no archived history
+    # Only that habit's days are decompressed from each yearly file, and nothing is kept once they are returned
+    # Only days before the horizon count, later days in the files were written by an archive run that did not commit
+    def archived_days(self, habit_id):
+        with self.lock:
+            horizon = self.archive_horizon()
+            # Only the habits in archived_habits have an archived history, the days of deleted habits stay in the files until the next run
+            if horizon is None or self.conn.execute("SELECT 1 FROM archived_habits WHERE habit_id = ?", (habit_id,)).fetchone() is None:
+                return array("i")
+            days = self.archive.read_habit(habit_id)
+        del days[bisect_left(days, horizon):]
+        return days
+
+    # Get the archived days of every habit with an archived history as {habit id: sorted array of day numbers}
+    # Only the reads that load the whole history of every habit anyway use this, the files are read again on each call
+    def all_archived_days(self):
+        with self.lock:
+            horizon = self.archive_horizon()
+            if horizon is None:
+                return {}
+            habit_ids = [row[0] for row in self.conn.execute("SELECT habit_id FROM archived_habits ORDER BY habit_id")]
+            days_by_habit = {}
+            with closing(self.archive.reader()) as reader:
+                for habit_id in habit_ids:
+                    days = reader.days(habit_id)
+                    del days[bisect_left(days, horizon):]
+                    days_by_habit[habit_id] = days
+        return days_by_habit
+
+    # Get the ids of the habits that have an archived completion between two day numbers, inclusive
+    # Only the files of the years in the range are read
+    def get_archived_habit_ids(self, first_day, last_day):
+        with self.lock:
+            horizon = self.archive_horizon()
+            if horizon is None or first_day >= horizon:
+                return set()
+            last_day = min(last_day, horizon - 1)
+            archived_ids = {row[0] for row in self.conn.execute("SELECT habit_id FROM archived_habits")}
+            habit_ids = set()
+            for year in range(archive.year_of_day(first_day), archive.year_of_day(last_day) + 1):
+                if not os.path.exists(self.archive.path(year)):
+                    continue
+                for habit_id, days in self.archive.read_year(year).items():
+                    index = bisect_left(days, first_day)
+                    if habit_id in archived_ids and index < len(days) and days[index] <= last_day:
+                        habit_ids.add(habit_id)
+        return habit_ids
+
+    # Add a completion to the database, for today unless another date is given
+    # Return False without adding anything if the habit is already completed for that day (daily habits) or week
+    # (weekly habits), which the unique index on (habit_id, period_key) decides even with several writers at once
+    def add_completion(self, habit, completion_date=None):
+        # Use today's date if no completion date is given
+        completion_date = datetime.now().date() if completion_date is None else to_date(completion_date)
+        with self.transaction() as conn:
+            # Refuse completions before the archive horizon, the archived streaks could not take them in
+            if self.is_archived(completion_date.toordinal()):
+                raise ValueError(f"{completion_date.isoformat()} is before the archive horizon")
+            # Insert the completion into the completions table unless its period is already completed
+            period = analytics.period_key(habit.habitfrequency, completion_date)
+            cursor = conn.execute(
+                "INSERT INTO completions (habit_id, completion_date, period_key) VALUES (?, ?, ?) ON CONFLICT (habit_id, period_key) DO NOTHING",
+                (habit.id, completion_date.isoformat(), period),
+            )
+            if cursor.rowcount == 0:
+                return False
+            # Get the stored streaks of the habit
+            row = conn.execute("SELECT longest_streak, current_streak, last_period, completion_count FROM habit_stats WHERE habit_id = ?", (habit.id,)).fetchone()
+            stats = analytics.StreakStats(*row) if row else None
+            # Extend the stored streaks, or recompute them if they are missing or the completion is older than the last one
+            if stats is not None and stats.add(period):
+                conn.execute(
+                    "UPDATE habit_stats SET longest_streak = ?, current_streak = ?, last_period = ?, completion_count = ? WHERE habit_id = ?",
+                    (stats.longest, stats.current, stats.last_period, stats.count, habit.id),
+                )
+            else:
+                rebuild_habit_stats(conn, [habit.id])
+            # Mark the day in the habit's bitmap
+            if self.bitmaps is not None:
+                creation_day = to_date(habit.creation_date).toordinal()
+                self.after_commit(lambda: self.bitmaps.add(habit.id, completion_date.toordinal(), creation_day))
+        return True
+
+    # Recompute the stored streaks of every habit from its completions
+    def rebuild_stats(self):
+        with self.transaction() as conn:
+            rebuild_habit_stats(conn)
+
+    # Add many (habit_id, date) completions in batches inside one transaction and return how many were added
+    # Rows for unknown habits, rows before the archive horizon and rows whose day (daily habits) or week (weekly habits)
+    # is already completed are skipped
+    def add_completions(self, completions, batch_size=5000):
+        added = 0
+        changed = set()
+        with self.transaction() as conn:
+            # Get the frequency of every habit so each row can be mapped to its period
+            frequencies = dict(conn.execute("SELECT id, frequency FROM habits"))
+            horizon = self.archive_horizon()
+            # Read the completions one batch at a time so the input is never held in memory as a whole
+            iterator = iter(completions)
+            while True:
+                batch = list(islice(iterator, batch_size))
+                if not batch:
+                    break
+                added += self._add_completion_batch(conn, frequencies, batch, changed, horizon)
+            # Recompute the streaks of the habits that got completions, which may be older than their last one
+            rebuild_habit_stats(conn, changed)
+        # Return the number of completions that were added
+        return added
+
+    # Insert one batch of completions, keeping only the first completion per habit and period
+    # The unique index on (habit_id, period_key) decides which periods are already completed, in the database or
+    # earlier in the input, and the row count of each insert tells whether it was added
+    def _add_completion_batch(self, conn, frequencies, batch, changed, horizon=None):
+        added = []
+        for habit_id, day in batch:
+            habit_id = int(habit_id)
+            frequency = frequencies.get(habit_id)
+            # Skip completions for habits that do not exist
+            if frequency is None:
+                continue
+            day = to_date(day)
+            # Skip completions that are older than the archived history
+            if horizon is not None and day.toordinal() < horizon:
+                continue
+            cursor = conn.execute(
+                "INSERT INTO completions (habit_id, completion_date, period_key) VALUES (?, ?, ?) ON CONFLICT (habit_id, period_key) DO NOTHING",
+                (habit_id, day.isoformat(), analytics.period_key(frequency, day)),
+            )
+            if cursor.rowcount == 1:
+                added.append((habit_id, day.toordinal()))
+        # Remember which habits got new completions
+        changed.update(habit_id for habit_id, _ in added)
+        # Mark the days in the bitmaps of the habits
+        if self.bitmaps is not None:
+            self.after_commit(lambda: [self.bitmaps.add(habit_id, day, day) for habit_id, day in added])
+        return len(added)
+
+    # Move the completions before a day number into the yearly archive files and return how many were moved
+    # The horizon is moved back to a Monday so no week of a weekly habit is split between the archive and the database
+    # The streaks and completion count of each archived history are kept in archived_habits, the stored streaks and the
+    # rollups still cover the whole history, and the bitmaps and snapshots do not change since no completion is lost
+    def archive_completions(self, before_day):
+        horizon = before_day - (before_day - 1) % 7
+        with self.transaction() as conn:
+            # Read the horizon from the database, another process may have moved it since it was last read
+            row = conn.execute("SELECT value FROM meta WHERE key = 'archive_horizon'").fetchone()
+            old_horizon = row[0] if row else None
+            # The horizon only moves forward
+            if old_horizon is not None and horizon <= old_horizon:
+                return 0
+            horizon_date = date.fromordinal(horizon).isoformat()
+            rows = conn.execute(f"""
+                SELECT c.habit_id, h.frequency, {Day_Number_SQL} FROM completions c JOIN habits h ON h.id = c.habit_id
+                WHERE c.completion_date < ? ORDER BY c.habit_id, c.completion_date
+            """, (horizon_date,)).fetchall()
+            if not rows:
+                return 0
+            # Continue the archived streaks of each habit with the completions being moved, which all come after them
+            summaries = {row[0]: analytics.StreakStats(*row[1:]) for row in conn.execute(
+                "SELECT habit_id, longest_streak, current_streak, last_period, completion_count FROM archived_habits")}
+            # Read the files, keeping only the habits that still have an archived history and the days before the old horizon
+            years = self.archive.read_years()
+            for days_by_habit in years.values():
+                for habit_id in list(days_by_habit):
+                    days = days_by_habit[habit_id]
+                    if habit_id in summaries:
+                        days_by_habit[habit_id] = days[:bisect_left(days, old_horizon)]
+                    else:
+                        del days_by_habit[habit_id]
+            # Add the completions being moved to the files of their years
+            for (habit_id, frequency), habit_rows in groupby(rows, key=itemgetter(0, 1)):
+                stats = summaries.setdefault(habit_id, analytics.StreakStats())
+                for year, year_rows in groupby(habit_rows, key=lambda row: archive.year_of_day(row[2])):
+                    days = years.setdefault(year, {}).setdefault(habit_id, array("i"))
+                    for _, _, day in year_rows:
+                        days.append(day)
+                        stats.add(analytics.period_of_day(frequency, day))
+            # Write the files before the completions are deleted, if the transaction fails the old horizon hides the new days
+            for year, days_by_habit in years.items():
+                self.archive.write_year(year, days_by_habit)
+            # Delete the completions, the archiving flag keeps the rollup triggers from uncounting them
+            conn.execute("INSERT INTO meta (key, value) VALUES ('archiving', 1)")
+            conn.execute("DELETE FROM completions WHERE completion_date < ?", (horizon_date,))
+            conn.execute("DELETE FROM meta WHERE key = 'archiving'")
+            conn.executemany("INSERT OR REPLACE INTO archived_habits VALUES (?, ?, ?, ?, ?)",
+                             [(habit_id, stats.longest, stats.current, stats.last_period, stats.count) for habit_id, stats in summaries.items()])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('archive_horizon', ?)", (horizon,))
+            # Keep the new horizon in memory once it is committed
+            self.after_commit(lambda: setattr(self, "horizon", horizon))
+        return len(rows)
+
+    # Give the pages freed by deleted rows back to the file system
+    # A database created before incremental vacuum was switched on is converted once with a full VACUUM
+    def compact(self):
+        with self.lock:
+            if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self.conn.execute("VACUUM")
+            else:
+                # The pragma frees one page per step, so step through all of them
+                self.conn.execute("PRAGMA incremental_vacuum").fetchall()
+            # Shrink the write-ahead log as well
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # Close the connection
+    def close(self):
+        with self.lock:
+            if self.bitmaps is not None:
+                self.bitmaps.close()
+            self.conn.close()
+
+# Keep the loaded habits in memory, indexed by id and by frequency, and write every change through to the database
+class HabitStore:
+    # Initialize an empty store on top of a repository, the shared one by default
+    # A lazy store only loads the details of each habit and keeps the histories it needs in a bounded HistoryCache
+    # If a snapshot path is given, an eager store loads the habits from that snapshot while it is up to date
+    def __init__(self, repository=None, lazy=False, max_habits=1000, max_completions=None, snapshot_path=None):
+        self.repository = repository or get_repository()
+        self.snapshot_path = snapshot_path
+        self.history = HistoryCache(self.repository, max_habits, max_completions) if lazy else None
+        # Index the habits by id
+        self.habits_by_id = {}
+        # Index the habits by frequency, each frequency maps habit ids to habits so removing one is O(1)
+        self.habits_by_frequency = {"daily": {}, "weekly": {}}
+        # Count the changes to the habits so cached analytics results can tell when they are out of date
+        self.generation = 0
+        # Cache analytics results as key -> (generation, result)
+        self.analytics_cache = {}
+
+    # Load all habits from the database, replacing the habits in the store
+    def load(self):
+        self.habits_by_id = {}
+        self.habits_by_frequency = {"daily": {}, "weekly": {}}
+        if self.history is None and self.snapshot_path:
+            habits = self.repository.get_all_habits_cached(self.snapshot_path)
+        else:
+            habits = self.repository.get_all_habits(self.history)
+        for habit in habits:
+            self._index(habit)
+        self.generation += 1
+        return self
+
+    # Add a habit to the indexes
+    def _index(self, habit):
+        self.habits_by_id[habit.id] = habit
+        self.habits_by_frequency.setdefault(habit.habitfrequency, {})[habit.id] = habit
+
+    # Loop through the habits in the order they were created
+    def __iter__(self):
+        return iter(self.habits_by_id.values())
+
+    # Get the number of habits
+    def __len__(self):
+        return len(self.habits_by_id)
+
+    # Get a habit by id, or None if there is no such habit
+    def get(self, habit_id):
+        return self.habits_by_id.get(habit_id)
+
+    # Get the habits with the given frequency
+    def by_frequency(self, frequency):
+        return list(self.habits_by_frequency.get(frequency, {}).values())
+
+    # Add a new habit to the database and the store
+    def add(self, name, frequency):
+        habit = self.repository.add_habit(name, frequency)
+        self.insert(habit)
+        return habit
+
+    # Delete a habit from the database and the store, and return it or None if there is no such habit
+    def delete(self, habit_id):
+        if habit_id not in self.habits_by_id:
+            return None
+        self.repository.delete_habit(habit_id)
+        return self.remove(habit_id)
+
+    # Complete a habit in the database and the store, and return False if it is already completed for this period
+    def complete(self, habit):
+        if habit.is_completed_this_period():
+            return False
+        # Write the completion to the database first so the store never holds a completion the database does not have
+        added = self.repository.add_completion(habit)
+        self.apply_completion(habit, added)
+        return added
+
+    # Add a habit that is already in the database to the store
+    def insert(self, habit):
+        self._index(habit)
+        self.generation += 1
+
+    # Remove a habit that was already deleted from the database from the store, and return it
+    def remove(self, habit_id):
+        habit = self.habits_by_id.pop(habit_id)
+        del self.habits_by_frequency[habit.habitfrequency][habit_id]
+        if self.history is not None:
+            self.history.discard(habit_id)
+        self.generation += 1
+        return habit
+
+    # Complete a habit in the store for a completion that is already in the database
+    # If the database refused the completion, another writer completed the habit for this period first, and the
+    # history is read again since that completion may be on another day of the week
+    def apply_completion(self, habit, added=True):
+        if added:
+            habit._add_completion_day(date.today().toordinal())
+        else:
+            habit.streak_stats = None
+            if self.history is not None:
+                self.history.discard(habit.id)
+            else:
+                habit.completion_days = self.repository.get_completion_days(habit.id)
+        self.generation += 1
+
+    # Get the ids of the habits that are completed for the current period
+    def completed_this_period(self):
+        today = date.today()
+        # Read the status of all habits from the memory-mapped bitmaps in one pass
+        if self.repository.bitmaps is not None:
+            completed_today, completed_this_week = self.repository.bitmaps.completed_ids(today.toordinal())
+        # Check the habits in memory
+        elif self.history is None:
+            return {habit.id for habit in self if habit.is_completed_this_period()}
+        # Read only today's and this week's completions from the database instead of loading any history
+        else:
+            week_start = today.toordinal() - today.weekday()
+            completed_today = self.repository.get_completed_habit_ids(today.toordinal(), today.toordinal())
+            completed_this_week = self.repository.get_completed_habit_ids(week_start, week_start + 6)
+        return {habit.id for habit in self if habit.id in (completed_this_week if habit.habitfrequency == "weekly" else completed_today)}
+
+    # Return the cached result for a key, or call the function and cache its result until the habits change
+    def cached(self, key, function):
+        entry = self.analytics_cache.get(key)
+        if entry is None or entry[0] != self.generation:
+            entry = (self.generation, function())
+            self.analytics_cache[key] = entry
+        return entry[1]
+
+# Define the repository shared by the module-level functions, created on first use
+_repository = None
+
+# Get the shared repository, opening a new one if the database name has changed since it was created
+def get_repository():
+    global _repository
+    if _repository is None or _repository.database_name != Database_Name:
+        # Close the connection to the old database before switching
+        if _repository is not None:
+            _repository.close()
+        _repository = HabitRepository(Database_Name)
+    return _repository
+
+# Close the shared repository, the next call to get_repository() opens it again
+def close_repository():
+    global _repository
+    if _repository is not None:
+        _repository.close()
+        _repository = None
+
+# Group several of the functions below into a single transaction
+def transaction():
+    return get_repository().transaction()
 
 # Initialize the SQLite database with habits and completions tables
 def init_db():
-    # Connect to the database
-    conn = sqlite3.connect(Database_Name)
-    # Create a cursor
-    cur = conn.cursor()
-    # Create the habits table if it does not exist
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS habits (
-            /* Define the id column as the primary key */
-            id INTEGER PRIMARY KEY,
-            /* Define the name column as a text field that cannot be null */
-            name TEXT NOT NULL,
-            /* Define the frequency column as a text field that cannot be null */
-            frequency TEXT NOT NULL,
-            /* Define the creation_date column as a text field that cannot be null */
-            creation_date TEXT NOT NULL
+    get_repository().init_db()
+
+# Apply the schema migrations that the database has not seen yet
+def migrate_db(conn):
+    # Get the schema version the database is currently at
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    # Apply every newer migration in its own transaction together with the new version number
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            # Migrations that need more than SQL are functions that are given the connection
+            if callable(migration):
+                conn.execute("BEGIN")
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.execute("COMMIT")
+            else:
+                conn.executescript(f"BEGIN; {migration} PRAGMA user_version = {number}; COMMIT;")
+        except BaseException:
+            # Undo the half-applied migration so the database stays at the last version that completed
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+# Create the habit_stats table that stores the streaks of each habit and fill it from the existing completions
+def create_habit_stats(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS habit_stats (
+            /* Define the habit_id column as the primary key that references the id column in the habits table */
+            habit_id INTEGER PRIMARY KEY REFERENCES habits (id),
+            /* Define the longest streak of the habit in days or weeks */
+            longest_streak INTEGER NOT NULL DEFAULT 0,
+            /* Define the streak that ends at the last completed period */
+            current_streak INTEGER NOT NULL DEFAULT 0,
+            /* Define the last completed period, as returned by analytics.period_key() */
+            last_period INTEGER,
+            /* Define the number of completions the streaks were computed from */
+            completion_count INTEGER NOT NULL DEFAULT 0
         );
     """)
-    # Create the completions table if it does not exist
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS completions (
-            /* Define the id column as the primary key */
+    rebuild_habit_stats(conn)
+
+# Create the meta table with a random id for the database and a change counter that triggers keep up to date
+def create_change_counter(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('database_id', abs(random())), ('changes', 0)")
+    for table in Counted_Tables:
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS count_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN UPDATE meta SET value = value + 1 WHERE key = 'changes'; END
+            """)
+
+# Create the completion_weeks and completion_months rollup tables, the triggers that keep them up to date, and fill them
+def create_rollups(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS completion_weeks (
+            habit_id INTEGER NOT NULL REFERENCES habits (id) ON DELETE CASCADE,
+            /* Define the week as the week number of analytics.period_key(), weeks start on Monday */
+            week INTEGER NOT NULL,
+            completions INTEGER NOT NULL,
+            PRIMARY KEY (habit_id, week)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS completion_months (
+            habit_id INTEGER NOT NULL REFERENCES habits (id) ON DELETE CASCADE,
+            /* Define the month as YYYY-MM */
+            month TEXT NOT NULL,
+            completions INTEGER NOT NULL,
+            PRIMARY KEY (habit_id, month)
+        ) WITHOUT ROWID
+    """)
+    # Count each completion in its week and month, and uncount it when it is deleted or changed
+    rollups = [("completion_weeks", "week", Week_Number_SQL), ("completion_months", "month", "strftime('%Y-%m', completion_date)")]
+    for table, column, expression in rollups:
+        count = f"""
+            INSERT INTO {table} (habit_id, {column}, completions) VALUES (NEW.habit_id, {expression.replace("completion_date", "NEW.completion_date")}, 1)
+            ON CONFLICT (habit_id, {column}) DO UPDATE SET completions = completions + 1;
+        """
+        uncount = f"""
+            UPDATE {table} SET completions = completions - 1
+            WHERE habit_id = OLD.habit_id AND {column} = {expression.replace("completion_date", "OLD.completion_date")};
+            DELETE FROM {table} WHERE habit_id = OLD.habit_id AND completions <= 0;
+        """
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS rollup_{table}_insert AFTER INSERT ON completions BEGIN {count} END")
+        # Completions moved to the archive stay counted, archive_completions() sets the archiving flag while it deletes them
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS rollup_{table}_delete AFTER DELETE ON completions
+            WHEN NOT EXISTS (SELECT 1 FROM meta WHERE key = 'archiving') BEGIN {uncount} END
+        """)
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS rollup_{table}_update AFTER UPDATE OF habit_id, completion_date ON completions BEGIN {uncount} {count} END")
+        # Fill the rollup from the completions that are already there
+        conn.execute(f"DELETE FROM {table}")
+        conn.execute(f"INSERT INTO {table} (habit_id, {column}, completions) SELECT habit_id, {expression}, COUNT(*) FROM completions GROUP BY 1, 2")
+
+# Rebuild the tables that refer to habits so their rows are deleted together with the habit
+# SQLite cannot add a foreign key action to an existing table, so each table is copied into a new one, without the rows
+# of habits that were already deleted, and its indexes and triggers are created again
+def add_cascading_deletes(conn):
+    conn.execute("""
+        CREATE TABLE completions_new (
             id INTEGER PRIMARY KEY,
-            /* Define the habit_id column as an integer that cannot be null */
-            habit_id INTEGER NOT NULL,
-            /* Define the completion_date column as a text field that cannot be null */
-            completion_date DATE,
-            /* Define the habit_id column as a foreign key that references the id column in the habits table */
-            FOREIGN KEY (habit_id) REFERENCES habits (id)
-        );
+            habit_id INTEGER NOT NULL REFERENCES habits (id) ON DELETE CASCADE,
+            completion_date DATE
+        )
     """)
-    # Commit the changes
-    conn.commit()
-    # Close the connection
-    conn.close()
+    conn.execute("INSERT INTO completions_new SELECT id, habit_id, completion_date FROM completions WHERE habit_id IN (SELECT id FROM habits)")
+    conn.execute("DROP TABLE completions")
+    conn.execute("ALTER TABLE completions_new RENAME TO completions")
+    conn.execute("CREATE INDEX idx_completions_habit_date ON completions (habit_id, completion_date)")
+    conn.execute("CREATE INDEX idx_completions_date_habit ON completions (completion_date, habit_id)")
+    conn.execute("""
+        CREATE TABLE habit_stats_new (
+            habit_id INTEGER PRIMARY KEY REFERENCES habits (id) ON DELETE CASCADE,
+            longest_streak INTEGER NOT NULL DEFAULT 0,
+            current_streak INTEGER NOT NULL DEFAULT 0,
+            last_period INTEGER,
+            completion_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("INSERT INTO habit_stats_new SELECT * FROM habit_stats WHERE habit_id IN (SELECT id FROM habits)")
+    conn.execute("DROP TABLE habit_stats")
+    conn.execute("ALTER TABLE habit_stats_new RENAME TO habit_stats")
+    # The rollups are created again with their foreign keys and refilled from the completions
+    conn.execute("DROP TABLE completion_weeks")
+    conn.execute("DROP TABLE completion_months")
+    # Dropping the old tables dropped their triggers
+    create_change_counter(conn)
+    create_rollups(conn)
 
-# Add a new habit to the database
-def add_habit(name, frequency):
-    # Connect to the database
-    conn = sqlite3.connect(Database_Name)
-    # Create a cursor
-    cur = conn.cursor()
+# Create the archived_habits table that keeps the streaks and completion count of each habit's archived completions
+def create_archived_habits(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archived_habits (
+            habit_id INTEGER PRIMARY KEY REFERENCES habits (id) ON DELETE CASCADE,
+            /* Define the streaks like habit_stats, over the archived completions only */
+            longest_streak INTEGER NOT NULL,
+            current_streak INTEGER NOT NULL,
+            last_period INTEGER NOT NULL,
+            completion_count INTEGER NOT NULL
+        )
+    """)
+
+# Add the period_key column to the completions, fill it, and keep only the first completion of each habit and period
+# The unique index then refuses a second completion for a period, and triggers fill in the key for writers that leave it out
+def add_period_keys(conn):
+    conn.execute("ALTER TABLE completions ADD COLUMN period_key INTEGER")
+    conn.execute(f"UPDATE completions SET period_key = {Period_Key_SQL}")
+    # Delete the later completions of each period, the rollup triggers uncount them
+    conn.execute("""
+        DELETE FROM completions WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY habit_id, period_key ORDER BY completion_date, id) AS number FROM completions
+            ) WHERE number > 1
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX idx_completions_habit_period ON completions (habit_id, period_key)")
+    period_key = Period_Key_SQL.replace("habit_id", "NEW.habit_id").replace("completion_date", "NEW.completion_date")
+    conn.execute(f"CREATE TRIGGER period_key_insert AFTER INSERT ON completions WHEN NEW.period_key IS NULL BEGIN UPDATE completions SET period_key = {period_key} WHERE id = NEW.id; END")
+    conn.execute(f"CREATE TRIGGER period_key_update AFTER UPDATE OF habit_id, completion_date ON completions BEGIN UPDATE completions SET period_key = {period_key} WHERE id = NEW.id; END")
+    # The deleted completions no longer count towards the streaks
+    rebuild_habit_stats(conn)
 
-    # Insert the habit into the habits table
-    cur.execute("INSERT INTO habits (name, frequency, creation_date) VALUES (?, ?, ?)", (name, frequency, datetime.now()))
-    # Commit the changes
-    conn.commit()
+# Get the habits saved in a snapshot file, or None if there is no snapshot or it was taken of another database or at another change count
+def read_snapshot(path, database_id, changes):
+    try:
+        with open(path, "rb") as file:
+            header = file.read(Snapshot_Header.size)
+            if len(header) != Snapshot_Header.size or Snapshot_Header.unpack(header) != (Snapshot_Magic, database_id, changes):
+                return None
+            rows = marshal.loads(file.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    habits = []
+    for id, name, frequency, creation_date, streak_stats, days in rows:
+        completion_days = array("i")
+        completion_days.frombytes(days)
+        habits.append(HabitClass.from_completion_days(id, name, frequency, datetime.fromisoformat(creation_date), completion_days,
+                                                      analytics.StreakStats(*streak_stats) if streak_stats else None))
+    return habits
 
-    # Get the id of the habit that was just added
-    habit_id = cur.lastrowid
+# Save the habits to a snapshot file, tagged with the database id and change count they were read at
+# The snapshot is only a cache, so it is written to a temporary file first and a failure to save it is ignored
+def write_snapshot(path, database_id, changes, habits):
+    rows = [
+        (habit.id, habit.habitname, habit.habitfrequency, habit.creation_date.isoformat(),
+         (habit.streak_stats.longest, habit.streak_stats.current, habit.streak_stats.last_period, habit.streak_stats.count) if habit.streak_stats else None,
+         habit.completion_days.tobytes())
+        for habit in habits
+    ]
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, "wb") as file:
+            file.write(Snapshot_Header.pack(Snapshot_Magic, database_id, changes))
+            file.write(marshal.dumps(rows))
+        os.replace(temporary_path, path)
+    except OSError:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
 
-    # Close the connection
-    conn.close()
+# Fill the temporary selected_habits table with the given habit ids so queries can join against it
+def select_habits(conn, habit_ids):
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS selected_habits (habit_id INTEGER PRIMARY KEY)")
+    conn.execute("DELETE FROM selected_habits")
+    conn.executemany("INSERT INTO selected_habits (habit_id) VALUES (?)", ((habit_id,) for habit_id in habit_ids))
+
+# Recompute the stored streaks of the given habits, or of every habit, from their completions
+def rebuild_habit_stats(conn, habit_ids=None):
+    # Select the habits to recompute
+    if habit_ids is None:
+        conn.execute("DELETE FROM habit_stats")
+        habit_filter = ""
+    else:
+        select_habits(conn, habit_ids)
+        habit_filter = "AND h.id IN (SELECT habit_id FROM selected_habits)"
+    # Weekly habits read their weeks from the completion_weeks rollup once it exists, instead of every completion
+    rollup = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'completion_weeks'").fetchone() is not None
+    weekly_rows = f"""
+        UNION ALL
+        SELECT h.id, h.frequency, w.week, w.completions FROM habits h
+        LEFT JOIN completion_weeks w ON w.habit_id = h.id
+        WHERE h.frequency = 'weekly' {habit_filter}
+    """ if rollup else ""
+    # Get the completed periods of those habits as (habit, frequency, period, completions in the period) rows,
+    # ordered so that each habit's periods are next to each other
+    rows = conn.execute(f"""
+        SELECT h.id, h.frequency, CASE WHEN h.frequency = 'weekly' THEN {Week_Number_SQL} ELSE {Day_Number_SQL} END, 1 FROM habits h
+        LEFT JOIN completions c ON c.habit_id = h.id
+        WHERE {"h.frequency != 'weekly'" if rollup else "1"} {habit_filter}
+        {weekly_rows}
+        ORDER BY 1, 3
+    """)
+    # Get the streaks of the archived histories, the completions in the database all come after them
+    # The weekly rollup still counts the archived weeks, so weekly habits read from it start from nothing
+    archived = {}
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archived_habits'").fetchone() is not None:
+        archived = {row[0]: row[1:] for row in conn.execute("SELECT habit_id, longest_streak, current_streak, last_period, completion_count FROM archived_habits")}
+    # Compute the streaks of each habit in one pass over the periods, which are in order
+    stats_rows = []
+    for (habit_id, frequency), habit_rows in groupby(rows, key=itemgetter(0, 1)):
+        stats = analytics.StreakStats(*archived.get(habit_id, ())) if not (rollup and frequency == "weekly") else analytics.StreakStats()
+        for _, _, period, count in habit_rows:
+            if period is not None:
+                for _ in range(count):
+                    stats.add(period)
+        stats_rows.append((habit_id, stats.longest, stats.current, stats.last_period, stats.count))
+    # Store the streaks
+    conn.executemany("INSERT OR REPLACE INTO habit_stats VALUES (?, ?, ?, ?, ?)", stats_rows)
 
-    # Return a HabitClass instance with the habit information
-    return HabitClass(habit_id, name, frequency, datetime.now(), [])
+# Add a new habit to the database
+def add_habit(name, frequency):
+    return get_repository().add_habit(name, frequency)
 
 # Delete a habit from the database
 def delete_habit(habit_id):
-    # Connect to the database
-    conn = sqlite3.connect(Database_Name)
-    # Create a cursor
-    cur = conn.cursor()
-
-    # Delete the habit from the habits table and the completions table
-    cur.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
-    # Delete the habit from the completions table
-    cur.execute("DELETE FROM completions WHERE habit_id = ?", (habit_id,))
-
-    # Commit the changes
-    conn.commit()
-    # Close the connection
-    conn.close()
+    get_repository().delete_habit(habit_id)
 
 # Get all habits from the database
 def get_all_habits():
-    # Connect to the database
-    conn = sqlite3.connect(Database_Name)
-    # Create a cursor
-    cur = conn.cursor()
+    return get_repository().get_all_habits()
 
-    # Get all habits from the habits table
-    habits_data = cur.execute("SELECT * FROM habits").fetchall()
+# Yield the habits from the database one at a time, optionally only those with the given frequency
+def iter_habits(frequency=None):
+    return get_repository().iter_habits(frequency)
 
-    
-    # Create a list of HabitClass instances
-    habits = []
-    # Loop through each habit
-    for habit_data in habits_data:
-        # Get the habit id, name, frequency, and creation date
-        id, name, frequency, creation_date = habit_data
-        # Convert the creation date from a string to a datetime object
-        creation_date = datetime.fromisoformat(creation_date)
-
-        # Get all completion dates for the habit
-        completion_dates_data = cur.execute("SELECT completion_date FROM completions WHERE habit_id = ?", (id,)).fetchall()
-        # Convert the completion dates from strings to datetime objects
-        completion_dates = [datetime.fromisoformat(cd[0]) for cd in completion_dates_data]
-        # Add the habit to the list of habits
-        habits.append(HabitClass(id, name, frequency, creation_date, completion_dates))
+# Add a completion to the database, False if the habit is already completed for that period
+def add_completion(habit, completion_date=None):
+    return get_repository().add_completion(habit, completion_date)
 
-    # Close the connection
-    conn.close()
-    # Return the list of habits
-    return habits
+# Add many (habit_id, date) completions to the database in one transaction
+def add_completions(completions, batch_size=5000):
+    return get_repository().add_completions(completions, batch_size)
 
-# Add a completion to the database
-def add_completion(habit):
-    # Connect to the database
-    conn = sqlite3.connect(Database_Name)
-    # Create a cursor
-    cur = conn.cursor()
+# Recompute the stored streaks of every habit to repair them
+def rebuild_stats():
+    get_repository().rebuild_stats()
 
-    # Insert the completion into the completions table
-    cur.execute("INSERT INTO completions (habit_id, completion_date) VALUES (?, ?)", (habit.id, datetime.now().date()))
-    # Commit the changes
-    conn.commit()
+# Get the path of the completion bitmaps file that belongs to the database
+def bitmaps_path():
+    return Database_Name + ".bitmaps"
 
-    # Close the connection
-    conn.close()
+# Keep the completion bitmaps of all habits in a memory-mapped file next to the database
+def attach_bitmaps():
+    return get_repository().attach_bitmaps(bitmaps_path())
+
+# Rebuild the completion bitmaps file from the completions table
+def rebuild_bitmaps():
+    return get_repository().rebuild_bitmaps(bitmaps_path())
+
+# Move the completions that are more than the given number of days old into the archive and compact the database
+def archive_completions(days):
+    repository = get_repository()
+    moved = repository.archive_completions(date.today().toordinal() - days)
+    repository.compact()
+    return moved
 
 # Main function that handles user input and interaction with the habit tracker
-def main():
+# Unless snapshot is False, the habits are loaded from a snapshot next to the database while it is up to date
+# With use_bitmaps, the status of all habits is read from the memory-mapped completion bitmaps
+def main(lazy=False, history_size=1000, snapshot=True, use_bitmaps=False):
     # Initialize the database
     init_db()
-    # Get all habits from the database
-    habits = get_all_habits()
+    if use_bitmaps:
+        attach_bitmaps()
+    # Load all habits from the snapshot or the database into the store, without their histories in lazy mode
+    snapshot_path = Database_Name + ".snapshot" if snapshot else None
+    habits = HabitStore(lazy=lazy, max_habits=history_size, snapshot_path=snapshot_path).load()
 
 # Main loop for user interaction
     while True:
@@ -209,10 +1394,8 @@ def main():
                 print("Invalid frequency. Please enter 'daily' or 'weekly'.")
                 continue
             
-            # Add the habit to the database
-            habit = add_habit(name, frequency)
-            # Add the habit to the list of habits
-            habits.append(habit)
+            # Add the habit to the database and the store
+            habit = habits.add(name, frequency)
             # Print a success message
             print(f"Habit '{name}' added.")
         
@@ -220,8 +1403,8 @@ def main():
         elif choice == '2':
             # Get the habit id
             id = int(input("Enter habit ID: "))
-            # Get the habit from the list of habits
-            habit = next((h for h in habits if h.id == id), None)
+            # Delete the habit from the database and the store
+            habit = habits.delete(id)
 
             # Check if the habit exists
             if not habit:
@@ -229,20 +1412,18 @@ def main():
                 print("Habit not found.")
                 continue
 
-            # Delete the habit from the database
-            delete_habit(id)
-            # Remove the habit from the list of habits
-            habits.remove(habit)
             # Print a success message
             print(f"Habit '{habit.habitname}' deleted.")
         
         # Check the status of all habits
         elif choice == '3':
             print("\nHabits:")
+            # Get the habits that have been completed for the current period
+            completed = habits.completed_this_period()
             # Loop through each habit
             for habit in habits:
                 # Check if the habit has been completed for the current period
-                status = "Completed" if (habit.habitfrequency == "daily" and habit.is_completed_today()) or (habit.habitfrequency == "weekly" and habit.is_completed_this_week()) else "Not completed"
+                status = "Completed" if habit.id in completed else "Not completed"
                 # Print the habit id, name, frequency, and status
                 print(f"{habit.id}: {habit.habitname} ({habit.habitfrequency.capitalize()}) - {status}")
         
@@ -250,8 +1431,8 @@ def main():
         elif choice == '4':
             # Get the habit id
             id = int(input("Enter habit ID: "))
-            # Get the habit from the list of habits
-            habit = next((h for h in habits if h.id == id), None)
+            # Get the habit from the store
+            habit = habits.get(id)
 
             # Check if the habit exists
             if not habit:
@@ -259,10 +1440,8 @@ def main():
                 print("Habit not found.")
                 continue
             
-            # Complete the habit
-            if habit.complete():
-                # Add the completion to the database
-                add_completion(habit)
+            # Complete the habit and add the completion to the database
+            if habits.complete(habit):
                 # Print a success message
                 print(f"Habit '{habit.habitname}' completed.")
             else:
@@ -272,14 +1451,15 @@ def main():
         # Analyze habits
         elif choice == '5':
             # Print the analysis menu
-            print("\n1. List all habits\n2. List habits by frequency\n3. Get longest streak of all habits\n4. Get longest streak for a habit")
+            print("\n1. List all habits\n2. List habits by frequency\n3. Get longest streak of all habits\n4. Get longest streak for a habit"
+                  "\n5. Completion rates over the last days or weeks\n6. Top habits by current streak\n7. Top habits by completion rate")
             # Get the user's choice
             analysis_choice = input("Enter your choice: ")
 
             # List all habits
             if analysis_choice == '1':
-                # Get all habits
-                all_habits = analytics.get_all_habits(habits)
+                # Get all habits one at a time
+                all_habits = analytics.iter_all_habits(habits)
                 print("All habits:")
                 # Loop through each habit
                 for habit in all_habits:
@@ -288,9 +1468,9 @@ def main():
             
             # List habits by frequency
             elif analysis_choice == '2':
-                # Get daily and weekly habits
-                daily_habits = analytics.get_habits_by_frequency(habits, "daily")
-                weekly_habits = analytics.get_habits_by_frequency(habits, "weekly")
+                # Get daily and weekly habits from the frequency index
+                daily_habits = habits.by_frequency("daily")
+                weekly_habits = habits.by_frequency("weekly")
                 # Print the daily and weekly habits
                 print("Daily habits:")
                 # Loop through each daily habit
@@ -307,7 +1487,9 @@ def main():
             # Get longest streak of all habits
             elif analysis_choice == '3':
                 # Get the longest streak
-                longest_streak_habit, longest_streak = analytics.get_longest_streak(habits)
+                # In lazy mode stream the habits from the database one at a time instead of filling the history cache
+                source = iter_habits if habits.history is not None else lambda: habits
+                longest_streak_habit, longest_streak = habits.cached("longest_streak", lambda: analytics.get_longest_streak(source()))
                 # Print the longest streak based on frequency (daily or weekly)
                 if longest_streak_habit.habitfrequency == "daily":
                     print(f"Longest streak of all habits: '{longest_streak_habit.habitname}' (daily, {longest_streak} days)")
@@ -318,8 +1500,8 @@ def main():
             elif analysis_choice == '4':
                 # Get the habit id
                 id = int(input("Enter habit ID: "))
-                # Get the habit from the list of habits
-                habit = next((h for h in habits if h.id == id), None)
+                # Get the habit from the store
+                habit = habits.get(id)
 
                 # Check if the habit exists
                 if not habit:
@@ -333,6 +1515,34 @@ def main():
                     print(f"Longest streak for habit '{habit.habitname}': {longest_streak} days")
                 else:
                     print(f"Longest streak for habit '{habit.habitname}': {longest_streak} weeks")
+
+            # Get the completion rate of every habit over its last days (daily habits) or weeks (weekly habits)
+            elif analysis_choice == '5':
+                periods = int(input("Enter the number of days or weeks: "))
+                if periods < 1:
+                    print("The number of days or weeks must be at least 1.")
+                    continue
+                for habit, rate in zip(habits, analytics.get_completion_rates(habits, periods)):
+                    unit = "days" if habit.habitfrequency == "daily" else "weeks"
+                    print(f"{habit.id}: {habit.habitname} - {rate:.0%} of the last {periods} {unit}")
+
+            # Get the habits with the longest current streaks
+            elif analysis_choice == '6':
+                k = int(input("Enter the number of habits: "))
+                for habit, streak in analytics.get_top_habits_by_streak(habits, k, current=True):
+                    unit = "days" if habit.habitfrequency == "daily" else "weeks"
+                    print(f"{habit.id}: {habit.habitname} - {streak} {unit}")
+
+            # Get the habits with the highest completion rates over their last days or weeks
+            elif analysis_choice == '7':
+                k = int(input("Enter the number of habits: "))
+                periods = int(input("Enter the number of days or weeks: "))
+                if periods < 1:
+                    print("The number of days or weeks must be at least 1.")
+                    continue
+                for habit, rate in analytics.get_top_habits_by_rate(habits, k, periods):
+                    unit = "days" if habit.habitfrequency == "daily" else "weeks"
+                    print(f"{habit.id}: {habit.habitname} - {rate:.0%} of the last {periods} {unit}")
             else:
                 # Print an error message if the user enters an invalid choice
                 print("Invalid choice. Please try again.")
@@ -347,6 +1557,160 @@ def main():
             # Print an error message if the user enters an invalid choice
             print("Invalid choice. Please try again.")
 
+# Define a function that converts a habit to a dictionary that can be printed as JSON
+def habit_to_json(habit, completed=None):
+    result = {"id": habit.id, "name": habit.habitname, "frequency": habit.habitfrequency}
+    if completed is not None:
+        result["completed"] = completed
+    return result
+
+# Define an argument parser that raises ValueError instead of exiting, so a bad line of a batch can be reported
+class CommandParser(argparse.ArgumentParser):
+    def error(self, message):
+        raise ValueError(message)
+
+# Add the commands that can be run from the command line and in a batch
+def add_command_parsers(subparsers):
+    add = subparsers.add_parser("add", help="create a habit")
+    add.add_argument("name")
+    add.add_argument("frequency", choices=["daily", "weekly"])
+    delete = subparsers.add_parser("delete", help="delete a habit and its completions")
+    delete.add_argument("id", type=int)
+    complete = subparsers.add_parser("complete", help="complete a habit for today or this week")
+    complete.add_argument("id", type=int)
+    subparsers.add_parser("status", help="show whether each habit is completed for the current period")
+    streak = subparsers.add_parser("streak", help="show the longest streak of all habits, or the streaks of one habit")
+    streak.add_argument("id", type=int, nargs="?")
+
+# Run one command on the habits in a store and return its result as a value that can be printed as JSON
+# Raises ValueError if the command cannot be carried out
+def run_command(store, args):
+    # Create a habit
+    if args.command == "add":
+        if not (3 <= len(args.name) <= 20):
+            raise ValueError("habit name must be between 3 and 20 characters")
+        return habit_to_json(store.add(args.name, args.frequency))
+    # Delete a habit
+    if args.command == "delete":
+        habit = store.delete(args.id)
+        if habit is None:
+            raise ValueError(f"habit {args.id} not found")
+        return habit_to_json(habit)
+    # Complete a habit, completed is False if it was already completed for this period
+    if args.command == "complete":
+        habit = store.get(args.id)
+        if habit is None:
+            raise ValueError(f"habit {args.id} not found")
+        return habit_to_json(habit, store.complete(habit))
+    # Get the status of every habit
+    if args.command == "status":
+        completed = store.completed_this_period()
+        return [habit_to_json(habit, habit.id in completed) for habit in store]
+    # Get the longest and current streak of one habit
+    if args.id is not None:
+        habit = store.get(args.id)
+        if habit is None:
+            raise ValueError(f"habit {args.id} not found")
+        return {"habit": habit_to_json(habit), "longest": analytics.get_longest_streak_for_habit(habit),
+                "current": analytics.get_current_streak_for_habit(habit)}
+    # Get the habit with the longest streak
+    habit, streak = analytics.get_longest_streak(store)
+    return {"habit": habit_to_json(habit) if habit else None, "streak": streak}
+
+# Run a stream of commands, one per line with the same arguments as on the command line, in a single transaction
+# Empty lines and lines starting with # are skipped. If any command fails nothing is saved, and the ValueError names its line
+def run_batch(store, lines):
+    parser = CommandParser(prog="batch")
+    add_command_parsers(parser.add_subparsers(dest="command", required=True))
+    results = []
+    with store.repository.transaction():
+        for number, line in enumerate(lines, start=1):
+            try:
+                words = shlex.split(line, comments=True)
+                if words:
+                    results.append(run_command(store, parser.parse_args(words)))
+            except ValueError as error:
+                raise ValueError(f"line {number}: {error}") from None
+    return results
+
+# Run the interactive menu, or a maintenance command if one is given on the command line
+def run(argv=None):
+    # Define the command line arguments
+    parser = argparse.ArgumentParser(description="Simple command-line habit tracker")
+    parser.add_argument("--lazy", action="store_true", help="load each habit's history only when it is needed")
+    parser.add_argument("--history-cache", type=int, default=1000, metavar="HABITS", help="number of habit histories kept in memory in lazy mode")
+    parser.add_argument("--no-snapshot", action="store_true", help="always load the habits from the database instead of the snapshot file next to it")
+    parser.add_argument("--bitmaps", action="store_true", help="keep the completed days of all habits in a memory-mapped bitmap file next to the database and read the status from it")
+    parser.add_argument("--profile", metavar="PATH", help="profile the session with cProfile and save the report to PATH")
+    parser.add_argument("--metrics", metavar="PATH", help="record call counts, latencies and rows touched and save them to PATH when the session ends (Prometheus text format for .prom files, JSON otherwise)")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("rebuild-stats", help="recompute the stored streaks of every habit from its completions")
+    subparsers.add_parser("rebuild-bitmaps", help="rebuild the completion bitmaps file from the completions")
+    archive_parser = subparsers.add_parser("archive", help="move old completions into compressed yearly files next to the database and compact it")
+    archive_parser.add_argument("--days", type=int, default=730, help="keep the completions of the last DAYS days in the database (default: 730)")
+    # Add the scripting commands, which print their results as JSON
+    add_command_parsers(subparsers)
+    batch = subparsers.add_parser("batch", help="run commands from a file, one per line, in a single transaction and print one JSON result per line")
+    batch.add_argument("file", nargs="?", default="-", help="file with the commands, standard input by default")
+    args = parser.parse_args(argv)
+
+    # Switch on the instrumentation, imported only when asked for so it costs nothing otherwise
+    if args.metrics:
+        import metrics
+        metrics.enable(sys.modules[__name__])
+    # Profile the whole session
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        # Repair the stored streaks
+        if args.command == "rebuild-stats":
+            init_db()
+            rebuild_stats()
+            print("Streaks rebuilt.")
+        # Rebuild the completion bitmaps
+        elif args.command == "rebuild-bitmaps":
+            init_db()
+            rebuild_bitmaps()
+            print("Bitmaps rebuilt.")
+        # Archive the old completions
+        elif args.command == "archive":
+            init_db()
+            print(f"Archived {archive_completions(args.days)} completions.")
+        # Run a scripted command or a batch of them, printing JSON
+        # Only the habit details are loaded, the few histories the commands need are read when they are needed
+        elif args.command in ("add", "delete", "complete", "status", "streak", "batch"):
+            init_db()
+            store = HabitStore(lazy=True).load()
+            try:
+                if args.command == "batch":
+                    if args.file == "-":
+                        results = run_batch(store, sys.stdin)
+                    else:
+                        with open(args.file) as file:
+                            results = run_batch(store, file)
+                    for result in results:
+                        print(json.dumps(result))
+                else:
+                    print(json.dumps(run_command(store, args)))
+            except ValueError as error:
+                print(json.dumps({"error": str(error)}))
+                sys.exit(1)
+        # Start the interactive menu
+        else:
+            main(args.lazy, args.history_cache, not args.no_snapshot, args.bitmaps)
+    finally:
+        # Save the profile report, sorted by the time spent in each function and the functions it calls
+        if args.profile:
+            import pstats
+            profiler.disable()
+            with open(args.profile, "w") as file:
+                pstats.Stats(profiler, stream=file).sort_stats("cumulative").print_stats()
+        if args.metrics:
+            metrics.write(args.metrics)
+            metrics.disable()
+
 # Run the main function
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run()
\ No newline at end of file
@@ -0,0 +1,57 @@
+# Description: Streaming importer that backfills habit completions from CSV or JSON Lines files
+# Each record holds a habit_id and a completion_date (YYYY-MM-DD). The files are read line by line and the
+# completions are written with habit_app.add_completions, which applies the one-per-day / one-per-week rule.
+
+# Import the csv and json modules to parse the input files
+# Import the sys module to read the command line arguments
+# Import the habit_app module to write the completions to the database
+import csv
+import json
+import sys
+import habit_app
+
+# Read (habit_id, completion_date) pairs from a CSV file with a habit_id,completion_date header
+def read_csv(path):
+    with open(path, newline="") as file:
+        # Loop through the rows one at a time, the line number is kept for error messages
+        for line_number, row in enumerate(csv.DictReader(file), start=2):
+            try:
+                yield int(row["habit_id"]), habit_app.to_date(row["completion_date"])
+            except (KeyError, TypeError, ValueError) as error:
+                raise ValueError(f"{path}:{line_number}: invalid completion row {row!r}") from error
+
+# Read (habit_id, completion_date) pairs from a JSON Lines file with one object per line
+def read_jsonl(path):
+    with open(path) as file:
+        # Loop through the lines one at a time, skipping blank lines
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                yield int(record["habit_id"]), habit_app.to_date(record["completion_date"])
+            except (KeyError, TypeError, ValueError) as error:
+                raise ValueError(f"{path}:{line_number}: invalid completion record {line.strip()!r}") from error
+
+# Read the completions from a file, choosing the format from the file extension
+def read_completions(path):
+    if path.endswith(".jsonl") or path.endswith(".ndjson"):
+        return read_jsonl(path)
+    return read_csv(path)
+
+# Import the completions from a file into the database and return how many were added
+def import_file(path, batch_size=5000):
+    return habit_app.add_completions(read_completions(path), batch_size)
+
+# Import every file given on the command line
+def main(paths):
+    # Initialize the database
+    habit_app.init_db()
+    for path in paths:
+        # Import the file and print how many completions were added
+        added = import_file(path)
+        print(f"{path}: {added} completions imported.")
+
+# Run the main function
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,251 @@
+# Description: Opt-in instrumentation for the Habit Tracker app
+# enable() wraps the database entry points of habit_app and every analytics function with timers that record call
+# counts, latency histograms, rows touched and SQL statements run. disable() puts the original functions back, so the
+# app runs exactly as before and instrumentation costs nothing while it is off.
+# The collected metrics can be exported as a JSON snapshot or in the Prometheus text format.
+
+# Import the functools module to keep the names of wrapped functions
+# Import the inspect module to find the analytics functions and recognize generators
+# Import the json module to write snapshots
+# Import the sqlite3 module to recognize a database without the change counter
+# Import the time module to measure latency
+# Import the habit_app and analytics modules to instrument them
+
+import functools
+import inspect
+import json
+import sqlite3
+import time
+import habit_app
+import analytics
+
+
+# Define the upper bounds of the latency histogram buckets in seconds, the last bucket counts everything
+Buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Define the repository methods behind the database entry points, the module-level functions call these
+# so wrapping the methods also covers HabitStore and the services built on the repository
+Repository_Methods = ("init_db", "add_habit", "delete_habit", "get_all_habits", "iter_habits",
+                      "add_completion", "add_completions", "rebuild_stats", "archive_completions")
+
+# Define the metrics of one operation
+class OperationMetrics:
+    __slots__ = ("calls", "errors", "seconds", "rows", "statements", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.statements = 0
+        self.buckets = [0] * len(Buckets)
+
+    # Record one call that took the given number of seconds
+    def observe(self, seconds, rows, statements, failed):
+        self.calls += 1
+        self.errors += failed
+        self.seconds += seconds
+        self.rows += rows
+        self.statements += statements
+        # Count the call in the first bucket it fits in, to_dict() makes the counts cumulative
+        for index, bound in enumerate(Buckets):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+
+    def to_dict(self):
+        cumulative, total = {}, 0
+        for bound, count in zip(Buckets, self.buckets):
+            total += count
+            cumulative["+Inf" if bound == float("inf") else str(bound)] = total
+        return {"calls": self.calls, "errors": self.errors, "seconds": self.seconds, "rows": self.rows,
+                "statements": self.statements, "buckets": cumulative}
+
+# Define the metrics collected so far, keyed by operation name such as "habit_app.add_habit"
+_operations = {}
+
+# Define the original functions replaced by enable(), as (owner, attribute, original) so disable() can restore them
+_originals = []
+
+# Define the habit_app module that was instrumented, habit_app.py run as a script is the __main__ module instead
+_app = habit_app
+
+# Define the number of SQL statements run on the connections being traced
+_statement_count = 0
+
+# Count every SQL statement sqlite3 runs on a traced connection
+def _count_statement(statement):
+    global _statement_count
+    _statement_count += 1
+
+# Return the number of rows changed in the database so far, without the updates of the change counter
+# The triggers behind the change counter update it once for every row changed in the counted tables, and sqlite3
+# counts those updates in total_changes as well
+def _changed_rows(repository):
+    conn = repository.conn
+    with repository.lock:
+        # Read the counter with tracing off so the query is not counted as one of the operation's statements
+        conn.set_trace_callback(None)
+        try:
+            counter = conn.execute("SELECT value FROM meta WHERE key = 'changes'").fetchone()[0]
+        except (sqlite3.OperationalError, TypeError):
+            # The database has not been migrated to the change counter yet
+            counter = 0
+        finally:
+            conn.set_trace_callback(_count_statement)
+        return conn.total_changes - counter
+
+# Return the number of rows an operation touched: the rows it changed in the database plus the rows it returned
+def _rows_of(result, changes):
+    if isinstance(result, (list, tuple)):
+        return changes + len(result)
+    return changes
+
+# Return the metrics of an operation, creating them on first use
+def _metrics(name):
+    metrics = _operations.get(name)
+    if metrics is None:
+        metrics = _operations[name] = OperationMetrics()
+    return metrics
+
+# Wrap a repository method so each call is timed and its rows and SQL statements are counted
+def _wrap_method(name, method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        changes = _changed_rows(self)
+        statements, failed = _statement_count, True
+        start = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            rows = 0 if failed else _rows_of(result, _changed_rows(self) - changes)
+            _metrics(name).observe(seconds, rows, _statement_count - statements, failed)
+
+    # Generators do their work while they are iterated, so time the whole iteration and count the rows yielded
+    @functools.wraps(method)
+    def generator_wrapper(self, *args, **kwargs):
+        start, rows, failed = time.perf_counter(), 0, True
+        try:
+            for item in method(self, *args, **kwargs):
+                rows += 1
+                yield item
+            failed = False
+        finally:
+            _metrics(name).observe(time.perf_counter() - start, rows, 0, failed)
+
+    return generator_wrapper if inspect.isgeneratorfunction(method) else wrapper
+
+# Wrap an analytics function so each call is timed, the rows it returns are the habits or values it produced
+def _wrap_function(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start, failed = time.perf_counter(), True
+        try:
+            result = function(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            rows = 0 if failed else _rows_of(result, 0)
+            _metrics(name).observe(time.perf_counter() - start, rows, 0, failed)
+
+    @functools.wraps(function)
+    def generator_wrapper(*args, **kwargs):
+        start, rows, failed = time.perf_counter(), 0, True
+        try:
+            for item in function(*args, **kwargs):
+                rows += 1
+                yield item
+            failed = False
+        finally:
+            _metrics(name).observe(time.perf_counter() - start, rows, 0, failed)
+
+    return generator_wrapper if inspect.isgeneratorfunction(function) else wrapper
+
+# Check whether instrumentation is switched on
+def is_enabled():
+    return bool(_originals)
+
+# Switch instrumentation on by replacing the entry points with timed wrappers
+# app is the habit_app module to instrument, pass sys.modules["__main__"] when habit_app.py runs as a script
+def enable(app=habit_app):
+    global _app
+    if _originals:
+        return
+    _app = app
+    for method_name in Repository_Methods:
+        method = getattr(app.HabitRepository, method_name)
+        _originals.append((app.HabitRepository, method_name, method))
+        setattr(app.HabitRepository, method_name, _wrap_method(f"habit_app.{method_name}", method))
+    # Every function defined in analytics, the helpers too, since the streak functions spend their time in them
+    for function_name, function in inspect.getmembers(analytics, inspect.isfunction):
+        if function.__module__ == analytics.__name__:
+            _originals.append((analytics, function_name, function))
+            setattr(analytics, function_name, _wrap_function(f"analytics.{function_name}", function))
+
+# Switch instrumentation off by putting the original functions back, the metrics collected so far are kept
+def disable():
+    while _originals:
+        owner, attribute, original = _originals.pop()
+        setattr(owner, attribute, original)
+    # Stop tracing the shared connection
+    if _app._repository is not None:
+        _app._repository.conn.set_trace_callback(None)
+
+# Forget all the metrics collected so far
+def reset():
+    global _statement_count
+    _operations.clear()
+    _statement_count = 0
+
+# Return the metrics collected so far as a dictionary that can be saved as JSON
+def snapshot():
+    return {
+        "timestamp": time.time(),
+        "statements": _statement_count,
+        "operations": {name: metrics.to_dict() for name, metrics in sorted(_operations.items())},
+    }
+
+# Save a JSON snapshot of the metrics to a file
+def write_json(path):
+    with open(path, "w") as file:
+        json.dump(snapshot(), file, indent=2)
+
+# Return the metrics in the Prometheus text exposition format
+def prometheus_text():
+    lines = [
+        "# HELP habit_tracker_operation_duration_seconds Time spent in each operation.",
+        "# TYPE habit_tracker_operation_duration_seconds histogram",
+    ]
+    operations = sorted(_operations.items())
+    for name, metrics in operations:
+        for bound, count in metrics.to_dict()["buckets"].items():
+            lines.append(f'habit_tracker_operation_duration_seconds_bucket{{operation="{name}",le="{bound}"}} {count}')
+        lines.append(f'habit_tracker_operation_duration_seconds_sum{{operation="{name}"}} {metrics.seconds}')
+        lines.append(f'habit_tracker_operation_duration_seconds_count{{operation="{name}"}} {metrics.calls}')
+    # The counters that are kept next to the histogram
+    counters = [
+        ("habit_tracker_operation_errors_total", "Calls that raised an exception.", "errors"),
+        ("habit_tracker_operation_rows_total", "Rows changed or returned by each operation.", "rows"),
+        ("habit_tracker_operation_statements_total", "SQL statements run by each operation.", "statements"),
+    ]
+    for metric, description, attribute in counters:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} counter")
+        for name, metrics in operations:
+            lines.append(f'{metric}{{operation="{name}"}} {getattr(metrics, attribute)}')
+    return "\n".join(lines) + "\n"
+
+# Save the metrics in the Prometheus text format, for example for the node exporter's textfile collector
+def write_prometheus(path):
+    with open(path, "w") as file:
+        file.write(prometheus_text())
+
+# Save the metrics to a file, in the Prometheus text format if the file name ends in .prom and as JSON otherwise
+def write(path):
+    if path.endswith(".prom"):
+        write_prometheus(path)
+    else:
+        write_json(path)
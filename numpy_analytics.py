@@ -0,0 +1,135 @@
+# Description: Vectorized analytics for the Habit Tracker app, backed by NumPy when it is installed
+# Each habit's completions are a sorted int32 array of periods (day numbers for daily habits, week numbers for weekly
+# habits, see analytics.period_key), and streaks are found from the differences between neighbouring periods.
+# Many habits are handled at once by concatenating their arrays into one flat array with an offsets array, where
+# habit i owns values[offsets[i]:offsets[i + 1]]. Without NumPy the same functions fall back to plain Python.
+
+# Import the array module to hold the periods compactly when NumPy is not installed
+# Import the datetime module to work with dates
+# Import the analytics module for the period numbers and the pure-Python streaks
+from array import array
+from datetime import date
+import analytics
+
+# Use NumPy if it is installed
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Define a function that returns the sorted periods of a habit's completions as an int32 array
+def habit_periods(habit):
+    # The completion days of a habit are already a sorted int32 array of day numbers
+    if np is None:
+        return array("i", (analytics.period_of_day(habit.habitfrequency, day) for day in habit.completion_days))
+    days = np.frombuffer(habit.completion_days, dtype=np.int32)
+    if habit.habitfrequency == "weekly":
+        return (days - 1) // 7
+    return days
+
+# Define a function that packs the periods of many habits into one flat values array and an offsets array
+def pack_habits(habits):
+    arrays = [habit_periods(habit) for habit in habits]
+    lengths = [len(periods) for periods in arrays]
+    if np is None:
+        values = array("i")
+        offsets = array("q", [0])
+        for periods, length in zip(arrays, lengths):
+            values.extend(periods)
+            offsets.append(offsets[-1] + length)
+        return values, offsets
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int32)
+    return values.astype(np.int32, copy=False), offsets
+
+# Define a function that returns the longest streak and the streak ending at the last completion of every packed habit
+# A run continues while each period is exactly one after the previous one, so a repeated period starts a new run like in analytics
+def batch_streaks(values, offsets):
+    if np is None:
+        stats = [analytics.StreakStats.from_periods(values[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1)]
+        return [s.longest for s in stats], [s.current for s in stats]
+
+    values = np.asarray(values, dtype=np.int32)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    habit_count = len(offsets) - 1
+    longest = np.zeros(habit_count, dtype=np.int64)
+    trailing = np.zeros(habit_count, dtype=np.int64)
+    if len(values) == 0:
+        return longest, trailing
+    # Mark where a run starts: at the first value of every habit and wherever the period does not follow the previous one
+    starts = np.ones(len(values), dtype=bool)
+    starts[1:] = np.diff(values) != 1
+    starts[offsets[:-1][offsets[:-1] < len(values)]] = True
+    # Number the runs and count the length of each one
+    run_ids = np.cumsum(starts) - 1
+    run_lengths = np.bincount(run_ids)
+    # Find the habit each run belongs to and keep the longest run of each habit
+    run_starts = np.flatnonzero(starts)
+    run_habits = np.searchsorted(offsets, run_starts, side="right") - 1
+    np.maximum.at(longest, run_habits, run_lengths)
+    # The trailing streak is the length of the run holding the last value of each habit that has completions
+    non_empty = offsets[1:] > offsets[:-1]
+    trailing[non_empty] = run_lengths[run_ids[offsets[1:][non_empty] - 1]]
+    return longest, trailing
+
+# Define a function that returns the number of distinct periods of every packed habit that fall between two periods, inclusive
+def batch_period_counts(values, offsets, first_period, last_period):
+    if np is None:
+        return [len({p for p in values[offsets[i]:offsets[i + 1]] if first_period <= p <= last_period}) for i in range(len(offsets) - 1)]
+
+    values = np.asarray(values, dtype=np.int32)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    # Drop repeated periods, keeping the first value of every habit
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:] = np.diff(values) != 0
+    keep[offsets[:-1][offsets[:-1] < len(values)]] = True
+    habit_ids = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+    # Count the kept periods inside the window for each habit
+    in_window = keep & (values >= first_period) & (values <= last_period)
+    return np.bincount(habit_ids[in_window], minlength=len(offsets) - 1)
+
+# Define a function that returns the longest streak for a habit
+def get_longest_streak_for_habit(habit):
+    longest, _ = batch_streaks(*pack_habits([habit]))
+    return int(longest[0])
+
+# Define a function that returns the habit with the longest streak and its streak, ties go to the first habit like analytics.get_longest_streak
+def get_longest_streak(habits):
+    habits = list(habits)
+    if not habits:
+        return None, 0
+    longest, _ = batch_streaks(*pack_habits(habits))
+    index = int(np.argmax(longest)) if np is not None else max(range(len(habits)), key=lambda i: (longest[i], -i))
+    if longest[index] == 0:
+        return None, 0
+    return habits[index], int(longest[index])
+
+# Define a function that returns the current streak for a habit, which is 0 if the last completed period is not this one or the one before
+def get_current_streak_for_habit(habit, today=None):
+    periods = habit_periods(habit)
+    if len(periods) == 0:
+        return 0
+    _, trailing = batch_streaks(periods, [0, len(periods)])
+    current_period = analytics.period_key(habit.habitfrequency, today or date.today())
+    return int(trailing[0]) if periods[-1] >= current_period - 1 else 0
+
+# Define a function that returns the number of completions of every habit
+def get_completion_counts(habits):
+    _, offsets = pack_habits(habits)
+    return [int(offsets[i + 1] - offsets[i]) for i in range(len(offsets) - 1)]
+
+# Define a function that returns the share of the last periods (days or weeks, up to and including today) in which each habit was completed
+def get_completion_rates(habits, periods, today=None):
+    today = today or date.today()
+    rates = []
+    # Daily and weekly habits count different periods, so each frequency is handled as its own batch
+    for frequency in ("daily", "weekly"):
+        group = [(i, habit) for i, habit in enumerate(habits) if habit.habitfrequency == frequency]
+        if not group:
+            continue
+        last_period = analytics.period_key(frequency, today)
+        counts = batch_period_counts(*pack_habits(habit for _, habit in group), last_period - periods + 1, last_period)
+        rates.extend((i, int(count) / periods) for (i, _), count in zip(group, counts))
+    # Return the rates in the order of the habits
+    return [rate for _, rate in sorted(rates)]
@@ -0,0 +1,88 @@
+# Description: Parallel streak analytics for the Habit Tracker app
+# Habits whose streaks have to be computed from their whole history are split into chunks that worker processes
+# work through at the same time. Each chunk only carries each habit's frequency and its completion days as the raw
+# bytes of an int32 array, so nothing but flat bytes is pickled. The workers send back the streaks of every habit in
+# their chunk and the chunk's longest streak, and the chunk results are merged in habit order.
+
+# Import the os module to count the CPU cores
+# Import the array module to rebuild the completion days in the workers
+# Import the ProcessPoolExecutor class to run the chunks on several cores
+# Import the analytics module for the streaks
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import analytics
+
+# Define the number of completions that have to be walked before starting worker processes pays off
+Parallel_Min_Completions = 500000
+
+# Define how many chunks each worker gets, more chunks than workers evens out chunks of different sizes
+Chunks_Per_Worker = 4
+
+# Define a function that returns True if a habit's streaks have to be computed from its history
+def needs_streaks(habit):
+    days = habit._loaded_days()
+    return habit.streak_stats is None or (days is not None and habit.streak_stats.count != len(days))
+
+# Define a function that returns True if computing the streaks of the habits is worth spreading over worker processes
+def should_run_in_parallel(habits, workers=None):
+    if (workers or os.cpu_count() or 1) < 2:
+        return False
+    # Only the histories that have to be walked count, the other habits already know their streaks
+    return sum(len(habit.completion_days) for habit in habits if needs_streaks(habit)) >= Parallel_Min_Completions
+
+# Define a function that computes the streaks of one chunk of habits, run in a worker process
+# The chunk is a list of (index, weekly, completion days as bytes); the result is the chunk's longest streak as
+# (index, streak), with ties going to the lowest index, and the streaks of every habit as (index, stats) pairs
+def chunk_streaks(chunk):
+    best = (None, 0)
+    streaks = []
+    for index, weekly, data in chunk:
+        days = array("i")
+        days.frombytes(data)
+        stats = analytics.StreakStats.from_periods((day - 1) // 7 for day in days) if weekly else analytics.StreakStats.from_periods(days)
+        streaks.append((index, (stats.longest, stats.current, stats.last_period, stats.count)))
+        if stats.longest > best[1]:
+            best = (index, stats.longest)
+    return best, streaks
+
+# Define a function that splits the habits that need their streaks computed into chunks of about the same number of completions
+def make_chunks(habits, chunk_count):
+    items = [(index, habit.habitfrequency == "weekly", habit.completion_days.tobytes())
+             for index, habit in enumerate(habits) if needs_streaks(habit)]
+    target = sum(len(data) for _, _, data in items) / max(chunk_count, 1)
+    chunks, chunk, size = [], [], 0
+    for item in items:
+        chunk.append(item)
+        size += len(item[2])
+        if size >= target:
+            chunks.append(chunk)
+            chunk, size = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+# Define a function that returns the habit with the longest streak and its streak, computing missing streaks on several cores
+# The answer is the same as analytics.get_longest_streak: the first habit with the longest streak, or (None, 0) without completions
+def get_longest_streak(habits, workers=None):
+    habits = list(habits)
+    workers = workers or os.cpu_count() or 1
+    chunks = make_chunks(habits, workers * Chunks_Per_Worker)
+    results = []
+    if chunks:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            results = list(executor.map(chunk_streaks, chunks))
+    # Keep the computed streaks on the habits, like HabitClass.get_streaks() does
+    computed = set()
+    for _, streaks in results:
+        for index, stats in streaks:
+            habits[index].streak_stats = analytics.StreakStats(*stats)
+            computed.add(index)
+    # Merge the longest streak of each chunk with the stored streaks of the other habits
+    # The first habit with the longest streak wins, so the answer does not depend on how the habits were chunked
+    candidates = [best for best, _ in results if best[0] is not None]
+    candidates.extend((index, habit.streak_stats.longest) for index, habit in enumerate(habits) if index not in computed)
+    index, streak = min(candidates, key=lambda candidate: (-candidate[1], candidate[0]), default=(None, 0))
+    if streak == 0:
+        return None, 0
+    return habits[index], streak
@@ -0,0 +1,236 @@
+# Description: Asyncio service that lets many local clients use the habit tracker at the same time
+# Clients connect over localhost TCP or a Unix socket and send one JSON request per line, for example:
+#   {"op": "create", "name": "Read", "frequency": "daily"}
+#   {"op": "complete", "id": 1}
+#   {"op": "status"}
+#   {"op": "analytics", "kind": "longest_streak"}
+# and get one JSON response per line: {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+# Reads are answered straight from the habits held in memory. Writes are queued for a single writer task, which
+# collects the writes that arrive within a few milliseconds and commits them together in one transaction (group commit).
+
+# Import the argparse module to read command line arguments
+# Import the asyncio module to serve many clients at once
+# Import the json module to encode requests and responses
+# Import the datetime module to work with dates
+# Import the habit_app and analytics modules to work with habits
+import argparse
+import asyncio
+import json
+from datetime import date
+import analytics
+import habit_app
+
+# Define the function that converts a habit to a dictionary that can be sent as JSON, shared with the command line
+habit_to_json = habit_app.habit_to_json
+
+# Define the error raised for requests that cannot be carried out, its message is sent back to the client
+class RequestError(Exception):
+    pass
+
+# Serve habit requests from the habits held in a HabitStore
+class HabitService:
+    # Initialize the service with a store that holds every habit in memory, how long the writer waits to collect
+    # more writes before committing, and the largest number of writes committed together
+    def __init__(self, store, commit_interval=0.002, max_batch=1000):
+        self.store = store
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        # Queue the writes as (request, future) pairs for the writer task
+        self.queue = asyncio.Queue()
+        # Count the transactions and writes committed by the writer
+        self.commits = 0
+        self.writes = 0
+        self.writer_task = None
+
+    # Start the writer task
+    def start(self):
+        self.writer_task = asyncio.get_running_loop().create_task(self.writer())
+
+    # Stop the writer task
+    async def stop(self):
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            try:
+                await self.writer_task
+            except asyncio.CancelledError:
+                pass
+
+    # Handle one request and return its result
+    async def handle(self, request):
+        op = request.get("op")
+        # Queue writes for the writer task and wait until they are committed
+        if op in ("create", "delete", "complete"):
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((request, future))
+            return await future
+        # Answer reads from memory
+        if op == "status":
+            # Reuse the status until the habits change or the day changes
+            return self.store.cached(("status", date.today()), self.status)
+        if op == "analytics":
+            return self.analytics(request)
+        raise RequestError(f"unknown op {op!r}")
+
+    # Get every habit with whether it is completed for the current period
+    def status(self):
+        completed = self.store.completed_this_period()
+        return [habit_to_json(habit, habit.id in completed) for habit in self.store]
+
+    # Answer an analytics request from memory
+    def analytics(self, request):
+        kind = request.get("kind")
+        if kind == "all":
+            return [habit_to_json(habit) for habit in analytics.iter_all_habits(self.store)]
+        if kind == "by_frequency":
+            return [habit_to_json(habit) for habit in self.store.by_frequency(request.get("frequency"))]
+        if kind == "longest_streak":
+            habit, streak = self.store.cached("longest_streak", lambda: analytics.get_longest_streak(self.store))
+            return {"habit": habit_to_json(habit) if habit else None, "streak": streak}
+        if kind == "habit_streak":
+            habit = self.get_habit(request)
+            return {"habit": habit_to_json(habit), "streak": analytics.get_longest_streak_for_habit(habit)}
+        raise RequestError(f"unknown analytics kind {kind!r}")
+
+    # Get the habit a request refers to
+    def get_habit(self, request):
+        habit = self.store.get(request.get("id"))
+        if habit is None:
+            raise RequestError("habit not found")
+        return habit
+
+    # Collect the writes that arrive within the commit interval and commit them together, for as long as the service runs
+    async def writer(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Give other clients a moment to queue their writes, then take everything that is waiting
+            await asyncio.sleep(self.commit_interval)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self.commit(batch)
+
+    # Commit a batch of writes in one transaction, then update the habits in memory and answer the clients
+    async def commit(self, batch):
+        # Check each write against the habits in memory and prepare its database action and its update in memory
+        planned = []
+        completing, deleted = set(), set()
+        for request, future in batch:
+            try:
+                planned.append((self.plan(request, completing, deleted), future))
+            except Exception as error:
+                future.set_exception(error)
+        if not planned:
+            return
+        # Run all database actions in one transaction in a worker thread, so reads keep being served meanwhile
+        try:
+            outcomes = await asyncio.to_thread(self.write, [plan[0] for plan, _ in planned])
+        except Exception as error:
+            for _, future in planned:
+                future.set_exception(error)
+            return
+        self.commits += 1
+        self.writes += len(planned)
+        # Update the habits in memory and answer each client, a failed write or update only fails its own request
+        for ((_, apply), future), (failure, result) in zip(planned, outcomes):
+            try:
+                if failure is not None:
+                    raise failure
+                future.set_result(apply(result))
+            except Exception as error:
+                future.set_exception(error)
+
+    # Run the database actions of a batch in one transaction and return (error, result) for each of them
+    # Each action runs under its own savepoint, so a failing action is rolled back without the others
+    def write(self, actions):
+        repository = self.store.repository
+        outcomes = []
+        with repository.transaction():
+            for action in actions:
+                try:
+                    with repository.savepoint():
+                        outcomes.append((None, action()))
+                except Exception as error:
+                    outcomes.append((error, None))
+        return outcomes
+
+    # Check a write and return its database action and the function that applies it in memory and returns the result
+    # completing and deleted hold the ids of the habits completed and deleted by earlier writes of the same batch
+    def plan(self, request, completing, deleted):
+        op = request["op"]
+        repository = self.store.repository
+        if op == "create":
+            name, frequency = request.get("name") or "", request.get("frequency")
+            if not isinstance(name, str) or not (3 <= len(name) <= 20):
+                raise RequestError("habit name must be between 3 and 20 characters")
+            if frequency not in ("daily", "weekly"):
+                raise RequestError("frequency must be 'daily' or 'weekly'")
+            def apply_create(habit):
+                self.store.insert(habit)
+                return habit_to_json(habit)
+            return (lambda: repository.add_habit(name, frequency)), apply_create
+        habit = self.get_habit(request)
+        # A habit deleted earlier in the batch is gone by the time this write runs
+        if habit.id in deleted:
+            raise RequestError("habit not found")
+        if op == "delete":
+            deleted.add(habit.id)
+            return (lambda: repository.delete_habit(habit.id)), lambda _: habit_to_json(self.store.remove(habit.id))
+        # A habit can only be completed once per period, also when several completions for it are in the same batch
+        if habit.is_completed_this_period() or habit.id in completing:
+            return (lambda: None), lambda _: False
+        completing.add(habit.id)
+        # The habit is completed for this period either way, the result says whether this request added the completion
+        def apply_complete(added):
+            self.store.apply_completion(habit, added)
+            return added
+        return (lambda: repository.add_completion(habit)), apply_complete
+
+    # Serve one client connection, answering each request line in order
+    async def serve_client(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    response = {"ok": True, "result": await self.handle(json.loads(line))}
+                # Report any failure of a request to its client instead of dropping the connection
+                except Exception as error:
+                    response = {"ok": False, "error": str(error)}
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+# Define a function that starts the service and returns it with its server, on a Unix socket if a path is given
+async def start_service(host="127.0.0.1", port=8765, path=None, commit_interval=0.002):
+    habit_app.init_db()
+    service = HabitService(habit_app.HabitStore().load(), commit_interval)
+    service.start()
+    if path:
+        server = await asyncio.start_unix_server(service.serve_client, path)
+    else:
+        server = await asyncio.start_server(service.serve_client, host, port)
+    return service, server
+
+# Run the service until it is interrupted
+async def serve(host, port, path, commit_interval):
+    service, server = await start_service(host, port, path, commit_interval)
+    print(f"Serving on {path or f'{host}:{port}'}")
+    async with server:
+        await server.serve_forever()
+
+# Read the command line arguments and run the service
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Habit Tracker service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--commit-interval", type=float, default=0.002, metavar="SECONDS", help="how long writes are collected before each commit")
+    parser.add_argument("--database", default=habit_app.Database_Name)
+    args = parser.parse_args(argv)
+    habit_app.Database_Name = args.database
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.commit_interval))
+    except KeyboardInterrupt:
+        pass
+
+# Run the main function
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Description: Tenant-aware storage that spreads habits over several SQLite shard files
+# Each tenant (user) is routed to one shard by a stable hash of its name, so a tenant's habits always live in the same
+# file and writes for different tenants mostly go to different files. Analytics across all tenants run one worker
+# process per shard and merge the partial results.
+
+# Import the os module to build the shard file paths
+# Import the zlib module for a hash that is stable across processes and Python runs
+# Import the ProcessPoolExecutor class to run one worker per shard
+# Import the sqlite3 module to open the shards in the worker processes
+# Import the habit_app and sql_analytics modules to store habits and compute streaks
+import os
+import sqlite3
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import habit_app
+import sql_analytics
+
+# Define a function that returns the shard number of a tenant
+def shard_for_tenant(tenant, shard_count):
+    # crc32 gives the same value in every process, unlike hash() which is randomized per process for strings
+    return zlib.crc32(tenant.encode("utf-8")) % shard_count
+
+# Define a function that computes the partial analytics of one shard, run in a worker process
+# It returns the shard's longest streak as (streak, habit id, name, frequency, tenant) and the number of habits per frequency
+def shard_summary(path):
+    conn = sqlite3.connect(path)
+    try:
+        habit_id, streak = sql_analytics.get_longest_streak(conn=conn)
+        longest = None
+        if habit_id is not None:
+            name, frequency, tenant = conn.execute("SELECT name, frequency, tenant FROM habits WHERE id = ?", (habit_id,)).fetchone()
+            longest = (streak, habit_id, name, frequency, tenant)
+        frequencies = dict(conn.execute("SELECT frequency, COUNT(*) FROM habits GROUP BY frequency"))
+        return longest, frequencies
+    finally:
+        conn.close()
+
+# Store the habits of many tenants in a directory of SQLite shard files
+class ShardedStorage:
+    # Initialize the storage with the directory that holds the shards and the number of shards
+    # The number of shards must stay the same for the life of the data, since it decides where each tenant lives
+    def __init__(self, directory, shard_count=8):
+        os.makedirs(directory, exist_ok=True)
+        self.paths = [os.path.join(directory, f"habits-{number:03d}.db") for number in range(shard_count)]
+        # Open each shard's repository when it is first used
+        self.repositories = {}
+
+    # Get the repository of a shard, creating the shard's tables if needed
+    def shard(self, number):
+        repository = self.repositories.get(number)
+        if repository is None:
+            repository = habit_app.HabitRepository(self.paths[number])
+            repository.init_db()
+            self.repositories[number] = repository
+        return repository
+
+    # Get the repository of the shard that holds a tenant's habits
+    def repository(self, tenant):
+        return self.shard(shard_for_tenant(tenant, len(self.paths)))
+
+    # Add a new habit for a tenant
+    def add_habit(self, tenant, name, frequency):
+        return self.repository(tenant).add_habit(name, frequency, tenant)
+
+    # Get all habits of a tenant
+    def get_habits(self, tenant):
+        return self.repository(tenant).get_all_habits(tenant=tenant)
+
+    # Get a habit of a tenant by id, or None if the tenant has no such habit
+    def get_habit(self, tenant, habit_id):
+        return next((habit for habit in self.get_habits(tenant) if habit.id == habit_id), None)
+
+    # Delete a habit of a tenant, and return False if the tenant has no such habit
+    def delete_habit(self, tenant, habit_id):
+        repository = self.repository(tenant)
+        with repository.transaction() as conn:
+            # Make sure the habit belongs to the tenant before deleting it
+            if conn.execute("SELECT 1 FROM habits WHERE id = ? AND tenant = ?", (habit_id, tenant)).fetchone() is None:
+                return False
+            repository.delete_habit(habit_id)
+        return True
+
+    # Add a completion for a tenant's habit, for today unless another date is given, and return False if the tenant has
+    # no such habit or its period is already completed
+    def add_completion(self, tenant, habit, completion_date=None):
+        repository = self.repository(tenant)
+        with repository.transaction() as conn:
+            # Make sure the habit belongs to the tenant before completing it
+            if conn.execute("SELECT 1 FROM habits WHERE id = ? AND tenant = ?", (habit.id, tenant)).fetchone() is None:
+                return False
+            return repository.add_completion(habit, completion_date)
+
+    # Compute the partial analytics of every shard in parallel, one worker process per shard
+    def shard_summaries(self):
+        # Make sure every shard exists so the workers find the tables
+        paths = [self.shard(number).database_name for number in range(len(self.paths))]
+        with ProcessPoolExecutor(max_workers=len(paths)) as executor:
+            return list(executor.map(shard_summary, paths))
+
+    # Get the longest streak across all tenants as (tenant, habit, streak), or (None, None, 0) if there are no completions
+    # Ties go to the lowest shard number and then the lowest habit id, so the answer does not depend on worker timing
+    def get_longest_streak(self):
+        best = None
+        for number, (longest, _) in enumerate(self.shard_summaries()):
+            if longest is not None and (best is None or longest[0] > best[1][0]):
+                best = (number, longest)
+        if best is None:
+            return None, None, 0
+        streak, habit_id, _, _, tenant = best[1]
+        return tenant, self.get_habit(tenant, habit_id), streak
+
+    # Get the number of habits of each frequency across all tenants
+    def get_frequency_breakdown(self):
+        totals = {}
+        for _, frequencies in self.shard_summaries():
+            for frequency, count in frequencies.items():
+                totals[frequency] = totals.get(frequency, 0) + count
+        return totals
+
+    # Close the connections to all shards
+    def close(self):
+        for repository in self.repositories.values():
+            repository.close()
+        self.repositories = {}
@@ -0,0 +1,109 @@
+# Description: Streak analytics computed inside SQLite with window functions, so completions never have to be loaded into Python
+# The streaks follow the same rules as the analytics module: a streak is a run of consecutive days (daily habits) or ISO weeks
+# (weekly habits), and a second completion in the same period starts a new streak.
+
+# Import the contextmanager decorator to share the connection handling between the functions
+# Import the groupby and itemgetter functions to group the rollup rows by habit
+# Import the analytics and habit_app modules to compute streaks and use the shared database connection
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+import analytics
+import habit_app
+
+# Define the query that returns the longest streak of each habit with completions, using the gaps-and-islands technique
+# 1. periods: turn each completion date into the same period number as analytics.period_key()
+#    (julianday 1721425.5 is day 1, Monday 1 January of year 1, and weeks are counted from that Monday)
+#    A habit with archived completions gets one more row at its last archived period that weighs as much as the streak
+#    ending there, so a run continuing from the archive is counted in full
+# 2. flagged: mark each completion that does not directly follow the previous period of the same habit as the start of a run
+# 3. runs: number the runs of each habit with a running total of those marks
+# 4. add up the weights of each run and keep the longest run of each habit, or its longest archived streak if that is longer
+Streaks_Query = """
+    WITH periods AS (
+        SELECT c.id, c.habit_id,
+               CASE WHEN h.frequency = 'weekly'
+                    THEN (CAST(julianday(date(c.completion_date)) - 1721424.5 AS INTEGER) - 1) / 7
+                    ELSE CAST(julianday(date(c.completion_date)) - 1721424.5 AS INTEGER)
+               END AS period,
+               1 AS weight
+        FROM completions c JOIN habits h ON h.id = c.habit_id
+        {habit_filter}
+        UNION ALL
+        SELECT 0, a.habit_id, a.last_period, a.current_streak FROM archived_habits a
+        {archive_filter}
+    ),
+    flagged AS (
+        SELECT habit_id, id, period, weight,
+               CASE WHEN period - LAG(period) OVER (PARTITION BY habit_id ORDER BY period, id) = 1 THEN 0 ELSE 1 END AS starts_run
+        FROM periods
+    ),
+    runs AS (
+        SELECT habit_id, weight, SUM(starts_run) OVER (PARTITION BY habit_id ORDER BY period, id ROWS UNBOUNDED PRECEDING) AS run
+        FROM flagged
+    ),
+    streaks AS (
+        SELECT habit_id, MAX(length) AS longest_streak
+        FROM (SELECT habit_id, SUM(weight) AS length FROM runs GROUP BY habit_id, run
+              UNION ALL
+              SELECT a.habit_id, a.longest_streak FROM archived_habits a {archive_filter})
+        GROUP BY habit_id
+    )
+"""
+
+# Define a function that builds the streaks query for the given habit ids, or for every habit
+def streaks_query(conn, habit_ids=None):
+    if habit_ids is None:
+        return Streaks_Query.format(habit_filter="", archive_filter="")
+    # Put the habit ids in a temporary table so any number of them can be selected
+    habit_app.select_habits(conn, habit_ids)
+    return Streaks_Query.format(habit_filter="WHERE c.habit_id IN (SELECT habit_id FROM selected_habits)",
+                                archive_filter="WHERE a.habit_id IN (SELECT habit_id FROM selected_habits)")
+
+# Define a function that returns the id and longest streak of the habit with the longest streak
+# Ties go to the habit with the lowest id, which matches analytics.get_longest_streak() on habits in id order
+# The shared connection of habit_app is used unless another connection is given
+def get_longest_streak(habit_ids=None, conn=None):
+    with connection(conn) as conn:
+        row = conn.execute(streaks_query(conn, habit_ids) + """
+            SELECT habit_id, longest_streak FROM streaks ORDER BY longest_streak DESC, habit_id LIMIT 1
+        """).fetchone()
+    # Return no habit and a streak of 0 if there are no completions, like analytics.get_longest_streak()
+    return row if row else (None, 0)
+
+# Define a function that returns the longest streak of a habit
+def get_longest_streak_for_habit(habit_id, conn=None):
+    with connection(conn) as conn:
+        row = conn.execute(streaks_query(conn, [habit_id]) + """
+            SELECT longest_streak FROM streaks
+        """).fetchone()
+    return row[0] if row else 0
+
+# Define a function that returns the streaks of weekly habits as {habit id: StreakStats}, read from the completion_weeks rollup
+# The rollup has one row per habit and week with its number of completions, so no completion rows have to be read
+def get_weekly_streak_stats(habit_ids=None, conn=None):
+    with connection(conn) as conn:
+        habit_filter = ""
+        if habit_ids is not None:
+            habit_app.select_habits(conn, habit_ids)
+            habit_filter = "AND w.habit_id IN (SELECT habit_id FROM selected_habits)"
+        rows = conn.execute(f"""
+            SELECT w.habit_id, w.week, w.completions FROM completion_weeks w JOIN habits h ON h.id = w.habit_id
+            WHERE h.frequency = 'weekly' {habit_filter}
+            ORDER BY w.habit_id, w.week
+        """).fetchall()
+    # A second completion in the same week starts a new streak, so each week is added once per completion
+    return {
+        habit_id: analytics.StreakStats.from_periods(week for _, week, count in habit_rows for _ in range(count))
+        for habit_id, habit_rows in groupby(rows, key=itemgetter(0))
+    }
+
+# Define a context manager that provides the given connection, or the shared connection of habit_app while holding its lock
+@contextmanager
+def connection(conn=None):
+    if conn is not None:
+        yield conn
+        return
+    repository = habit_app.get_repository()
+    with repository.lock:
+        yield repository.conn
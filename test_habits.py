@@ -6,10 +6,25 @@
 # Import the HabitClass from the habit_app module
 # Import the init_db, add_habit, delete_habit, get_all_habits, and add_completion functions from the habit_app module
 # Import the analytics functions from the analytics module
+import asyncio
+import json
 import pytest
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+import time
+from datetime import date, datetime, timedelta
 import analytics
+import archive
+import benchmarks
+import bitmaps
+import habit_app
+import importer
+import metrics
+import numpy_analytics
+import parallel_analytics
+import sharding
+import sql_analytics
+import service
 from habit_app import HabitClass, init_db, add_habit, delete_habit, get_all_habits, add_completion
 
 def test_habit_creation():
@@ -60,9 +75,11 @@ def test_get_longest_streak():
     assert longest_streak == 4
 
 @pytest.fixture
-def db_connection():
+def db_connection(tmp_path, monkeypatch):
+    # Use a throwaway database so the tests do not leave habits behind in habits.db
+    monkeypatch.setattr(habit_app, "Database_Name", str(tmp_path / "habits.db"))
     init_db()
-    connection = sqlite3.connect("habits.db")
+    connection = sqlite3.connect(habit_app.Database_Name)
     yield connection
     connection.close()
 
@@ -133,3 +150,780 @@ def test_get_longest_streak_for_weekly_habit():
     ]
     habit = HabitClass(1, "Test Habit", "weekly", datetime.now(), completion_dates)
     assert analytics.get_longest_streak_for_habit(habit) == 2
+
+def test_get_all_habits_groups_completions(db_connection):
+    habit1 = add_habit("Read", "daily")
+    habit2 = add_habit("Run", "weekly")
+    add_habit("Swim", "weekly")
+    cur = db_connection.cursor()
+    cur.executemany("INSERT INTO completions (habit_id, completion_date) VALUES (?, ?)", [
+        (habit1.id, "2023-03-07"), (habit2.id, "2023-03-06"), (habit1.id, "2023-03-05"), (habit1.id, "2023-03-06"),
+    ])
+    db_connection.commit()
+    habits = {h.id: h for h in get_all_habits()}
+    assert len(habits) == 3
+    assert [d.day for d in habits[habit1.id].completion_dates] == [5, 6, 7]
+    assert [d.day for d in habits[habit2.id].completion_dates] == [6]
+    assert habits[3].completion_dates == []
+
+def test_init_db_migrates_existing_database(tmp_path, monkeypatch):
+    path = str(tmp_path / "old.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE habits (id INTEGER PRIMARY KEY, name TEXT NOT NULL, frequency TEXT NOT NULL, creation_date TEXT NOT NULL)")
+    connection.execute("CREATE TABLE completions (id INTEGER PRIMARY KEY, habit_id INTEGER NOT NULL, completion_date DATE)")
+    connection.commit()
+    connection.close()
+    monkeypatch.setattr(habit_app, "Database_Name", path)
+    init_db()
+    init_db()
+    connection = sqlite3.connect(path)
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == len(habit_app.MIGRATIONS)
+    indexes = [row[1] for row in connection.execute("PRAGMA index_list(completions)")]
+    assert "idx_completions_habit_date" in indexes
+    connection.close()
+
+def test_failed_migration_is_rolled_back(monkeypatch):
+    connection = sqlite3.connect(":memory:", isolation_level=None)
+    connection.execute("CREATE TABLE completions (id INTEGER PRIMARY KEY, habit_id INTEGER NOT NULL, completion_date DATE)")
+    def broken_migration(conn):
+        conn.execute("CREATE TABLE half_done (id INTEGER)")
+        raise sqlite3.OperationalError("broken")
+    monkeypatch.setattr(habit_app, "MIGRATIONS", [habit_app.MIGRATIONS[0], broken_migration])
+    with pytest.raises(sqlite3.OperationalError):
+        habit_app.migrate_db(connection)
+    # The first migration stays applied, the broken one leaves nothing behind and no transaction open
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == 1
+    assert connection.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+    assert not connection.in_transaction
+    connection.close()
+
+def test_repository_reuses_connection_in_wal_mode(db_connection):
+    repository = habit_app.get_repository()
+    add_habit("Read", "daily")
+    assert habit_app.get_repository() is repository
+    assert repository.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+def test_transaction_groups_and_rolls_back(db_connection):
+    with habit_app.transaction():
+        habit = add_habit("Read", "daily")
+        add_completion(habit)
+    assert len(get_all_habits()) == 1
+    with pytest.raises(RuntimeError):
+        with habit_app.transaction():
+            add_habit("Run", "weekly")
+            raise RuntimeError("abort")
+    habits = get_all_habits()
+    assert [h.habitname for h in habits] == ["Read"]
+    assert len(habits[0].completion_dates) == 1
+
+def test_add_completions_applies_period_rule(db_connection):
+    daily = add_habit("Read", "daily")
+    weekly = add_habit("Run", "weekly")
+    add_completion(daily, "2023-03-06")
+    added = habit_app.add_completions([
+        (daily.id, "2023-03-06"), (daily.id, "2023-03-07"), (daily.id, "2023-03-07"),
+        (weekly.id, "2023-03-06"), (weekly.id, "2023-03-12"), (weekly.id, "2023-03-13"),
+        (999, "2023-03-06"),
+    ], batch_size=2)
+    assert added == 3
+    habits = {h.id: h for h in get_all_habits()}
+    assert [d.day for d in habits[daily.id].completion_dates] == [6, 7]
+    assert [d.day for d in habits[weekly.id].completion_dates] == [6, 13]
+
+def test_import_csv_and_jsonl(db_connection, tmp_path):
+    habit = add_habit("Read", "daily")
+    csv_path = tmp_path / "history.csv"
+    csv_path.write_text(f"habit_id,completion_date\n{habit.id},2023-03-05\n{habit.id},2023-03-06\n")
+    jsonl_path = tmp_path / "history.jsonl"
+    jsonl_path.write_text(f'{{"habit_id": {habit.id}, "completion_date": "2023-03-06"}}\n\n{{"habit_id": {habit.id}, "completion_date": "2023-03-07"}}\n')
+    assert importer.import_file(str(csv_path)) == 2
+    assert importer.import_file(str(jsonl_path)) == 1
+    assert len(get_all_habits()[0].completion_dates) == 3
+    jsonl_path.write_text('{"habit_id": 1}\n')
+    with pytest.raises(ValueError):
+        importer.import_file(str(jsonl_path))
+
+def test_stored_streaks_match_full_recompute(db_connection):
+    daily = add_habit("Read", "daily")
+    weekly = add_habit("Run", "weekly")
+    start = datetime(2023, 3, 6)
+    for offset in [0, 1, 2, 4, 5, 9]:
+        add_completion(daily, start + timedelta(days=offset))
+    for offset in [0, 1, 3, 4, 5]:
+        add_completion(weekly, start + timedelta(weeks=offset))
+    # An older completion arrives last and forces a recompute
+    add_completion(daily, start - timedelta(days=1))
+    rows = dict((row[0], row[1:]) for row in db_connection.execute("SELECT habit_id, longest_streak, current_streak FROM habit_stats"))
+    assert rows[daily.id] == (4, 1)
+    assert rows[weekly.id] == (3, 3)
+    for habit in get_all_habits():
+        stored = habit.streak_stats
+        recomputed = analytics.compute_streak_stats(habit)
+        assert (stored.longest, stored.current, stored.last_period) == (recomputed.longest, recomputed.current, recomputed.last_period)
+    db_connection.execute("UPDATE habit_stats SET longest_streak = 0")
+    db_connection.commit()
+    habit_app.rebuild_stats()
+    assert [h.streak_stats.longest for h in get_all_habits()] == [4, 3]
+
+def test_complete_updates_streaks_incrementally():
+    completion_dates = [datetime.now() - timedelta(days=2), datetime.now() - timedelta(days=1)]
+    habit = HabitClass(1, "Test Habit", "daily", datetime.now(), completion_dates)
+    assert analytics.get_longest_streak_for_habit(habit) == 2
+    stats = habit.streak_stats
+    assert habit.complete() == True
+    assert habit.streak_stats is stats
+    assert analytics.get_longest_streak_for_habit(habit) == 3
+    assert analytics.get_current_streak_for_habit(habit) == 3
+    assert analytics.get_current_streak_for_habit(habit, datetime.now().date() + timedelta(days=2)) == 0
+
+def store_habits(habits):
+    # Save in-memory habits to the database and return them as loaded back from it
+    for habit in habits:
+        stored = add_habit(habit.habitname, habit.habitfrequency)
+        habit_app.add_completions((stored.id, d) for d in habit.completion_dates)
+    return get_all_habits()
+
+@pytest.mark.parametrize("frequency, offsets", [
+    ("daily", [timedelta(days=n) for n in (4, 3, 2, 1)]),
+    ("daily", [timedelta(days=n) for n in (6, 5, 4, 1)]),
+    ("weekly", [timedelta(weeks=n) for n in (4, 3, 1)]),
+    ("weekly", [timedelta(weeks=n) for n in (2, 1)]),
+    ("daily", []),
+])
+def test_sql_backend_matches_python_for_habit(db_connection, frequency, offsets):
+    habit = HabitClass(1, "Test Habit", frequency, datetime.now(), [datetime.now() - offset for offset in offsets])
+    stored, = store_habits([habit])
+    assert analytics.get_longest_streak_for_habit(stored, backend="sql") == analytics.get_longest_streak_for_habit(habit)
+
+def test_sql_backend_matches_python_for_all_habits(db_connection):
+    habits = store_habits([
+        HabitClass(1, "Test Habit 1", "daily", datetime.now(), [datetime.now() - timedelta(days=n) for n in (4, 3, 2, 1)]),
+        HabitClass(2, "Test Habit 2", "weekly", datetime.now(), [datetime.now() - timedelta(weeks=n) for n in (2, 1)]),
+        HabitClass(3, "Test Habit 3", "daily", datetime.now(), [datetime.now() - timedelta(days=n) for n in (9, 8, 7, 6)]),
+    ])
+    sql_habit, sql_streak = analytics.get_longest_streak(habits, backend="sql")
+    python_habit, python_streak = analytics.get_longest_streak(habits)
+    assert (sql_habit.id, sql_streak) == (python_habit.id, python_streak) == (habits[0].id, 4)
+    assert analytics.get_longest_streak([], backend="sql") == (None, 0)
+
+def test_sql_backend_counts_duplicate_completions_like_python(db_connection):
+    habit = add_habit("Read", "daily")
+    # The database refuses the second completion of a day
+    assert [add_completion(habit, day) for day in ["2023-03-01", "2023-03-01", "2023-03-03", "2023-03-04"]] == [True, False, True, True]
+    stored, = get_all_habits()
+    assert analytics.get_longest_streak_for_habit(stored, backend="sql") == analytics.compute_streak_stats(stored).longest == 2
+
+@pytest.fixture(params=["numpy", "python"])
+def numpy_backend(request, monkeypatch):
+    # Run the vectorized analytics with NumPy and with the pure-Python fallback
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(numpy_analytics, "np", None)
+    return numpy_analytics
+
+def test_numpy_streaks_match_analytics(numpy_backend):
+    today = datetime(2023, 3, 15)
+    habits = [
+        HabitClass(1, "Daily", "daily", today, [today - timedelta(days=n) for n in (9, 8, 8, 7, 5, 4, 3, 2, 1)]),
+        HabitClass(2, "Empty", "daily", today, []),
+        HabitClass(3, "Weekly", "weekly", today, [today - timedelta(weeks=n) for n in (9, 6, 5, 4, 3, 2)]),
+        HabitClass(4, "Tied", "weekly", today, [today - timedelta(weeks=n) for n in (30, 29, 28, 27, 26)]),
+    ]
+    for habit in habits:
+        assert numpy_backend.get_longest_streak_for_habit(habit) == analytics.get_longest_streak_for_habit(habit)
+        assert numpy_backend.get_current_streak_for_habit(habit, today.date()) == analytics.get_current_streak_for_habit(habit, today.date())
+    habit, streak = numpy_backend.get_longest_streak(habits)
+    assert (habit.id, streak) == (1, 5)
+    assert numpy_backend.get_longest_streak([habits[1]]) == (None, 0)
+    assert numpy_backend.get_completion_counts(habits) == [9, 0, 6, 5]
+    assert numpy_backend.get_completion_rates(habits, 10, today.date()) == [0.8, 0.0, 0.6, 0.0]
+    assert analytics.get_completion_rates(habits, 10, today.date()) == [0.8, 0.0, 0.6, 0.0]
+
+def test_habit_stores_completions_as_sorted_day_numbers():
+    today = datetime.now()
+    monday = today - timedelta(days=today.weekday())
+    habit = HabitClass(1, "Test Habit", "weekly", today, [monday - timedelta(days=1), monday - timedelta(days=8)])
+    assert not hasattr(habit, "__dict__")
+    assert habit.completion_days.itemsize == 4
+    assert list(habit.completion_days) == [(monday - timedelta(days=8)).toordinal(), (monday - timedelta(days=1)).toordinal()]
+    assert habit.completion_dates == [datetime.combine((monday - timedelta(days=n)).date(), datetime.min.time()) for n in (8, 1)]
+    assert habit.is_completed_this_week() == False
+    assert habit.is_completed_today() == False
+    assert habit.complete() == True
+    assert habit.is_completed_this_week() == True
+    assert habit.complete() == False
+    assert list(habit.completion_days) == sorted(habit.completion_days)
+
+def test_completion_dates_list_idioms_change_the_habit():
+    habit = HabitClass(1, "Read", "daily", datetime.now(), [])
+    habit.completion_dates.append(datetime.now())
+    assert len(habit.completion_dates) == 1
+    assert habit.is_completed_today()
+    habit.completion_dates.append(datetime.now() - timedelta(days=1))
+    assert habit.get_streaks().longest == 2
+    habit.completion_dates.remove(habit.completion_dates[-1])
+    assert not habit.is_completed_today()
+    assert habit.get_streaks().longest == 1
+
+def test_habit_store_writes_through_and_keeps_indexes(db_connection):
+    store = habit_app.HabitStore().load()
+    read = store.add("Read", "daily")
+    run = store.add("Run", "weekly")
+    assert store.get(read.id) is read
+    assert store.by_frequency("weekly") == [run]
+    assert store.complete(read) == True
+    assert store.complete(read) == False
+    assert store.delete(run.id) is run
+    assert store.delete(run.id) is None
+    assert store.by_frequency("weekly") == []
+    reloaded = habit_app.HabitStore().load()
+    assert [h.id for h in reloaded] == [read.id]
+    assert len(reloaded.get(read.id).completion_days) == 1
+
+def test_habit_store_caches_analytics_until_data_changes(db_connection):
+    store = habit_app.HabitStore().load()
+    habit = store.add("Read", "daily")
+    calls = []
+    def longest():
+        calls.append(1)
+        return analytics.get_longest_streak(store)
+    assert store.cached("longest", longest) == (None, 0)
+    assert store.cached("longest", longest) == (None, 0)
+    assert len(calls) == 1
+    store.complete(habit)
+    assert store.cached("longest", longest) == (habit, 1)
+    assert len(calls) == 2
+
+def test_lazy_store_loads_histories_on_demand(db_connection):
+    today = datetime.now().date()
+    habit_ids = [add_habit(f"Habit {n}", "daily").id for n in range(3)]
+    habit_app.add_completions((habit_id, today - timedelta(days=n)) for habit_id in habit_ids for n in range(1, 4))
+    store = habit_app.HabitStore(lazy=True, max_habits=2).load()
+    assert store.completed_this_period() == set()
+    assert analytics.get_longest_streak_for_habit(store.get(habit_ids[0])) == 3
+    assert len(store.history.entries) == 0
+    assert len(store.get(habit_ids[0]).completion_dates) == 3
+    assert len(store.get(habit_ids[1]).completion_days) == 3
+    assert len(store.get(habit_ids[2]).completion_days) == 3
+    assert list(store.history.entries) == habit_ids[1:]
+    assert store.history.size == 6
+
+def test_lazy_store_completes_without_loading_history(db_connection):
+    habit_id = add_habit("Read", "daily").id
+    store = habit_app.HabitStore(lazy=True).load()
+    habit = store.get(habit_id)
+    assert store.complete(habit) == True
+    assert store.complete(habit) == False
+    assert len(store.history.entries) == 0
+    assert store.completed_this_period() == {habit_id}
+    assert analytics.get_current_streak_for_habit(habit) == 1
+    assert len(habit.completion_days) == 1
+
+def test_iter_habits_streams_one_habit_at_a_time(db_connection):
+    daily = add_habit("Read", "daily")
+    weekly = add_habit("Run", "weekly")
+    empty = add_habit("Swim", "daily")
+    habit_app.add_completions([(daily.id, "2023-03-05"), (daily.id, "2023-03-06"), (weekly.id, "2023-03-06")])
+    stream = habit_app.iter_habits()
+    first = next(stream)
+    assert (first.id, list(first.completion_days)) == (daily.id, [date(2023, 3, 5).toordinal(), date(2023, 3, 6).toordinal()])
+    assert [(h.id, len(h.completion_days)) for h in stream] == [(weekly.id, 1), (empty.id, 0)]
+    assert [h.id for h in analytics.iter_habits_by_frequency(habit_app.iter_habits("daily"), "daily")] == [daily.id, empty.id]
+    habit, streak = analytics.get_longest_streak(habit_app.iter_habits())
+    assert (habit.id, streak) == (daily.id, 2)
+    stats = {h.id: rest for h, *rest in analytics.iter_habit_stats(habit_app.iter_habits(), date(2023, 3, 7))}
+    assert stats == {daily.id: [2, 2, 2], weekly.id: [1, 1, 1], empty.id: [0, 0, 0]}
+
+def test_sharded_storage_routes_and_isolates_tenants(tmp_path):
+    storage = sharding.ShardedStorage(str(tmp_path / "shards"), shard_count=3)
+    assert sharding.shard_for_tenant("alice", 3) == sharding.shard_for_tenant("alice", 3)
+    tenants = ["alice", "bob", "carol", "erin"]
+    habits = {tenant: storage.add_habit(tenant, f"{tenant} reads", "daily") for tenant in tenants}
+    for tenant in tenants:
+        assert [h.habitname for h in storage.get_habits(tenant)] == [f"{tenant} reads"]
+    assert len({sharding.shard_for_tenant(tenant, 3) for tenant in tenants}) > 1
+    # dave shares alice's shard but does not own her habit
+    assert sharding.shard_for_tenant("dave", 3) == sharding.shard_for_tenant("alice", 3)
+    assert storage.delete_habit("dave", habits["alice"].id) == False
+    assert storage.delete_habit("alice", habits["alice"].id) == True
+    assert storage.get_habits("alice") == []
+    assert len(storage.get_habits("bob")) == 1
+    storage.close()
+
+def test_sharded_storage_refuses_completions_of_another_tenants_habit(tmp_path):
+    storage = sharding.ShardedStorage(str(tmp_path / "shards"), shard_count=3)
+    alice = storage.add_habit("alice", "Read", "daily")
+    # dave shares alice's shard, so only the tenant check keeps him from completing her habit
+    assert sharding.shard_for_tenant("dave", 3) == sharding.shard_for_tenant("alice", 3)
+    assert storage.add_completion("dave", alice, date(2023, 3, 1)) == False
+    assert storage.get_habit("alice", alice.id).completion_dates == []
+    assert storage.add_completion("alice", alice, date(2023, 3, 1)) == True
+    assert [day.date() for day in storage.get_habit("alice", alice.id).completion_dates] == [date(2023, 3, 1)]
+    # A tenant on another shard cannot reach the habit either
+    other = next(tenant for tenant in ["bob", "carol", "erin"] if sharding.shard_for_tenant(tenant, 3) != sharding.shard_for_tenant("alice", 3))
+    assert storage.add_completion(other, alice, date(2023, 3, 2)) == False
+    assert [day.date() for day in storage.get_habit("alice", alice.id).completion_dates] == [date(2023, 3, 1)]
+    storage.close()
+
+def test_sharded_storage_merges_analytics_across_shards(tmp_path):
+    storage = sharding.ShardedStorage(str(tmp_path / "shards"), shard_count=3)
+    assert storage.get_longest_streak() == (None, None, 0)
+    for number, tenant in enumerate(["alice", "bob", "carol", "dave", "erin"]):
+        habit = storage.add_habit(tenant, "Read", "daily")
+        storage.add_habit(tenant, "Run", "weekly")
+        for day in range(number + 1):
+            storage.add_completion(tenant, habit, date(2023, 3, 1) + timedelta(days=day))
+    tenant, habit, streak = storage.get_longest_streak()
+    assert (tenant, habit.habitname, streak) == ("erin", "Read", 5)
+    assert storage.get_frequency_breakdown() == {"daily": 5, "weekly": 5}
+    storage.close()
+
+def test_service_group_commits_concurrent_writes(db_connection):
+    async def scenario():
+        service_instance, server = await service.start_service(port=0, commit_interval=0.05)
+        port = server.sockets[0].getsockname()[1]
+        async def call(request):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(json.dumps(request).encode() + b"\n")
+            response = json.loads(await reader.readline())
+            writer.close()
+            return response
+        created = await asyncio.gather(*(call({"op": "create", "name": f"Habit {n}", "frequency": "daily"}) for n in range(5)))
+        habit_id = created[0]["result"]["id"]
+        completed = await asyncio.gather(call({"op": "complete", "id": habit_id}), call({"op": "complete", "id": habit_id}))
+        status = await call({"op": "status"})
+        longest = await call({"op": "analytics", "kind": "longest_streak"})
+        invalid = await call({"op": "create", "name": "x", "frequency": "daily"})
+        server.close()
+        await server.wait_closed()
+        await service_instance.stop()
+        return service_instance, created, completed, status, longest, invalid
+    service_instance, created, completed, status, longest, invalid = asyncio.run(scenario())
+    assert all(response["ok"] for response in created)
+    assert service_instance.commits == 2
+    assert sorted(response["result"] for response in completed) == [False, True]
+    assert [h["completed"] for h in status["result"]] == [True, False, False, False, False]
+    assert longest["result"]["streak"] == 1
+    assert invalid["ok"] == False
+    assert len(get_all_habits()) == 5
+
+def test_service_fails_only_the_bad_writes_of_a_batch(db_connection):
+    first, second = add_habit("Read", "daily"), add_habit("Swim", "weekly")
+    async def scenario():
+        service_instance = service.HabitService(habit_app.HabitStore().load(), commit_interval=0.05)
+        service_instance.start()
+        # Delete the second habit behind the service's back, so completing it fails in the database
+        db_connection.execute("PRAGMA foreign_keys = ON")
+        db_connection.execute("DELETE FROM habits WHERE id = ?", (second.id,))
+        db_connection.commit()
+        requests = [
+            {"op": "delete", "id": first.id}, {"op": "delete", "id": first.id}, {"op": "complete", "id": first.id},
+            {"op": "create", "name": 123, "frequency": "daily"}, {"op": "complete", "id": second.id},
+            {"op": "create", "name": "Walk", "frequency": "daily"},
+        ]
+        results = await asyncio.gather(*(service_instance.handle(request) for request in requests), return_exceptions=True)
+        # The writer is still running after the failures
+        later = await service_instance.handle({"op": "create", "name": "Cook", "frequency": "daily"})
+        await service_instance.stop()
+        return service_instance, results, later
+    service_instance, results, later = asyncio.run(scenario())
+    assert results[0]["id"] == first.id
+    assert [type(result) for result in results[1:5]] == [service.RequestError, service.RequestError, service.RequestError, sqlite3.IntegrityError]
+    assert results[5]["name"] == "Walk" and later["name"] == "Cook"
+    assert service_instance.commits == 2
+    assert [habit.habitname for habit in get_all_habits()] == ["Walk", "Cook"]
+
+def test_generate_completions_is_deterministic(db_connection):
+    habits = [add_habit("Run", "daily"), add_habit("Swim", "weekly")]
+    completions = list(benchmarks.generate_completions(habits, 70, seed=3))
+    assert completions == list(benchmarks.generate_completions(habits, 70, seed=3))
+    assert completions != list(benchmarks.generate_completions(habits, 70, seed=4))
+    # Weekly habits only get one completion per week
+    weekly = [day for habit_id, day in completions if habit_id == habits[1].id]
+    assert len(weekly) <= 10
+    assert all((day - benchmarks.History_Start).days % 7 == 0 for day in weekly)
+
+def test_create_database_points_the_app_back(db_connection, tmp_path):
+    habit = add_habit("Run", "daily")
+    benchmarks.create_database(str(tmp_path / "bench.db"), 4, 14)
+    # The app still uses its own database, and the benchmark database was filled
+    assert [h.id for h in get_all_habits()] == [habit.id]
+    with benchmarks.using_database(str(tmp_path / "bench.db")) as repository:
+        assert len(repository.get_all_habits()) == 4
+    assert [h.id for h in get_all_habits()] == [habit.id]
+
+def test_find_regressions():
+    baseline = {"small": {"get_all_habits": 0.010, "add_completion": 0.00001}}
+    results = {"small": {"get_all_habits": 0.020, "add_completion": 0.00003, "new_operation": 1.0}}
+    # add_completion tripled, but by less than the noise floor; new operations have no baseline yet
+    assert benchmarks.find_regressions(results, baseline, 0.5) == [("small", "get_all_habits", 0.010, 0.020)]
+    assert benchmarks.find_regressions(results, baseline, 1.5) == []
+
+def test_metrics_record_operations_only_while_enabled(db_connection):
+    metrics.reset()
+    original = habit_app.HabitRepository.add_habit
+    metrics.enable()
+    try:
+        habit = add_habit("Read", "daily")
+        add_completion(habit, "2023-01-02")
+        habits = get_all_habits()
+        analytics.get_longest_streak(habits)
+    finally:
+        metrics.disable()
+    assert habit_app.HabitRepository.add_habit is original
+    add_habit("Write", "daily")
+    operations = metrics.snapshot()["operations"]
+    # The second add_habit ran after disable() and is not counted
+    assert operations["habit_app.add_habit"]["calls"] == 1
+    assert operations["habit_app.add_habit"]["rows"] == 2
+    assert operations["habit_app.add_completion"]["statements"] > 0
+    assert operations["habit_app.get_all_habits"]["rows"] == 1
+    assert operations["analytics.get_longest_streak"]["buckets"]["+Inf"] == 1
+    text = metrics.prometheus_text()
+    assert 'habit_tracker_operation_duration_seconds_count{operation="habit_app.add_habit"} 1' in text
+    metrics.reset()
+
+def test_snapshot_is_used_until_the_database_changes(db_connection, tmp_path):
+    repository = habit_app.get_repository()
+    habit = add_habit("Read", "daily")
+    add_completion(habit, "2023-01-02")
+    snapshot_path = str(tmp_path / "habits.db.snapshot")
+    # The first load reads the database and saves the snapshot
+    first = repository.get_all_habits_cached(snapshot_path)
+    database_id, changes = repository.change_count()
+    cached = habit_app.read_snapshot(snapshot_path, database_id, changes)
+    assert [(h.id, h.habitname, h.creation_date, list(h.completion_days), h.get_streaks().longest) for h in cached] == \
+           [(h.id, h.habitname, h.creation_date, list(h.completion_days), h.get_streaks().longest) for h in first]
+    # Any change to the completions makes the snapshot out of date
+    add_completion(habit, "2023-01-03")
+    assert habit_app.read_snapshot(snapshot_path, *repository.change_count()) is None
+    store = habit_app.HabitStore(repository, snapshot_path=snapshot_path).load()
+    assert store.get(habit.id).get_streaks().longest == 2
+    assert habit_app.read_snapshot(snapshot_path, *repository.change_count()) is not None
+
+def test_are_dates_in_same_week():
+    assert analytics.are_dates_in_same_week(datetime(2023, 1, 2), datetime(2023, 1, 8, 23, 59))
+    assert not analytics.are_dates_in_same_week(date(2023, 1, 8), date(2023, 1, 9))
+
+def test_parallel_longest_streak_matches_sequential(db_connection, monkeypatch):
+    # Two habits tie for the longest streak, the first one must win in both modes
+    histories = {"Run": [2, 3, 4, 10], "Read": [1, 2, 3], "Swim": [5, 6, 7], "Yoga": []}
+    for name, days in histories.items():
+        habit = add_habit(name, "daily")
+        for day in days:
+            add_completion(habit, date(2023, 1, day))
+    sequential = analytics.get_longest_streak(get_all_habits(), backend="sequential")
+    habits = get_all_habits()
+    # Forget the stored streaks of some habits so they are computed by the workers
+    habits[0].streak_stats = habits[2].streak_stats = None
+    chunks = parallel_analytics.make_chunks(habits, 2)
+    assert [index for chunk in chunks for index, _, _ in chunk] == [0, 2]
+    habit, streak = parallel_analytics.get_longest_streak(habits, workers=2)
+    assert (habit.id, streak) == (sequential[0].id, sequential[1]) == (habits[0].id, 3)
+    assert habits[2].streak_stats.longest == 3
+    # Small inputs stay on one core
+    monkeypatch.setattr(parallel_analytics, "Parallel_Min_Completions", 100)
+    assert not parallel_analytics.should_run_in_parallel(habits, workers=4)
+    monkeypatch.setattr(parallel_analytics, "Parallel_Min_Completions", 3)
+    habits[1].streak_stats = None
+    assert parallel_analytics.should_run_in_parallel(habits, workers=4)
+    assert not parallel_analytics.should_run_in_parallel(habits, workers=1)
+    # A HabitStore takes the parallel path like a list, a stream of habits does not
+    monkeypatch.setattr(parallel_analytics, "should_run_in_parallel", lambda habits: True)
+    monkeypatch.setattr(parallel_analytics, "get_longest_streak", lambda habits: ("parallel", 0))
+    assert analytics.get_longest_streak(habit_app.HabitStore().load()) == ("parallel", 0)
+    assert analytics.get_longest_streak(habit_app.iter_habits())[1] == 3
+
+def test_habit_bitmap_days_and_weeks():
+    monday = date(2023, 1, 2).toordinal()
+    bitmap = bitmaps.HabitBitmap.from_days([monday, monday + 6, monday + 15], monday + 7)
+    # The bitmap starts at the week of the first completion, which is before the creation day
+    assert bitmap.origin_week == (monday - 1) // 7
+    assert bitmap.weeks == bytearray([0b1000001, 0, 0b10])
+    assert bitmap.has_day(monday + 6) and not bitmap.has_day(monday + 7)
+    assert bitmap.has_week(bitmap.origin_week + 2) and not bitmap.has_week(bitmap.origin_week + 1)
+    bitmap.add(monday - 7)
+    assert bitmap.days() == [monday - 7, monday, monday + 6, monday + 15]
+
+def test_habit_bitmap_follows_completions_and_reassigned_dates():
+    today = datetime.combine(date.today(), datetime.min.time())
+    weekly = HabitClass(1, "Swim", "weekly", today - timedelta(days=20), [today - timedelta(days=14)])
+    daily = HabitClass(2, "Read", "daily", today - timedelta(days=20), [today - timedelta(days=1)])
+    # Once the bitmap is built the status checks test its bits, and completing a habit marks today in it
+    for habit in (weekly, daily):
+        assert not habit.bitmap.has_day(today.toordinal())
+        assert not habit.is_completed_this_period()
+        assert habit.complete() == True
+        assert habit.bitmap.has_day(today.toordinal())
+        assert habit.is_completed_today() and habit.is_completed_this_week()
+        assert habit.complete() == False
+    assert weekly.bitmap.days() == [day.toordinal() for day in weekly.completion_dates]
+    # Reassigning the completion dates drops the bitmap, and the next one is built from the new dates
+    daily.completion_dates = [today - timedelta(days=2)]
+    assert not daily.is_completed_today() and not daily.is_completed_on((today - timedelta(days=1)).toordinal())
+    assert daily.bitmap.days() == [(today - timedelta(days=2)).toordinal()]
+    daily.completion_dates.append(today)
+    assert daily.is_completed_today() and daily.bitmap.has_day(today.toordinal())
+    del daily.completion_dates[-1]
+    assert not daily.is_completed_today() and not daily.bitmap.has_day(today.toordinal())
+
+@pytest.fixture(params=["numpy", "python"])
+def bitmap_file(request, db_connection, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(bitmaps, "np", None)
+    elif bitmaps.load_numpy() is None:
+        pytest.skip("NumPy is not installed")
+    yield habit_app.attach_bitmaps()
+    repository = habit_app.get_repository()
+    repository.bitmaps.close()
+    repository.bitmaps = None
+
+def test_bitmap_file_follows_completions(bitmap_file, monkeypatch):
+    repository = habit_app.get_repository()
+    run, read, swim = add_habit("Run", "daily"), add_habit("Read", "daily"), add_habit("Swim", "weekly")
+    today = date.today()
+    add_completion(run, today)
+    add_completion(swim, today - timedelta(days=today.weekday()))
+    habit_app.add_completions([(read.id, today - timedelta(days=7))])
+    assert bitmap_file.completed_ids(today.toordinal()) == ({run.id}, {run.id, swim.id})
+    store = habit_app.HabitStore().load()
+    assert store.completed_this_period() == {run.id, swim.id}
+    # A completion far outside the file grows it
+    add_completion(read, today - timedelta(days=5000))
+    assert bitmap_file.get(read.id).has_day((today - timedelta(days=5000)).toordinal())
+    # Rolled back completions never reach the bitmaps
+    with pytest.raises(ZeroDivisionError):
+        with habit_app.transaction():
+            add_completion(read, today)
+            1 / 0
+    assert not bitmap_file.get(read.id).has_day(today.toordinal())
+    delete_habit(run.id)
+    assert bitmap_file.completed_ids(today.toordinal()) == (set(), {swim.id})
+    # The file still matches the database, so attaching it again does not rebuild it
+    assert bitmap_file.changes == repository.change_count()[1]
+    # A file that missed a change is rebuilt when it is attached
+    bitmap_file.mark_synced(0)
+    repository.bitmaps = None
+    bitmap_file.close()
+    rebuilt = habit_app.attach_bitmaps()
+    assert rebuilt.completed_ids(today.toordinal()) == (set(), {swim.id})
+    assert rebuilt.get(read.id).days() == [(today - timedelta(days=5000)).toordinal(), (today - timedelta(days=7)).toordinal()]
+    assert habit_app.rebuild_bitmaps().get(swim.id).has_week(bitmaps.week_of_day(today.toordinal())[0])
+
+def test_prefix_counts_count_any_range():
+    prefix = analytics.PrefixCounts.from_periods([10, 11, 11, 14, 20])
+    assert prefix.count(0, 100) == 4
+    assert prefix.count(11, 14) == 2
+    assert prefix.count(12, 13) == 0
+    assert prefix.count(20, 25) == 1
+    assert prefix.count(15, 12) == 0
+    # Periods before the last one are rejected, the counts must be rebuilt
+    assert not prefix.add(12)
+    assert prefix.add(20) and prefix.add(21)
+    assert prefix.count(19, 21) == 2
+
+def test_windowed_analytics_and_top_habits():
+    today = datetime(2023, 3, 15)
+    habits = [
+        HabitClass(1, "Read", "daily", today, [today - timedelta(days=n) for n in (0, 1, 2, 5)]),
+        HabitClass(2, "Run", "daily", today, [today - timedelta(days=n) for n in (1, 2, 3, 4, 10, 11, 12, 13, 14, 15)]),
+        HabitClass(3, "Swim", "weekly", today, [today - timedelta(weeks=n) for n in (0, 1, 2, 3)]),
+        HabitClass(4, "Yoga", "daily", today, [today - timedelta(days=n) for n in (1, 2, 3, 4)]),
+    ]
+    assert analytics.get_completion_rate(habits[0], 4, today.date()) == 0.75
+    assert analytics.get_completion_rate(habits[2], 8, today.date()) == 0.5
+    # Completing a habit keeps its prefix counts up to date
+    habits[3].complete()
+    assert analytics.get_completion_count(habits[3], date.today().toordinal(), date.today().toordinal()) == 1
+    habits[3] = HabitClass(4, "Yoga", "daily", today, [today - timedelta(days=n) for n in (1, 2, 3, 4)])
+    # Ties keep the order of the habits
+    top = analytics.get_top_habits_by_streak(habits, 2, current=True, today=today.date())
+    assert [(habit.id, streak) for habit, streak in top] == [(2, 4), (3, 4)]
+    top = analytics.get_top_habits_by_streak(habits, 1)
+    assert [(habit.id, streak) for habit, streak in top] == [(2, 6)]
+    top = analytics.get_top_habits_by_rate(habits, 3, 5, today.date())
+    assert [(habit.id, rate) for habit, rate in top] == [(2, 0.8), (3, 0.8), (4, 0.8)]
+
+def test_command_line_prints_json(db_connection, capsys):
+    habit_app.run(["add", "Read", "daily"])
+    habit = json.loads(capsys.readouterr().out)
+    habit_app.run(["complete", str(habit["id"])])
+    assert json.loads(capsys.readouterr().out)["completed"] is True
+    habit_app.run(["status"])
+    assert json.loads(capsys.readouterr().out) == [dict(habit, completed=True)]
+    habit_app.run(["streak", str(habit["id"])])
+    assert json.loads(capsys.readouterr().out) == {"habit": habit, "longest": 1, "current": 1}
+    with pytest.raises(SystemExit):
+        habit_app.run(["delete", "99"])
+    assert json.loads(capsys.readouterr().out) == {"error": "habit 99 not found"}
+
+def test_batch_runs_in_one_transaction(db_connection):
+    store = habit_app.HabitStore(lazy=True).load()
+    results = habit_app.run_batch(store, ["add Read daily", "", "# a comment", "add 'Evening walk' weekly", "complete 1", "complete 1", "streak"])
+    assert [result.get("completed") for result in results[2:4]] == [True, False]
+    assert results[1]["name"] == "Evening walk"
+    assert results[4]["streak"] == 1
+    # A failing command rolls back the whole batch
+    with pytest.raises(ValueError, match="line 2"):
+        habit_app.run_batch(habit_app.HabitStore(lazy=True).load(), ["add Run daily", "frobnicate"])
+    assert [habit.habitname for habit in get_all_habits()] == ["Read", "Evening walk"]
+
+def test_rollups_follow_completions(db_connection):
+    repository = habit_app.get_repository()
+    swim, read = add_habit("Swim", "weekly"), add_habit("Read", "daily")
+    for day in (date(2023, 1, 30), date(2023, 2, 8), date(2023, 2, 20)):
+        add_completion(swim, day)
+    add_completion(read, date(2023, 1, 31))
+    week = (date(2023, 1, 30).toordinal() - 1) // 7
+    assert repository.get_weekly_counts(swim.id) == [(swim.id, week, 1), (swim.id, week + 1, 1), (swim.id, week + 3, 1)]
+    assert repository.get_monthly_counts(swim.id) == [(swim.id, "2023-01", 1), (swim.id, "2023-02", 2)]
+    # The weekly streaks read from the rollup match the streaks computed from the completions
+    expected = analytics.compute_streak_stats(get_all_habits()[0])
+    stats = sql_analytics.get_weekly_streak_stats()[swim.id]
+    assert (stats.longest, stats.current, stats.last_period, stats.count) == (expected.longest, expected.current, expected.last_period, expected.count)
+    assert analytics.get_longest_streak_for_habit(swim, backend="sql") == expected.longest == 2
+    habit_app.rebuild_stats()
+    assert get_all_habits()[0].streak_stats.longest == 2
+    # Deleting completions uncounts them
+    db_connection.execute("DELETE FROM completions WHERE completion_date = '2023-02-08'")
+    db_connection.commit()
+    assert repository.get_weekly_counts(swim.id) == [(swim.id, week, 1), (swim.id, week + 3, 1)]
+    delete_habit(swim.id)
+    assert repository.get_weekly_counts() == [(read.id, (date(2023, 1, 31).toordinal() - 1) // 7, 1)]
+
+def test_rollups_are_filled_by_the_migration(db_connection):
+    habit = add_habit("Swim", "weekly")
+    add_completion(habit, date(2023, 1, 30))
+    add_completion(habit, date(2023, 3, 1))
+    # Go back to the schema before the rollups, with completions the rollups have not seen
+    for table in ("completion_weeks", "completion_months"):
+        db_connection.execute(f"DROP TABLE {table}")
+        for event in ("insert", "delete", "update"):
+            db_connection.execute(f"DROP TRIGGER rollup_{table}_{event}")
+    db_connection.execute("PRAGMA user_version = 5")
+    db_connection.commit()
+    init_db()
+    repository = habit_app.get_repository()
+    assert [row[1:] for row in repository.get_monthly_counts()] == [("2023-01", 1), ("2023-03", 1)]
+    assert len(repository.get_weekly_counts(habit.id)) == 2
+
+def test_deleting_a_habit_cascades(db_connection):
+    habit = add_habit("Swim", "weekly")
+    add_completion(habit, date(2023, 1, 30))
+    delete_habit(habit.id)
+    for table in ("completions", "habit_stats", "completion_weeks", "completion_months"):
+        assert db_connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0
+
+def test_archived_history_is_read_transparently(db_connection):
+    repository = habit_app.get_repository()
+    read, swim = add_habit("Read", "daily"), add_habit("Swim", "weekly")
+    days = [date(2022, 12, 28) + timedelta(days=offset) for offset in range(10)] + [date(2023, 1, 20)]
+    habit_app.add_completions([(read.id, day) for day in days] + [(swim.id, day) for day in days])
+    before = {habit.id: (list(habit.completion_days), habit.streak_stats.longest) for habit in get_all_habits()}
+    weeks = repository.get_weekly_counts()
+    # Archive everything before Thursday 5 January 2023, the horizon moves back to Monday 2 January
+    assert repository.archive_completions(date(2023, 1, 5).toordinal()) == 6
+    assert repository.archive_horizon() == date(2023, 1, 2).toordinal()
+    assert sorted(archive.CompletionArchive(habit_app.Database_Name + ".archive").years()) == [2022, 2023]
+    assert db_connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0] == 8
+    # Every history-wide read still sees the archived days, and the streaks still span the horizon
+    assert {habit.id: (list(habit.completion_days), habit.streak_stats.longest) for habit in get_all_habits()} == before
+    assert {habit.id: list(habit.completion_days) for habit in habit_app.iter_habits()} == {habit_id: days for habit_id, (days, _) in before.items()}
+    assert list(repository.get_completion_days(read.id)) == before[read.id][0]
+    assert repository.get_weekly_counts() == weeks
+    assert sql_analytics.get_longest_streak_for_habit(read.id) == 10
+    habit_app.rebuild_stats()
+    assert {habit.id: habit.streak_stats.longest for habit in get_all_habits()} == {read.id: 10, swim.id: 2}
+    assert repository.get_completed_habit_ids(date(2022, 12, 28).toordinal(), date(2022, 12, 28).toordinal()) == {read.id, swim.id}
+    assert repository.has_completion_between(swim.id, date(2022, 12, 26).toordinal(), date(2023, 1, 1).toordinal())
+    assert not repository.has_completion_between(swim.id, date(2022, 12, 19).toordinal(), date(2022, 12, 25).toordinal())
+    # Completions before the horizon are refused
+    with pytest.raises(ValueError):
+        add_completion(read, date(2022, 6, 1))
+    assert habit_app.add_completions([(read.id, date(2022, 6, 1))]) == 0
+    # Deleting a habit drops its archived history
+    delete_habit(read.id)
+    assert list(repository.all_archived_days()) == [swim.id]
+    assert list(repository.archived_days(read.id)) == []
+    # The next run moves the horizon kept in memory, and the files only gain the newly archived days
+    assert repository.archive_completions(date(2023, 1, 10).toordinal()) == 1
+    assert repository.horizon == date(2023, 1, 9).toordinal()
+    assert list(repository.get_completion_days(swim.id)) == before[swim.id][0]
+    repository.compact()
+    assert db_connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+def test_one_completion_per_period_is_enforced_by_the_database(db_connection):
+    habit = add_habit("Swim", "weekly")
+    week = (date(2023, 1, 30).toordinal() - 1) // 7
+    other = habit_app.HabitRepository(habit_app.Database_Name)
+    try:
+        assert add_completion(habit, date(2023, 1, 30))
+        # Another writer completing the same week is refused
+        assert other.add_completion(habit, date(2023, 2, 1)) is False
+    finally:
+        other.close()
+    # Writers that leave out the period key get it filled in, so they are refused as well
+    with pytest.raises(sqlite3.IntegrityError):
+        db_connection.execute("INSERT INTO completions (habit_id, completion_date) VALUES (?, '2023-02-03')", (habit.id,))
+    db_connection.execute("INSERT INTO completions (habit_id, completion_date) VALUES (?, '2023-02-06')", (habit.id,))
+    db_connection.commit()
+    assert db_connection.execute("SELECT period_key FROM completions ORDER BY id").fetchall() == [(week,), (week + 1,)]
+
+def test_concurrent_completions_of_a_period_add_one_row(db_connection):
+    habit = add_habit("Read", "daily")
+    other = habit_app.HabitRepository(habit_app.Database_Name)
+    results = []
+    try:
+        # The other writer starts while this transaction holds the completion, and has to wait for it to commit
+        with habit_app.transaction():
+            assert add_completion(habit, date(2023, 3, 1))
+            thread = threading.Thread(target=lambda: results.append(other.add_completion(habit, date(2023, 3, 1))))
+            thread.start()
+            time.sleep(0.2)
+        thread.join()
+    finally:
+        other.close()
+    assert results == [False]
+    assert db_connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0] == 1
+
+def test_store_completes_in_memory_only_after_the_database(db_connection, monkeypatch):
+    store = habit_app.HabitStore().load()
+    habit = store.add("Read", "daily")
+    def fail(habit, completion_date=None):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(store.repository, "add_completion", fail)
+    with pytest.raises(sqlite3.OperationalError):
+        store.complete(habit)
+    assert not habit.is_completed_today()
+    monkeypatch.delattr(store.repository, "add_completion")
+    assert store.complete(habit)
+    assert get_all_habits()[0].is_completed_today()
+
+def test_period_key_migration_keeps_the_first_completion_of_each_period(db_connection):
+    read, swim = add_habit("Read", "daily"), add_habit("Swim", "weekly")
+    # Go back to the schema before the period keys and add duplicate completions
+    # The table is copied without the column instead of using DROP COLUMN, which needs SQLite 3.35
+    db_connection.executescript("""
+        CREATE TABLE completions_old (id INTEGER PRIMARY KEY, habit_id INTEGER NOT NULL REFERENCES habits (id) ON DELETE CASCADE, completion_date DATE);
+        INSERT INTO completions_old SELECT id, habit_id, completion_date FROM completions;
+        DROP TABLE completions;
+        ALTER TABLE completions_old RENAME TO completions;
+        CREATE INDEX idx_completions_habit_date ON completions (habit_id, completion_date);
+        CREATE INDEX idx_completions_date_habit ON completions (completion_date, habit_id);
+        PRAGMA user_version = 8;
+    """)
+    # Dropping the old table dropped the triggers of the change counter and the rollups as well
+    habit_app.create_change_counter(db_connection)
+    habit_app.create_rollups(db_connection)
+    db_connection.executemany("INSERT INTO completions (habit_id, completion_date) VALUES (?, ?)", [
+        (read.id, "2023-03-01"), (read.id, "2023-03-01"), (read.id, "2023-03-02"),
+        (swim.id, "2023-03-01"), (swim.id, "2023-02-27"), (swim.id, "2023-03-08"),
+    ])
+    db_connection.commit()
+    init_db()
+    assert db_connection.execute("SELECT habit_id, completion_date FROM completions ORDER BY habit_id, completion_date").fetchall() == [
+        (read.id, "2023-03-01"), (read.id, "2023-03-02"), (swim.id, "2023-02-27"), (swim.id, "2023-03-08"),
+    ]
+    assert [(habit.streak_stats.longest, habit.streak_stats.count) for habit in get_all_habits()] == [(2, 2), (2, 2)]
+    assert [row[2] for row in habit_app.get_repository().get_weekly_counts(swim.id)] == [1, 1]